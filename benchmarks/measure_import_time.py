@@ -0,0 +1,72 @@
+from utils.logger import setup_custom_logger
+import subprocess
+import argparse
+import json
+import sys
+import os
+import re
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Repository root, which needs to be on the Python path of the measured interpreter
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry points that are invoked once per file by job systems
+ENTRY_POINTS = [
+    "classification.compute_scores_dct_matching",
+    "classification.score_motion_jpeg",
+    "classification.compute_upsampling_scores",
+    "data.create_data",
+]
+
+# Modules that must only be imported by the code paths that need them
+LAZY_MODULES = ["pandas", "scipy", "h5py", "tqdm", "exiftool", "decoder", "imageio", "PIL", "pyarrow", "numba"]
+
+# Default budget for importing a single entry point, in milliseconds
+DEFAULT_MAX_IMPORT_MS = 500
+
+
+def measure_import(module):
+    """
+    Imports a module in a fresh interpreter and reports which heavy modules it pulled in
+    :param module: dotted module name
+    :return: cumulative import time in milliseconds, and list of lazy modules that were imported, as 2-tuple
+    """
+    code = "import {}, sys, json; print(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules))))".format(module)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR] + [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]))
+    # -X importtime reports to stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True)
+
+    # Each line reads "import time: self [us] | cumulative | imported package", top-level imports are not indented
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = re.match(r"^import time:\s+\d+ \|\s+(\d+) \| (\S.*)$", line)
+        if match is not None:
+            total_us += int(match.group(1))
+
+    imported = set(json.loads(result.stdout.strip().splitlines()[-1]))
+    return total_us / 1000., [m for m in LAZY_MODULES if m in imported]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the import time of the command line entry points and fails if it exceeds the budget or heavy dependencies are imported eagerly")
+    parser.add_argument("--max_import_ms", type=float, default=DEFAULT_MAX_IMPORT_MS, help="Budget for importing a single entry point in milliseconds")
+    parser.add_argument("--entry_points", nargs="+", type=str, default=ENTRY_POINTS, help="Modules to measure")
+    args = vars(parser.parse_args())
+
+    failed = False
+    for module in args["entry_points"]:
+        import_ms, eager_modules = measure_import(module)
+        log.info("{}: {:.1f} ms".format(module, import_ms))
+
+        if import_ms > args["max_import_ms"]:
+            log.error("{}: import takes {:.1f} ms, exceeding the budget of {:.1f} ms".format(module, import_ms, args["max_import_ms"]))
+            failed = True
+        if len(eager_modules) > 0:
+            log.error("{}: imports {} at startup".format(module, ", ".join(eager_modules)))
+            failed = True
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,299 @@
+from utils.logger import setup_custom_logger
+import collections
+import subprocess
+import statistics
+import threading
+import itertools
+import tempfile
+import argparse
+import json
+import time
+import sys
+import os
+import re
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Repository root, which needs to be on the Python path of the measured interpreter
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO_DIR, "classification", "compute_scores_dct_matching.py")
+DEFAULT_QUALITY_FACTOR_ESTIMATOR = os.path.join(REPO_DIR, "data", "quality_factor_estimator_libjpeg_state.h5")
+
+# Options of the scoring CLI that can be swept, combined with "+", e.g., "crop+noise_residual"
+OPTIONS = ["crop", "noise_residual", "reduce_444_chroma"]
+NO_OPTIONS = "none"
+DEFAULT_OPTION_SETS = [NO_OPTIONS] + OPTIONS
+
+# Edge lengths of the synthetic images in pixels
+DEFAULT_SIZES = [512, 1024, 2048]
+DEFAULT_NUM_IMAGES = 32
+
+# Seconds between two samples of the resident memory of the scoring processes
+RSS_SAMPLING_INTERVAL = 0.05
+
+
+def default_num_workers():
+    """
+    :return: 0 (scoring in the main process), followed by powers of two up to the number of CPUs
+    """
+    num_cpus = os.cpu_count() or 1
+    return [0] + [2 ** i for i in range(num_cpus.bit_length()) if 2 ** i <= num_cpus]
+
+
+def create_synthetic_corpus(output_dir, size, num_images, quality=90, seed=0):
+    """
+    Writes smooth random color images, alternately with 4:2:0 and 4:4:4 chroma subsampling, such that --reduce_444_chroma has images to work on.
+    :param output_dir: directory to write the images to
+    :param size: edge length of the square images in pixels
+    :param num_images: number of images
+    :param quality: JPEG quality factor
+    :param seed: random seed
+    :return: list of file paths
+    """
+    from PIL import Image
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    img_filenames = []
+    for i in range(num_images):
+        # Upsampled noise plus fine grain compresses roughly like a photograph
+        coarse = rng.integers(0, 256, size=(size // 16 + 1, size // 16 + 1, 3)).astype(np.float64)
+        img = np.repeat(np.repeat(coarse, 16, axis=0), 16, axis=1)[:size, :size]
+        img = np.clip(img + rng.normal(scale=8, size=img.shape), 0, 255).astype(np.uint8)
+
+        img_filename = os.path.join(output_dir, "synthetic_{}_{:04d}_quality_{}.jpg".format(size, i, quality))
+        # Pillow's subsampling 2 is 4:2:0, 0 is 4:4:4
+        Image.fromarray(img).save(img_filename, quality=quality, subsampling=2 if i % 2 == 0 else 0)
+        img_filenames.append(img_filename)
+
+    return img_filenames
+
+
+def get_process_tree_rss(pid):
+    """
+    Sums the resident memory of a process and all its descendants, read from /proc
+    :param pid: process id of the root process
+    :return: resident memory in bytes, 0 if /proc is not available
+    """
+    children = collections.defaultdict(list)
+    rss_pages = dict()
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                # The process name may contain spaces and is enclosed in parentheses, the remaining fields start with the state
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            # Process exited in the meantime
+            continue
+        children[int(fields[1])].append(int(entry))
+        rss_pages[int(entry)] = int(fields[21])
+
+    total_pages = 0
+    stack = [pid]
+    while len(stack) > 0:
+        p = stack.pop()
+        total_pages += rss_pages.get(p, 0)
+        stack.extend(children.get(p, []))
+    return total_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def run_configuration(data_dir, quality_factor_estimator_filename, num_workers, options, work_dir):
+    """
+    Runs the scoring CLI once and measures its resource usage, including all worker and exiftool processes
+    :param data_dir: directory of images to score
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param num_workers: number of worker processes, 0 to score in the main process
+    :param options: list of options from OPTIONS to enable
+    :param work_dir: directory for the output and log files
+    :return: dict of wall time and CPU time in seconds, peak resident memory of the process tree, and of the largest single process, in bytes
+    """
+    cmd = [sys.executable, SCRIPT, data_dir, os.path.join(work_dir, "scores.csv"), quality_factor_estimator_filename]
+    cmd += ["--{}".format(option) for option in options]
+    if num_workers > 0:
+        cmd += ["--num_workers", str(num_workers)]
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR] + [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]))
+    log_filename = os.path.join(work_dir, "scoring.log")
+
+    with open(log_filename, "w") as log_file:
+        start = time.monotonic()
+        process = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+        # Sample the memory of the process tree until the process exits
+        peak_rss = [0]
+        done = threading.Event()
+
+        def sample_rss():
+            while not done.is_set():
+                peak_rss[0] = max(peak_rss[0], get_process_tree_rss(process.pid))
+                done.wait(RSS_SAMPLING_INTERVAL)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+        # Unlike Popen.wait, wait4 reports the resource usage of the process including all descendants it has waited for
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.monotonic() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        done.set()
+        sampler.join()
+
+    if process.returncode != 0:
+        with open(log_filename) as f:
+            log.error(f.read()[-2000:])
+        raise RuntimeError("Scoring failed with exit code {}".format(process.returncode))
+
+    return {
+        "wall_time": wall_time,
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss": peak_rss[0],
+        "max_process_rss": rusage.ru_maxrss * 1024,
+    }
+
+
+def median_run(runs):
+    """
+    :param runs: list of dicts as returned by run_configuration
+    :return: run with the median wall time
+    """
+    return sorted(runs, key=lambda r: r["wall_time"])[len(runs) // 2]
+
+
+def measure_startup(quality_factor_estimator_filename, num_workers, options, repeats=1):
+    """
+    Runs the scoring CLI on an empty directory, which measures the time for starting the interpreter, importing modules, loading the quality factor estimator and starting the workers
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param num_workers: number of worker processes, 0 to score in the main process
+    :param options: list of options from OPTIONS to enable
+    :param repeats: number of runs, of which the median wall time is reported
+    :return: dict as returned by run_configuration
+    """
+    runs = []
+    with tempfile.TemporaryDirectory() as empty_dir:
+        for _ in range(repeats):
+            with tempfile.TemporaryDirectory() as work_dir:
+                runs.append(run_configuration(empty_dir, quality_factor_estimator_filename, num_workers, options, work_dir))
+    return median_run(runs)
+
+
+def measure(corpora, quality_factor_estimator_filename, num_workers_list, option_sets, repeats=1):
+    """
+    Sweeps all combinations of corpus, options and number of workers.
+    Throughput and CPU utilization refer to the scoring phase only: the start-up time of each combination of options and number of workers, measured on an empty directory, is subtracted from the wall time and the CPU time.
+    :param corpora: list of 2-tuples of corpus name (e.g., image size) and directory
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param num_workers_list: numbers of worker processes, 0 to score in the main process
+    :param option_sets: list of option sets, each a "+"-separated combination of OPTIONS or "none"
+    :param repeats: number of runs per configuration, of which the median wall time is reported
+    :return: list of dicts, one per configuration
+    """
+    records = []
+    startups = dict()
+    for (corpus, data_dir), option_set, num_workers in itertools.product(corpora, option_sets, num_workers_list):
+        options = [] if NO_OPTIONS == option_set else option_set.split("+")
+        if (option_set, num_workers) not in startups:
+            startups[option_set, num_workers] = measure_startup(quality_factor_estimator_filename, num_workers, options, repeats=repeats)
+        startup = startups[option_set, num_workers]
+
+        img_filenames = [os.path.join(dp, f) for dp, dn, filenames in os.walk(data_dir) for f in filenames if re.search(".(jpg|jpeg)$", f.lower()) is not None]
+        num_bytes = sum(os.path.getsize(img_filename) for img_filename in img_filenames)
+
+        runs = []
+        for _ in range(repeats):
+            with tempfile.TemporaryDirectory() as work_dir:
+                runs.append(run_configuration(data_dir, quality_factor_estimator_filename, num_workers, options, work_dir))
+        run = median_run(runs)
+        # Guard against start-up times that vary by more than the scoring phase takes
+        scoring_time = max(run["wall_time"] - startup["wall_time"], 1e-3)
+
+        record = {
+            "corpus": corpus,
+            "options": option_set,
+            "num_workers": num_workers,
+            "num_images": len(img_filenames),
+            "megabytes": num_bytes / 1e6,
+            "wall_time": run["wall_time"],
+            "wall_time_stdev": statistics.stdev([r["wall_time"] for r in runs]) if len(runs) > 1 else 0.,
+            "startup_time": startup["wall_time"],
+            "scoring_time": scoring_time,
+            "images_per_second": len(img_filenames) / scoring_time,
+            "megabytes_per_second": num_bytes / 1e6 / scoring_time,
+            # Average number of busy cores
+            "cpu_utilization": max(run["cpu_time"] - startup["cpu_time"], 0.) / scoring_time,
+            "peak_rss_mb": run["peak_rss"] / 1e6,
+            "max_process_rss_mb": run["max_process_rss"] / 1e6,
+        }
+        records.append(record)
+        log.info("{corpus} {options} workers={num_workers}: {images_per_second:.2f} images/s, {megabytes_per_second:.2f} MB/s, {cpu_utilization:.2f} cores, {peak_rss_mb:.0f} MB, {startup_time:.2f}s start-up".format(**record))
+
+    add_scaling_efficiency(records)
+    return records
+
+
+def add_scaling_efficiency(records):
+    """
+    Relates the throughput of each configuration to the throughput with the fewest workers of the same corpus and options, scaled by the number of workers.
+    An efficiency well below 1 indicates that adding workers no longer pays off, e.g., because of memory bandwidth, exiftool or I/O.
+    :param records: list of dicts as returned by measure, which are updated in place
+    """
+    baselines = dict()
+    for record in sorted(records, key=lambda r: r["num_workers"]):
+        key = (record["corpus"], record["options"])
+        baseline = baselines.setdefault(key, record)
+        speedup = record["images_per_second"] / baseline["images_per_second"]
+        record["speedup"] = speedup
+        record["efficiency"] = speedup / (max(record["num_workers"], 1) / max(baseline["num_workers"], 1))
+
+
+def format_table(records):
+    """
+    :param records: list of dicts as returned by measure
+    :return: table as multi-line string
+    """
+    columns = [("corpus", "{}"), ("options", "{}"), ("num_workers", "{}"), ("num_images", "{}"), ("startup_time", "{:.2f}"), ("images_per_second", "{:.2f}"), ("megabytes_per_second", "{:.2f}"),
+               ("cpu_utilization", "{:.2f}"), ("speedup", "{:.2f}"), ("efficiency", "{:.2f}"), ("peak_rss_mb", "{:.0f}"), ("max_process_rss_mb", "{:.0f}")]
+    rows = [[name for name, _ in columns]] + [[fmt.format(record[name]) for name, fmt in columns] for record in records]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how the throughput of the scoring CLI scales with the number of workers, the image size and the enabled options")
+    parser.add_argument("--data_dir", type=str, help="Directory of images to score instead of synthetic images")
+    parser.add_argument("--quality_factor_estimator_filename", type=str, default=DEFAULT_QUALITY_FACTOR_ESTIMATOR, help="Path to state of quality factor estimator as HDF5 file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Edge lengths of the synthetic images in pixels")
+    parser.add_argument("--num_images", type=int, default=DEFAULT_NUM_IMAGES, help="Number of synthetic images per size")
+    parser.add_argument("--num_workers", type=int, nargs="+", default=default_num_workers(), help="Numbers of worker processes to sweep, 0 to score in the main process")
+    parser.add_argument("--option_sets", type=str, nargs="+", default=DEFAULT_OPTION_SETS, help="Option sets to sweep, each none or a +-separated combination of {}".format(", ".join(OPTIONS)))
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs per configuration, of which the median is reported")
+    parser.add_argument("--output_json", type=str, help="Where to store the measurements as JSON")
+    args = vars(parser.parse_args())
+
+    for option_set in args["option_sets"]:
+        if NO_OPTIONS != option_set and any(option not in OPTIONS for option in option_set.split("+")):
+            parser.error("Unknown option set {}".format(option_set))
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        if args["data_dir"] is not None:
+            corpora = [(os.path.basename(os.path.normpath(args["data_dir"])), args["data_dir"])]
+        else:
+            corpora = []
+            for size in args["sizes"]:
+                size_dir = os.path.join(corpus_dir, str(size))
+                os.makedirs(size_dir)
+                create_synthetic_corpus(size_dir, size, args["num_images"])
+                corpora.append(("{}x{}".format(size, size), size_dir))
+
+        records = measure(corpora, args["quality_factor_estimator_filename"], args["num_workers"], args["option_sets"], repeats=args["repeats"])
+
+    print(format_table(records))
+
+    if args["output_json"] is not None:
+        with open(args["output_json"], "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "configurations": records}, f, indent=2)
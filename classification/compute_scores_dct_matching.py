@@ -1,17 +1,26 @@
-from utils.constants import COL_FILENAME, COL_CB_SCORE, COL_CR_SCORE, COL_MAX_V_SAMP_FACTOR, COL_MAX_H_SAMP_FACTOR, COL_CB_V_SAMP_FACTOR, COL_CB_H_SAMP_FACTOR, COL_EXIF_MAKE, COL_EXIF_MODEL, COL_ESTIMATED_QUALITY_FACTOR, COL_ESTIMATED_QUALITY_FACTOR_DISTANCE, COL_CROP_TOP, COL_CROP_LEFT
+from utils.constants import COL_FILENAME, COL_CB_SCORE, COL_CR_SCORE, COL_MAX_V_SAMP_FACTOR, COL_MAX_H_SAMP_FACTOR, COL_CB_V_SAMP_FACTOR, COL_CB_H_SAMP_FACTOR, COL_EXIF_MAKE, COL_EXIF_MODEL, COL_ESTIMATED_QUALITY_FACTOR, COL_ESTIMATED_QUALITY_FACTOR_DISTANCE, COL_CROP_TOP, COL_CROP_LEFT, COL_CB_BEST_TEMPLATE, COL_CR_BEST_TEMPLATE, COL_CB_TEMPLATE_SCORE, COL_CR_TEMPLATE_SCORE, COL_DUPLICATE_OF, COL_CB_ROI_SCORE, COL_CR_ROI_SCORE, COL_CB_ROI_COMPLEMENT_SCORE, COL_CR_ROI_COMPLEMENT_SCORE, COL_ROI_NUM_BLOCKS, COL_ROI_COMPLEMENT_NUM_BLOCKS, COL_CB_STATISTIC, COL_CR_STATISTIC, COL_CB_CR_AGREEMENT, DECODER_DCT_COEFFICIENT
 from detectors.dct.dct_template_matching_detector import DctTemplateMatchingDetector
+from detectors.dct.dct_template_bank_detector import DctTemplateBankDetector
+from detectors.score_aggregator import ScoreAggregator, STAT_MEAN, DEFAULT_NUM_BINS, DEFAULT_QUANTILES, DEFAULT_THRESHOLDS
 from data.quality_factor_estimator import QualityFactorEstimator
-from decoder import PyCoefficientDecoder
 from utils.logger import setup_custom_logger
-from utils.upsampling import reduce_444_chroma_channel
-from utils.noise_residual import obtain_noise_residual
-from utils.cropping import crop
-from tqdm import tqdm
-import pandas as pd
+from utils import kernels
+from utils.deduplication import find_duplicate_files, content_fingerprint, full_hash
+from utils.result_writer import get_result_writer, FORMATS
+from utils.scheduling import estimate_cost, LongestProcessingTimeFirstQueue, COST_FILE_SIZE, COST_MODELS
+from utils.roi import score_channel_rois, parse_roi, DEFAULT_CONTEXT_BLOCKS
+from utils.jpeg_io import read_exif_make_and_model, is_archive, iterate_archive, split_jpeg_stream, ARCHIVE_SEPARATOR, STDIN
+from utils.verification import ScoreVerifier, VerificationError, DEFAULT_TOLERANCE
+from utils.chroma_decoder import open_decoder, is_jpeg_bytes, DECODERS
+from utils.group_summary import GroupSummary, get_summary_filename, DEFAULT_NUM_BINS as DEFAULT_SUMMARY_BINS
 import numpy as np
 import argparse
+import contextlib
 import traceback
-import exiftool
+import hashlib
+import json
+import time
+import sys
 import os
 import re
 
@@ -19,146 +28,805 @@ import re
 log = setup_custom_logger(os.path.basename(__file__))
 
 
-def loop(data_dir, output_csv, detector, quality_factor_estimator_filename, quality=None, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False):
+# With worker processes, number of inputs with content to read ahead per worker
+PENDING_INPUTS_PER_WORKER = 16
+
+# Suffix of the file next to a shard's output that records the command line arguments the shard was computed with
+ARGUMENTS_SUFFIX = "_args.json"
+
+# Column order of the results table
+RESULT_COLUMNS = [COL_FILENAME, COL_MAX_V_SAMP_FACTOR, COL_MAX_H_SAMP_FACTOR, COL_CB_V_SAMP_FACTOR, COL_CB_H_SAMP_FACTOR, COL_EXIF_MAKE, COL_EXIF_MODEL, COL_CB_SCORE, COL_CR_SCORE, COL_ESTIMATED_QUALITY_FACTOR, COL_ESTIMATED_QUALITY_FACTOR_DISTANCE, COL_CROP_TOP, COL_CROP_LEFT]
+
+
+def get_make_and_model(metadata):
+    """
+    Extracts camera make and model from the metadata reported by exiftool
+    :param metadata: dict of metadata for a single file
+    :return: make and model as 2-tuple, empty strings if not available
+    """
+    make = metadata["EXIF:Make"] if "EXIF:Make" in metadata else ""
+    model = metadata["EXIF:Model"] if "EXIF:Model" in metadata else ""
+    return make, model
+
+
+def complete_row(row, make, model):
+    """
+    Adds camera make and model to the scores of a single image and brings the columns into the order of the results table
+    :param row: dict as returned by score_image
+    :param make: camera make
+    :param model: camera model
+    :return: dict with columns ordered as in RESULT_COLUMNS, followed by any additional columns
+    """
+    row = dict(row, **{COL_EXIF_MAKE: make, COL_EXIF_MODEL: model})
+    ordered_row = {col: row[col] for col in RESULT_COLUMNS if col in row}
+    ordered_row.update(row)
+    return ordered_row
+
+
+def get_crop_offsets(img):
+    """
+    Derives the number of pixels to crop from the top and left margins from a hash of the file content, such that identical content is always cropped identically, regardless of the process, shard or run that scores it
+    :param img: path to JPEG file, or JPEG file content as bytes
+    :return: 2-tuple of number of pixels to crop from the top and left margins, each in range [0, 8)
+    """
+    digest = hashlib.sha1(img).hexdigest() if is_jpeg_bytes(img) else full_hash(img)
+    value = int(digest[:8], 16)
+    return value % 8, (value // 8) % 8
+
+
+def score_image(img_filename, detector, quality_factor_estimator, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, rois=None, roi_context_blocks=DEFAULT_CONTEXT_BLOCKS, verifier=None, decoder_name=DECODER_DCT_COEFFICIENT, data=None):
+    """
+    Computes the detection scores for a single jpg image.
+    :param img_filename: path to jpg file, or name of the image if data is given
+    :param detector: detector instance
+    :param quality_factor_estimator: quality factor estimator instance
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_top_left_margins: Whether to crop a number of pixels from top and left margins, derived from the file content, see get_crop_offsets
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param rois: (optional) list of regions of interest as 4-tuples of left, top, right and bottom pixel coordinates, see score_decoder
+    :param roi_context_blocks: number of blocks around each region of interest whose scores make up its complement score
+    :param verifier: (optional) ScoreVerifier instance, see score_decoder
+    :param decoder_name: decoder backend, see utils.chroma_decoder.open_decoder
+    :param data: (optional) JPEG file content as bytes, which is decoded instead of reading the file
+    :return: dict with one entry per result column except for camera make and model, or None if the sanity check failed
+    """
+    img = img_filename if data is None else data
+    crop_offsets = get_crop_offsets(img) if crop_top_left_margins else None
+    with open_decoder(img, decoder_name) as decoder:
+        return score_decoder(decoder, img_filename, detector, quality_factor_estimator, reduce_444_chroma=reduce_444_chroma, crop_top_left_margins=crop_top_left_margins, use_noise_residual=use_noise_residual, crop_offsets=crop_offsets, rois=rois, roi_context_blocks=roi_context_blocks, verifier=verifier)
+
+
+def score_decoder(decoder, img_filename, detector, quality_factor_estimator, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, crop_offsets=None, rois=None, roi_context_blocks=DEFAULT_CONTEXT_BLOCKS, verifier=None):
+    """
+    Computes the detection scores for a single decoded jpg image.
+    :param decoder: PyCoefficientDecoder instance of the image
+    :param img_filename: name of the image to report in the results and log messages
+    :param detector: detector instance
+    :param quality_factor_estimator: quality factor estimator instance
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_top_left_margins: Whether to crop a number of pixels, derived from the file content, from top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param crop_offsets: 2-tuple of number of pixels to crop from the top and left margins, required if crop_top_left_margins is set, see get_crop_offsets
+    :param rois: (optional) list of regions of interest as 4-tuples of left, top, right and bottom pixel coordinates in the full-resolution image. If given, only the blocks around these regions are processed. The Cb and Cr scores are then averaged over the union of all regions, and each region gets its own score and complement score columns.
+    :param roi_context_blocks: number of blocks around each region of interest whose scores make up its complement score. Blocks inside any region of interest are excluded from the complement.
+    :param verifier: (optional) ScoreVerifier instance. If given, the scoring time is added to the results, and images selected by the verifier are scored a second time with the reference implementations. Cannot be combined with regions of interest.
+    :return: dict with one entry per result column except for camera make and model, or None if the sanity check failed
+    """
+    num_vertical_blocks = decoder.get_height_in_blocks(1)
+    num_horizontal_blocks = decoder.get_width_in_blocks(1)
+
+    # Get sampling factors
+    max_v_samp_factor = decoder.max_v_samp_factor
+    max_h_samp_factor = decoder.max_h_samp_factor
+    cb_v_samp_factor = decoder.v_samp_factor(1)
+    cb_h_samp_factor = decoder.h_samp_factor(1)
+
+    # Sanity checks
+    if decoder.get_height_in_blocks(2) != num_vertical_blocks or decoder.get_width_in_blocks(2) != num_horizontal_blocks or decoder.v_samp_factor(0) != max_v_samp_factor or decoder.h_samp_factor(0) != max_h_samp_factor:
+        log.error("Sanity check failed for image {}. Please doublecheck.".format(img_filename))
+        return None
+
+    # Load DCT coefficients for Cb and Cr channels
+    cb_dct_coefs = decoder.get_dct_coefficients(1).reshape(num_vertical_blocks, num_horizontal_blocks, 64)
+    cr_dct_coefs = decoder.get_dct_coefficients(2).reshape(num_vertical_blocks, num_horizontal_blocks, 64)
+
+    # Optionally downsample chroma channels by a factor of two in both directions
+    reduce_chroma = reduce_444_chroma and max_v_samp_factor == 1 and max_h_samp_factor == 1
+
+    # Optionally crop top-left margins in spatial domain
+    if crop_top_left_margins:
+        # Offsets are never drawn here, since worker processes share the state of the global random number generator
+        if crop_offsets is None:
+            raise ValueError("Cropping requires crop offsets, see get_crop_offsets")
+        crop_top, crop_left = crop_offsets
+    else:
+        crop_top = 0
+        crop_left = 0
+
+    # Get quantization tables
+    cb_quantization_table = decoder.get_quantization_table(1).ravel()
+    cr_quantization_table = decoder.get_quantization_table(2).ravel()
+
+    if not np.allclose(cb_quantization_table, cr_quantization_table):
+        log.warning("Quantization tables for Cb and Cr channels are different for image {}".format(img_filename))
+
+    # Estimate quality factor
+    estimated_quality_factor, estimated_quality_factor_distance = quality_factor_estimator.find_nearest_quality_factor(cb_quantization_table)
+
+    if rois is not None:
+        # Only process the blocks around the regions of interest
+        cb_score, cr_score, extra_columns = score_channels_rois(cb_dct_coefs, cr_dct_coefs, cb_quantization_table, cr_quantization_table, detector, rois, cb_v_samp_factor / max_v_samp_factor, cb_h_samp_factor / max_h_samp_factor, reduce_chroma, (crop_top, crop_left), use_noise_residual, roi_context_blocks)
+    else:
+        crop_offsets = (crop_top, crop_left) if crop_top_left_margins else None
+        if verifier is not None:
+            verifier.warm_up(lambda cb, cr: score_channels(cb, cr, cb_quantization_table, cr_quantization_table, detector, reduce_chroma, crop_offsets, use_noise_residual), cb_dct_coefs, cr_dct_coefs)
+
+        start = time.perf_counter()
+        cb_score, cr_score, extra_columns = score_channels(cb_dct_coefs, cr_dct_coefs, cb_quantization_table, cr_quantization_table, detector, reduce_chroma, crop_offsets, use_noise_residual)
+
+        if verifier is not None:
+            extra_columns.update(verifier.verify(img_filename, cb_dct_coefs, cr_dct_coefs, cb_quantization_table, cr_quantization_table, cb_score, cr_score, time.perf_counter() - start, reduce_chroma=reduce_chroma, crop_offsets=crop_offsets, use_noise_residual=use_noise_residual))
+
+    return dict({
+        COL_FILENAME: img_filename,
+        COL_MAX_V_SAMP_FACTOR: max_v_samp_factor,
+        COL_MAX_H_SAMP_FACTOR: max_h_samp_factor,
+        COL_CB_V_SAMP_FACTOR: cb_v_samp_factor,
+        COL_CB_H_SAMP_FACTOR: cb_h_samp_factor,
+        COL_CB_SCORE: cb_score,
+        COL_CR_SCORE: cr_score,
+        COL_ESTIMATED_QUALITY_FACTOR: estimated_quality_factor,
+        COL_ESTIMATED_QUALITY_FACTOR_DISTANCE: estimated_quality_factor_distance,
+        COL_CROP_TOP: crop_top,
+        COL_CROP_LEFT: crop_left,
+    }, **extra_columns)
+
+
+def score_channels(cb_dct_coefs, cr_dct_coefs, cb_quantization_table, cr_quantization_table, detector, reduce_chroma=False, crop_offsets=None, use_noise_residual=False):
+    """
+    Computes the detection scores over the whole Cb and Cr channels
+    :param cb_dct_coefs: quantized DCT coefficients of the Cb channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param cr_dct_coefs: quantized DCT coefficients of the Cr channel
+    :param cb_quantization_table: flat quantization table of the Cb channel
+    :param cr_quantization_table: flat quantization table of the Cr channel
+    :param detector: detector instance
+    :param reduce_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_offsets: (optional) 2-tuple of number of pixels to crop from the top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :return: Cb score, Cr score, and dict of template bank and statistics columns
+    """
+    if reduce_chroma:
+        from utils.upsampling import reduce_444_chroma_channel
+        cb_dct_coefs = reduce_444_chroma_channel(cb_dct_coefs)
+        cr_dct_coefs = reduce_444_chroma_channel(cr_dct_coefs)
+
+    if crop_offsets is not None:
+        from utils.cropping import crop
+        cb_dct_coefs = crop(cb_dct_coefs, *crop_offsets)
+        cr_dct_coefs = crop(cr_dct_coefs, *crop_offsets)
+
+    if use_noise_residual:
+        from utils.noise_residual import obtain_noise_residual
+
+        # Dequantize
+        cb_dct_coefs = cb_dct_coefs * cb_quantization_table
+        cr_dct_coefs = cr_dct_coefs * cr_quantization_table
+
+        cb_dct_coefs = obtain_noise_residual(cb_dct_coefs)
+        cr_dct_coefs = obtain_noise_residual(cr_dct_coefs)
+
+        # Scores are computed on the dequantized coefficients
+        cb_detector_quantization_table = None
+        cr_detector_quantization_table = None
+    else:
+        # The detector folds the quantization tables into the correlation, which saves dequantizing the coefficients
+        cb_detector_quantization_table = cb_quantization_table
+        cr_detector_quantization_table = cr_quantization_table
+
+    # Compute maps of matching against model, from which the scores and any further statistics are derived
+    cb_map = detector.detect_map(cb_dct_coefs, quantization_table=cb_detector_quantization_table)
+    cr_map = detector.detect_map(cr_dct_coefs, quantization_table=cr_detector_quantization_table)
+
+    columns = {}
+    if isinstance(detector, DctTemplateBankDetector):
+        # Average each template separately, the first template gives the main scores
+        cb_template_scores = np.mean(cb_map, axis=(0, 1))
+        cr_template_scores = np.mean(cr_map, axis=(0, 1))
+        cb_score = cb_template_scores[0]
+        cr_score = cr_template_scores[0]
+
+        for template_name, cb_template_score, cr_template_score in zip(detector.template_names, cb_template_scores, cr_template_scores):
+            columns[COL_CB_TEMPLATE_SCORE.format(template_name)] = cb_template_score
+            columns[COL_CR_TEMPLATE_SCORE.format(template_name)] = cr_template_score
+        columns[COL_CB_BEST_TEMPLATE] = detector.best_template(cb_template_scores)
+        columns[COL_CR_BEST_TEMPLATE] = detector.best_template(cr_template_scores)
+    else:
+        cb_score = np.mean(cb_map)
+        cr_score = np.mean(cr_map)
+
+    if detector.aggregator is not None:
+        columns.update(get_statistics_columns(detector, cb_map, cr_map))
+
+    return cb_score, cr_score, columns
+
+
+def get_statistics_columns(detector, cb_map, cr_map):
+    """
+    Summarizes the detection maps of both chroma channels by the statistics of the detector's aggregator
+    :param detector: detector instance with aggregator
+    :param cb_map: detection map of the Cb channel as returned by detect_map
+    :param cr_map: detection map of the Cr channel
+    :return: dict of statistics columns per channel and the agreement between both channels
     """
-    Computes the detection scores over all jpg images in the given directory.
+    columns = {}
+    for col, detection_map in [(COL_CB_STATISTIC, cb_map), (COL_CR_STATISTIC, cr_map)]:
+        for name, value in detector.aggregate_map(detection_map).items():
+            # The mean equals the main score
+            if STAT_MEAN != name:
+                columns[col.format(name)] = value
+
+    # Agreement of the main template between the channels
+    if cb_map.ndim == 3:
+        cb_map, cr_map = cb_map[:, :, 0], cr_map[:, :, 0]
+    columns[COL_CB_CR_AGREEMENT] = detector.aggregator.agreement(cb_map, cr_map)
+    return columns
+
+
+def score_channels_rois(cb_dct_coefs, cr_dct_coefs, cb_quantization_table, cr_quantization_table, detector, rois, v_scale, h_scale, reduce_chroma=False, crop_offsets=(0, 0), use_noise_residual=False, context_blocks=DEFAULT_CONTEXT_BLOCKS):
+    """
+    Computes the detection scores inside regions of interest of the Cb and Cr channels, see utils.roi.score_channel_rois
+    :param cb_dct_coefs: quantized DCT coefficients of the Cb channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param cr_dct_coefs: quantized DCT coefficients of the Cr channel
+    :param cb_quantization_table: flat quantization table of the Cb channel
+    :param cr_quantization_table: flat quantization table of the Cr channel
+    :param detector: detector instance
+    :param rois: list of 4-tuples of left, top, right and bottom pixel coordinates in the full-resolution image
+    :param v_scale: vertical chroma resolution relative to the full-resolution image
+    :param h_scale: horizontal chroma resolution relative to the full-resolution image
+    :param reduce_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_offsets: 2-tuple of number of pixels to crop from the top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param context_blocks: number of blocks around each region whose scores make up its complement score
+    :return: Cb and Cr scores over the union of all regions, and dict of template bank and per-region columns
+    """
+    channel_args = dict(detector=detector, rois=rois, v_scale=v_scale, h_scale=h_scale, reduce_444_chroma=reduce_chroma, crop_offsets=crop_offsets, use_noise_residual=use_noise_residual, context_blocks=context_blocks)
+    cb_template_scores, cb_roi_scores = score_channel_rois(cb_dct_coefs, cb_quantization_table, **channel_args)
+    cr_template_scores, cr_roi_scores = score_channel_rois(cr_dct_coefs, cr_quantization_table, **channel_args)
+
+    # The first template gives the main scores
+    columns = {}
+    if isinstance(detector, DctTemplateBankDetector):
+        for template_name, cb_template_score, cr_template_score in zip(detector.template_names, cb_template_scores, cr_template_scores):
+            columns[COL_CB_TEMPLATE_SCORE.format(template_name)] = cb_template_score
+            columns[COL_CR_TEMPLATE_SCORE.format(template_name)] = cr_template_score
+        columns[COL_CB_BEST_TEMPLATE] = detector.best_template(cb_template_scores)
+        columns[COL_CR_BEST_TEMPLATE] = detector.best_template(cr_template_scores)
+
+    for i, (cb_roi_score, cr_roi_score) in enumerate(zip(cb_roi_scores, cr_roi_scores)):
+        columns[COL_CB_ROI_SCORE.format(i)] = cb_roi_score["score"][0]
+        columns[COL_CR_ROI_SCORE.format(i)] = cr_roi_score["score"][0]
+        columns[COL_CB_ROI_COMPLEMENT_SCORE.format(i)] = cb_roi_score["complement_score"][0]
+        columns[COL_CR_ROI_COMPLEMENT_SCORE.format(i)] = cr_roi_score["complement_score"][0]
+        columns[COL_ROI_NUM_BLOCKS.format(i)] = cb_roi_score["num_blocks"]
+        columns[COL_ROI_COMPLEMENT_NUM_BLOCKS.format(i)] = cb_roi_score["num_complement_blocks"]
+
+    return cb_template_scores[0], cr_template_scores[0], columns
+
+
+def find_img_filenames(data_dir, quality=None):
+    """
+    Recursively finds all jpg files in the given data directory
     :param data_dir: directory to look for jpg files (recursively)
-    :param output_csv: where to store the results
-    :param quality_factor_estimator_filename: persistent state of quality factor estimator
     :param quality: (optional) restrict to JPEG files ending like quality_75.jpg (if quality was set to 75)
-    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions. Useful for 4:4:4 images created from a previously compressed image.
-    :param crop_top_left_margins: Whether to crop a random number of pixels from top and left margins
-    :param use_noise_residual: whether to use noise residual instead of image
-    :return: data frame containing the results
+    :return: sorted list of file paths
     """
-    # Recursively find all jpg files in the given data directory
     search_string = ".(jpg|jpeg)$" if quality is None else "quality_{}.(jpg|jpeg)$".format(quality)
     img_filenames = [os.path.join(dp, f) for dp, dn, filenames in os.walk(data_dir) for f in filenames if re.search(search_string, f.lower()) is not None]
     # Sort files
-    img_filenames = sorted(img_filenames)
+    return sorted(img_filenames)
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification of the form "i/N"
+    :param shard: string like "3/8"
+    :return: shard index and number of shards as 2-tuple
+    """
+    match = re.match("^([0-9]+)/([0-9]+)$", shard)
+    if match is None:
+        raise argparse.ArgumentTypeError("Expected shard as i/N, e.g., 0/4")
+    shard_index, num_shards = int(match.group(1)), int(match.group(2))
+    if num_shards < 1 or shard_index >= num_shards:
+        raise argparse.ArgumentTypeError("Shard index must be in range [0, N)")
+    return shard_index, num_shards
+
+
+def get_shard_index_of_name(relative_name, num_shards):
+    """
+    Assigns an input to a shard by hashing its name.
+    The assignment does not depend on which other inputs exist, so it is stable when inputs are added, and identical on all nodes.
+    :param relative_name: path relative to the data directory, or name of the archive member
+    :param num_shards: total number of shards
+    :return: shard index in range [0, num_shards)
+    """
+    digest = hashlib.md5(relative_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def get_shard_index(img_filename, data_dir, num_shards):
+    """
+    Assigns a file to a shard by hashing its path relative to the data directory.
+    :param img_filename: path to jpg file
+    :param data_dir: directory the file was found in
+    :param num_shards: total number of shards
+    :return: shard index in range [0, num_shards)
+    """
+    relative_path = os.path.relpath(img_filename, data_dir).replace(os.sep, "/")
+    return get_shard_index_of_name(relative_path, num_shards)
+
+
+def get_input_shard_index(input_name, data_dir, num_shards):
+    """
+    Assigns an input as enumerated by iterate_inputs to a shard.
+    :param input_name: file path, or name of archive member or streamed image as reported in the filename column
+    :param data_dir: directory, archive or stream the input was found in
+    :param num_shards: total number of shards
+    :return: shard index in range [0, num_shards)
+    """
+    if STDIN == data_dir:
+        return get_shard_index_of_name(input_name, num_shards)
+
+    if input_name.startswith(data_dir + ARCHIVE_SEPARATOR):
+        # Archive member
+        return get_shard_index_of_name(input_name[len(data_dir) + len(ARCHIVE_SEPARATOR):], num_shards)
+
+    return get_shard_index(input_name, data_dir, num_shards)
+
 
-    quality_factor_estimator = QualityFactorEstimator(quality_factor_estimator_filename)
+def select_shard(img_filenames, data_dir, shard_index, num_shards):
+    """
+    :param img_filenames: list of file paths
+    :param data_dir: directory the files were found in
+    :param shard_index: index of the shard to select
+    :param num_shards: total number of shards
+    :return: files that belong to the given shard, in the given order
+    """
+    return [img_filename for img_filename in img_filenames if get_shard_index(img_filename, data_dir, num_shards) == shard_index]
+
+
+def iterate_inputs(data_dir, quality=None, shard=None, read_data=True):
+    """
+    Enumerates the jpg images to process, which are either files in a directory, members of a tar or zip archive, or a stream of concatenated JPEG files on stdin.
+    :param data_dir: directory to look for jpg files (recursively), path to tar or zip archive, or "-" for stdin
+    :param quality: (optional) restrict to JPEG files ending like quality_75.jpg (if quality was set to 75). Not applicable to stdin.
+    :param shard: (optional) 2-tuple of shard index and number of shards. Restricts the inputs to those of this shard.
+    :param read_data: whether to read the content of archive members. If False, yields None instead. Files on disk are never read.
+    :return: iterable of 2-tuples of input name and content as bytes (None for files on disk), and the number of inputs if known in advance (None otherwise), as 2-tuple
+    """
+    search_string = ".(jpg|jpeg)$" if quality is None else "quality_{}.(jpg|jpeg)$".format(quality)
+
+    if STDIN == data_dir:
+        # Stream of concatenated JPEG files
+        inputs = (("stdin{}{:08d}.jpg".format(ARCHIVE_SEPARATOR, i), data) for i, data in enumerate(split_jpeg_stream(sys.stdin.buffer)))
+        if shard is not None:
+            shard_index, num_shards = shard
+            inputs = ((name, data) for name, data in inputs if get_input_shard_index(name, data_dir, num_shards) == shard_index)
+        return inputs, None
+
+    if is_archive(data_dir):
+        # Members of other shards are skipped without reading their content
+        keep = None
+        if shard is not None:
+            shard_index, num_shards = shard
+            keep = lambda member_name: get_shard_index_of_name(member_name, num_shards) == shard_index
+        inputs = ((data_dir + ARCHIVE_SEPARATOR + member_name, data) for member_name, data in iterate_archive(data_dir, search_string, read_data=read_data, keep=keep))
+        return inputs, None
+
+    # Recursively find all jpg files in the given data directory
+    img_filenames = find_img_filenames(data_dir, quality)
+
+    if shard is not None:
+        shard_index, num_shards = shard
+        img_filenames = select_shard(img_filenames, data_dir, shard_index, num_shards)
+        log.info("Processing shard {}/{} with {} files".format(shard_index, num_shards, len(img_filenames)))
+
+    return [(img_filename, None) for img_filename in img_filenames], len(img_filenames)
+
+
+def score_input(img_filename, data, et, detector, quality_factor_estimator, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, rois=None, roi_context_blocks=DEFAULT_CONTEXT_BLOCKS, verifier=None, decoder_name=DECODER_DCT_COEFFICIENT):
+    """
+    Computes the complete result row for a single input, including camera make and model.
+    :param img_filename: name of the input, which is the path to the jpg file if data is None
+    :param data: JPEG file content as bytes, or None to read the file from disk
+    :param et: running exiftool instance, used for inputs read from disk
+    :param detector: detector instance
+    :param quality_factor_estimator: quality factor estimator instance
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_top_left_margins: Whether to crop a number of pixels, derived from the file content, from top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param rois: (optional) list of regions of interest, see score_decoder
+    :param roi_context_blocks: number of blocks around each region of interest whose scores make up its complement score
+    :param verifier: (optional) ScoreVerifier instance, see score_decoder
+    :param decoder_name: decoder backend, see utils.chroma_decoder.open_decoder
+    :return: dict with one entry per result column, or None if the image failed the sanity check or could not be processed
+    """
+    # We don't want the whole execution being terminated by a single malformed image, thus log exceptions and keep on going with the next image.
+    try:
+        # Archive members and streamed images are passed to the decoder as bytes, see open_decoder
+        row = score_image(img_filename, detector, quality_factor_estimator, reduce_444_chroma=reduce_444_chroma, crop_top_left_margins=crop_top_left_margins, use_noise_residual=use_noise_residual, rois=rois, roi_context_blocks=roi_context_blocks, verifier=verifier, decoder_name=decoder_name, data=data)
+        if row is None:
+            return None
+
+        # Camera make and model. exiftool only accepts paths, thus the Exif segment of images given as bytes is parsed in memory.
+        if data is None:
+            metadata = et.get_metadata(img_filename)
+            if isinstance(metadata, list):
+                metadata = metadata[0]
+            make, model = get_make_and_model(metadata)
+        else:
+            make, model = read_exif_make_and_model(data)
+
+        row = complete_row(row, make, model)
+        row[COL_FILENAME] = img_filename
+        return row
+
+    except Exception as e:
+        # Skip images that cannot be decoded
+        log.error("Error processing image {}".format(img_filename))
+        log.error(traceback.format_exc())
+        return None
+
+
+# State of each worker process, set up by _init_worker
+_worker = dict()
 
-    buffer = []
-    # Use single exiftool instance for all images
-    with exiftool.ExifToolHelper() as et:
-        for i in tqdm(range(len(img_filenames))):
-            img_filename = img_filenames[i]
-            # We don't want the whole execution being terminated by a single malformed image, thus log exceptions and keep on going with the next image.
+
+def _init_worker(detector, quality_factor_estimator_filename, score_args):
+    import multiprocessing.util
+    import exiftool
+
+    _worker["detector"] = detector
+    _worker["quality_factor_estimator"] = QualityFactorEstimator(quality_factor_estimator_filename)
+    _worker["score_args"] = score_args
+
+    # Use single exiftool instance per worker, terminated when the worker exits
+    _worker["et"] = exiftool.ExifToolHelper()
+    _worker["et"].run()
+    multiprocessing.util.Finalize(None, _worker["et"].terminate, exitpriority=10)
+
+
+def _score_task(index, img_filename, data):
+    return index, score_input(img_filename, data, _worker["et"], _worker["detector"], _worker["quality_factor_estimator"], **_worker["score_args"])
+
+
+def dispatch_longest_first(inputs, submit, wait, max_in_flight, cost_model=COST_FILE_SIZE, max_pending=None, progress=None):
+    """
+    Dispatches inputs to asynchronous workers longest-processing-time first, such that a few large images do not end up running alone at the end, and yields the results in input order.
+    :param inputs: iterable of 3-tuples of input name, JPEG file content as bytes or None, and name of the input this is a duplicate of or None. Duplicates are not dispatched.
+    :param submit: function that takes index, input name and content, and hands them to a worker
+    :param wait: function that blocks until the next worker finishes and returns the index and the result row or None
+    :param max_in_flight: maximum number of dispatched inputs that have not finished yet
+    :param cost_model: how to estimate the processing time of an image, see utils.scheduling
+    :param max_pending: (optional) maximum number of inputs to read ahead, which bounds the memory taken by inputs with content. By default, all inputs are read in advance and scheduled at once.
+    :param progress: (optional) progress bar to update
+    :return: generator of 3-tuples of input name, result row or None, and name of the input this is a duplicate of or None, in input order
+    """
+    inputs = iter(inputs)
+    pending = LongestProcessingTimeFirstQueue()
+    # Names of the inputs in flight
+    in_flight = dict()
+    # Finished inputs that wait for all previous inputs to finish
+    results = dict()
+    num_read = 0
+    num_yielded = 0
+    exhausted = False
+
+    while True:
+        # Read ahead
+        while not exhausted and (max_pending is None or len(pending) < max_pending):
             try:
-                decoder = PyCoefficientDecoder(img_filename)
+                img_filename, data, original_filename = next(inputs)
+            except StopIteration:
+                exhausted = True
+                break
 
-                num_vertical_blocks = decoder.get_height_in_blocks(1)
-                num_horizontal_blocks = decoder.get_width_in_blocks(1)
+            if original_filename is not None:
+                results[num_read] = (img_filename, None, original_filename)
+                if progress is not None:
+                    progress.update(1)
+            else:
+                pending.push(estimate_cost(img_filename, data, cost_model), (num_read, img_filename, data))
+            num_read += 1
 
-                # Get sampling factors
-                max_v_samp_factor = decoder.max_v_samp_factor
-                max_h_samp_factor = decoder.max_h_samp_factor
-                cb_v_samp_factor = decoder.v_samp_factor(1)
-                cb_h_samp_factor = decoder.h_samp_factor(1)
+        # Dispatch the most expensive pending inputs
+        while len(pending) > 0 and len(in_flight) < max_in_flight:
+            index, img_filename, data = pending.pop()
+            in_flight[index] = img_filename
+            submit(index, img_filename, data)
+
+        # Yield finished inputs in input order
+        while num_yielded in results:
+            yield results.pop(num_yielded)
+            num_yielded += 1
+
+        if exhausted and len(pending) == 0 and len(in_flight) == 0:
+            return
+
+        # Wait for the next input to finish
+        index, row = wait()
+        results[index] = (in_flight.pop(index), row, None)
+        if progress is not None:
+            progress.update(1)
+
+
+def score_inputs_in_parallel(inputs, num_workers, detector, quality_factor_estimator_filename, cost_model=COST_FILE_SIZE, max_pending=None, total=None, **score_args):
+    """
+    Scores inputs in worker processes. Pending inputs are dispatched longest-processing-time first, and results are yielded in input order.
+    :param inputs: iterable of 3-tuples of input name, JPEG file content as bytes or None, and name of the input this is a duplicate of or None. Duplicates are not scored.
+    :param num_workers: number of worker processes
+    :param detector: detector instance
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param cost_model: how to estimate the processing time of an image, see utils.scheduling
+    :param max_pending: (optional) maximum number of inputs to read ahead, see dispatch_longest_first
+    :param total: (optional) number of inputs for the progress bar
+    :param score_args: further arguments to score_input
+    :return: generator of 3-tuples of input name, result row or None, and name of the input this is a duplicate of or None, in input order
+    """
+    from tqdm import tqdm
+    import multiprocessing
+    import queue
+
+    # Worker callbacks report finished tasks through this queue
+    done_queue = queue.Queue()
+
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(detector, quality_factor_estimator_filename, score_args)) as pool, tqdm(total=total) as progress:
+        def submit(index, img_filename, data):
+            pool.apply_async(_score_task, (index, img_filename, data),
+                             callback=done_queue.put,
+                             error_callback=lambda e: done_queue.put((index, None)))
+
+        # Keep another task queued per worker, such that workers do not wait for the main process
+        yield from dispatch_longest_first(inputs, submit, done_queue.get, max_in_flight=2 * num_workers, cost_model=cost_model, max_pending=max_pending, progress=progress)
 
-                # Sanity checks
-                if decoder.get_height_in_blocks(2) != num_vertical_blocks or decoder.get_width_in_blocks(2) != num_horizontal_blocks or decoder.v_samp_factor(0) != max_v_samp_factor or decoder.h_samp_factor(0) != max_h_samp_factor:
-                    log.error("Sanity check failed for image {}. Please doublecheck.".format(img_filename))
-                    continue
 
-                # Load DCT coefficients for Cb and Cr channels
-                cb_dct_coefs = decoder.get_dct_coefficients(1).reshape(num_vertical_blocks, num_horizontal_blocks, 64)
-                cr_dct_coefs = decoder.get_dct_coefficients(2).reshape(num_vertical_blocks, num_horizontal_blocks, 64)
-
-                # Optionally downsample chroma channels by a factor of two in both directions
-                if reduce_444_chroma and max_v_samp_factor == 1 and max_h_samp_factor == 1:
-                    cb_dct_coefs = reduce_444_chroma_channel(cb_dct_coefs)
-                    cr_dct_coefs = reduce_444_chroma_channel(cr_dct_coefs)
-                    num_vertical_blocks, num_horizontal_blocks = cb_dct_coefs.shape[:2]
-
-                # Optionally crop top-left margins in spatial domain
-                if crop_top_left_margins:
-                    # Upper bound is exclusive
-                    crop_top = np.random.randint(0, 8)
-                    crop_left = np.random.randint(0, 8)
-                    cb_dct_coefs = crop(cb_dct_coefs, crop_top, crop_left)
-                    cr_dct_coefs = crop(cr_dct_coefs, crop_top, crop_left)
-                    num_vertical_blocks, num_horizontal_blocks = cb_dct_coefs.shape[:2]
+def loop(data_dir, output_csv, detector, quality_factor_estimator_filename, quality=None, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, shard=None, output_format=None, append=False, deduplicate=False, num_workers=None, cost_model=COST_FILE_SIZE, num_decode_workers=None, num_score_workers=None, num_slabs=None, slab_mb=None, rois=None, roi_context_blocks=DEFAULT_CONTEXT_BLOCKS, verifier=None, summary=None, decoder_name=DECODER_DCT_COEFFICIENT):
+    """
+    Computes the detection scores over all jpg images in the given directory, archive or stream.
+    :param data_dir: directory to look for jpg files (recursively), path to tar or zip archive, or "-" to read concatenated JPEG files from stdin
+    :param output_csv: where to store the results. Results are written as csv unless the file extension is .parquet or .pq.
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param quality: (optional) restrict to JPEG files ending like quality_75.jpg (if quality was set to 75)
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions. Useful for 4:4:4 images created from a previously compressed image.
+    :param crop_top_left_margins: Whether to crop a number of pixels, derived from the file content, from top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param shard: (optional) 2-tuple of shard index and number of shards. Restricts processing to the files of this shard.
+    :param output_format: (optional) "csv" or "parquet" to override the format inferred from the output file extension
+    :param append: whether to append to an existing output file
+    :param deduplicate: whether to score byte-identical inputs only once. Duplicates receive a copy of the first input's results, including its crop offsets, and the name of the first input in an additional column.
+    :param num_workers: (optional) number of worker processes. By default, images are processed in the main process.
+    :param cost_model: with worker processes, how to estimate the processing time of an image in order to process the most expensive images first. "size" uses the file size, "blocks" the number of blocks according to the frame header.
+    :param num_decode_workers: (optional) number of decoder processes. Together with num_score_workers, runs decoding and scoring in separate processes that hand over the coefficients through shared memory. Cannot be combined with num_workers.
+    :param num_score_workers: (optional) number of scoring processes of the staged pipeline
+    :param num_slabs: (optional) number of shared memory slabs of the staged pipeline, defaults to two per scoring process
+    :param slab_mb: (optional) size of each shared memory slab in MB
+    :param rois: (optional) list of regions of interest as 4-tuples of left, top, right and bottom pixel coordinates. If given, only the blocks around these regions are scored, see score_decoder.
+    :param roi_context_blocks: number of blocks around each region of interest whose scores make up its complement score
+    :param verifier: (optional) ScoreVerifier instance. If given, a fraction of images is scored a second time with the reference implementations. The reference scores, their absolute differences to the scores, and the time taken by both implementations are added to the results. Stops with a VerificationError after writing the first image whose scores differ by more than the verifier's tolerance.
+    :param summary: (optional) GroupSummary instance. If given, it is updated with every written row, and written next to the output file, see utils.group_summary.get_summary_filename. When appending, the existing summary is merged in.
+    :param decoder_name: decoder backend, DECODER_DCT_COEFFICIENT for PyCoefficientDecoder or DECODER_CHROMA for the pure-Python chroma-only decoder, see utils.chroma_decoder
+    :return: data frame containing the results
+    """
+    staged = num_decode_workers is not None or num_score_workers is not None
+    if staged and num_workers is not None:
+        raise ValueError("Worker processes and the staged pipeline cannot be combined")
+    if rois is not None and detector.aggregator is not None:
+        raise ValueError("Statistics are not available for regions of interest")
+    if rois is not None and verifier is not None:
+        raise ValueError("Regions of interest cannot be verified against the reference implementations")
+
+    import pandas as pd
+
+    inputs, num_inputs = iterate_inputs(data_dir, quality=quality, shard=shard)
+
+    writer = get_result_writer(output_csv, output_format=output_format, append=append)
+
+    if deduplicate:
+        # Maps duplicates to the first input with identical content. For files on disk, this is known in advance. For archive members and streams, it is filled while iterating.
+        duplicate_of = find_duplicate_files([img_filename for img_filename, _ in inputs]) if num_inputs is not None else dict()
+        first_by_fingerprint = dict()
+        # Results of the inputs that duplicates are copied from
+        rows_by_filename = dict()
+
+    def find_duplicates():
+        # Adds the name of the first input with identical content to each duplicate
+        for img_filename, data in inputs:
+            original_filename = None
+            if deduplicate:
+                if data is not None:
+                    original_filename = first_by_fingerprint.setdefault(content_fingerprint(data), img_filename)
                 else:
-                    crop_top = 0
-                    crop_left = 0
-
-                # Get quantization tables
-                cb_quantization_table = decoder.get_quantization_table(1).ravel()
-                cr_quantization_table = decoder.get_quantization_table(2).ravel()
-
-                if not np.allclose(cb_quantization_table, cr_quantization_table):
-                    log.warning("Quantization tables for Cb and Cr channels are different for image {}".format(img_filename))
-
-                # Estimate quality factor
-                estimated_quality_factor, estimated_quality_factor_distance = quality_factor_estimator.find_nearest_quality_factor(cb_quantization_table)
-
-                # Dequantize
-                cb_dct_coefs = cb_dct_coefs * cb_quantization_table
-                cr_dct_coefs = cr_dct_coefs * cr_quantization_table
-
-                if use_noise_residual:
-                    cb_dct_coefs = obtain_noise_residual(cb_dct_coefs)
-                    cr_dct_coefs = obtain_noise_residual(cr_dct_coefs)
-
-                # Compute scores of matching against model
-                cb_score = detector.detect_score(cb_dct_coefs)
-                cr_score = detector.detect_score(cr_dct_coefs)
-
-                # Camera make and model
-                metadata = et.get_metadata(img_filename)
-                model = metadata["EXIF:Model"] if "EXIF:Model" in metadata else ""
-                make = metadata["EXIF:Make"] if "EXIF:Make" in metadata else ""
-
-                # Store in buffer
-                buffer.append({
-                    COL_FILENAME: img_filename,
-                    COL_MAX_V_SAMP_FACTOR: max_v_samp_factor,
-                    COL_MAX_H_SAMP_FACTOR: max_h_samp_factor,
-                    COL_CB_V_SAMP_FACTOR: cb_v_samp_factor,
-                    COL_CB_H_SAMP_FACTOR: cb_h_samp_factor,
-                    COL_EXIF_MAKE: make,
-                    COL_EXIF_MODEL: model,
-                    COL_CB_SCORE: cb_score,
-                    COL_CR_SCORE: cr_score,
-                    COL_ESTIMATED_QUALITY_FACTOR: estimated_quality_factor,
-                    COL_ESTIMATED_QUALITY_FACTOR_DISTANCE: estimated_quality_factor_distance,
-                    COL_CROP_TOP: crop_top,
-                    COL_CROP_LEFT: crop_left,
-                })
-
-            except Exception as e:
-                # Skip images that cannot be decoded
-                log.error("Error processing image {}".format(img_filename))
-                log.error(traceback.format_exc())
+                    original_filename = duplicate_of.get(img_filename, img_filename)
+
+                if original_filename == img_filename:
+                    original_filename = None
+
+            yield img_filename, data, original_filename
+
+    score_args = dict(reduce_444_chroma=reduce_444_chroma, crop_top_left_margins=crop_top_left_margins, use_noise_residual=use_noise_residual, rois=rois, roi_context_blocks=roi_context_blocks, verifier=verifier)
+    with contextlib.ExitStack() as stack:
+        if staged:
+            from classification.staged_pipeline import score_inputs_staged, DEFAULT_SLAB_MB
+
+            num_decode_workers = 1 if num_decode_workers is None else num_decode_workers
+            num_score_workers = 1 if num_score_workers is None else num_score_workers
+            # Inputs with content are only read a bounded number of inputs ahead
+            max_pending = None if num_inputs is not None else num_decode_workers * PENDING_INPUTS_PER_WORKER
+            results = score_inputs_staged(find_duplicates(), detector, quality_factor_estimator_filename, num_decode_workers, num_score_workers, num_slabs=num_slabs, slab_mb=DEFAULT_SLAB_MB if slab_mb is None else slab_mb, cost_model=cost_model, max_pending=max_pending, total=num_inputs, decoder_name=decoder_name, **score_args)
+        elif num_workers is None:
+            from tqdm import tqdm
+            import exiftool
+
+            quality_factor_estimator = QualityFactorEstimator(quality_factor_estimator_filename)
+
+            # Use single exiftool instance for all images
+            et = stack.enter_context(exiftool.ExifToolHelper())
+
+            def score_sequentially():
+                for img_filename, data, original_filename in tqdm(find_duplicates(), total=num_inputs):
+                    # Duplicates are not scored
+                    row = score_input(img_filename, data, et, detector, quality_factor_estimator, decoder_name=decoder_name, **score_args) if original_filename is None else None
+                    yield img_filename, row, original_filename
+
+            results = score_sequentially()
+        else:
+            # Inputs with content are only read a bounded number of inputs ahead
+            max_pending = None if num_inputs is not None else num_workers * PENDING_INPUTS_PER_WORKER
+            results = score_inputs_in_parallel(find_duplicates(), num_workers, detector, quality_factor_estimator_filename, cost_model=cost_model, max_pending=max_pending, total=num_inputs, decoder_name=decoder_name, **score_args)
+
+        buffer = []
+        mismatch = None
+        for img_filename, row, original_filename in results:
+            if original_filename is not None:
+                # Copy results instead of scoring the same content again
+                if original_filename not in rows_by_filename:
+                    log.warning("Skipping duplicate {} because its original {} could not be processed".format(img_filename, original_filename))
+                    continue
+                row = dict(rows_by_filename[original_filename], **{COL_FILENAME: img_filename, COL_DUPLICATE_OF: original_filename})
+            elif row is None:
                 continue
+            elif deduplicate:
+                row[COL_DUPLICATE_OF] = ""
+                rows_by_filename[img_filename] = row
+
+            # Store in buffer
+            buffer.append(row)
+            writer.write(row)
+            if summary is not None:
+                summary.update(row)
+
+            if verifier is not None and original_filename is None and not verifier.check(row):
+                mismatch = img_filename
+                break
+
+    writer.close()
+
+    if summary is not None:
+        summary_filename = get_summary_filename(output_csv)
+        if append and os.path.exists(summary_filename):
+            summary.merge(GroupSummary.read(summary_filename))
+        summary.write(summary_filename)
+
+    if verifier is not None:
+        verifier.log_summary()
+        if mismatch is not None:
+            raise VerificationError("Scores of image {} differ from the reference implementations by more than {}".format(mismatch, verifier.tolerance))
 
     # Concatenate results in data frame
-    df = pd.DataFrame(buffer)
-    df.to_csv(output_csv, index=False)
-    return df
+    return pd.DataFrame(buffer)
+
+
+def get_arguments_filename(output_filename):
+    """
+    :param output_filename: path to the main output file
+    :return: path to the file next to it that records the command line arguments
+    """
+    return os.path.splitext(output_filename)[0] + ARGUMENTS_SUFFIX
+
+
+def read_arguments(arguments_filename):
+    """
+    Reads the command line arguments recorded by run
+    :param arguments_filename: path to json file
+    :return: dict of command line arguments as parsed by the argument parser
+    """
+    with open(arguments_filename, "r") as f:
+        args = json.load(f)
+
+    # json stores tuples as lists
+    if args["shard"] is not None:
+        args["shard"] = tuple(args["shard"])
+    if args["roi"] is not None:
+        args["roi"] = [tuple(roi) for roi in args["roi"]]
+    return args
+
+
+def run(args):
+    """
+    Sets up the detector and the optional components from the command line arguments and runs the loop.
+    For a shard, the arguments are recorded next to its output first, see get_arguments_filename, such that merge_shards.py can re-run a failed shard with the same settings.
+    :param args: dict of command line arguments as parsed by the argument parser
+    :return: data frame containing the results
+    """
+    kernels.set_backend(args["kernel_backend"])
+
+    if args["shard"] is not None:
+        with open(get_arguments_filename(args["output_csv"]), "w") as f:
+            json.dump(args, f, indent=2)
+
+    aggregator = ScoreAggregator(num_bins=args["histogram_bins"], quantiles=args["quantiles"], thresholds=args["thresholds"]) if args["statistics"] else None
+    detector = DctTemplateBankDetector(aggregator=aggregator) if args["template_bank"] else DctTemplateMatchingDetector(aggregator=aggregator)
+    verifier = ScoreVerifier(args["verify_fraction"], tolerance=args["verify_tolerance"], seed=args["verify_seed"]) if args["verify_fraction"] is not None else None
+    summary = GroupSummary(num_bins=args["summary_bins"]) if args["summary"] else None
+
+    return loop(data_dir=args["data_dir"],
+                output_csv=args["output_csv"],
+                detector=detector,
+                quality_factor_estimator_filename=args["quality_factor_estimator_filename"],
+                quality=args["quality"],
+                reduce_444_chroma=args["reduce_444_chroma"],
+                crop_top_left_margins=args["crop"],
+                use_noise_residual=args["noise_residual"],
+                shard=args["shard"],
+                output_format=args["format"],
+                append=args["append"],
+                deduplicate=args["deduplicate"],
+                num_workers=args["num_workers"],
+                cost_model=args["cost_model"],
+                num_decode_workers=args["decode_workers"],
+                num_score_workers=args["score_workers"],
+                num_slabs=args["num_slabs"],
+                slab_mb=args["slab_mb"],
+                rois=args["roi"],
+                roi_context_blocks=args["roi_context_blocks"],
+                verifier=verifier,
+                summary=summary,
+                decoder_name=args["decoder"])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("data_dir", type=str, help="Path to data")
-    parser.add_argument("output_csv", type=str, help="Where to put resulting csv file")
+    parser.add_argument("data_dir", type=str, help="Path to data directory, tar or zip archive, or - to read concatenated JPEG files from stdin")
+    parser.add_argument("output_csv", type=str, help="Where to put resulting csv (or Parquet) file")
     parser.add_argument("quality_factor_estimator_filename", type=str, help="Path to state of quality factor estimator as HDF5 file")
 
     parser.add_argument("--quality", type=int, help="Restrict to files with the given quality factor")
     parser.add_argument("--reduce_444_chroma", default=False, action="store_true", help="Whether to downsample full-resolution chroma channels")
-    parser.add_argument("--crop", default=False, action="store_true", help="Whether to crop a random number of pixels from the top and left margins")
+    parser.add_argument("--crop", default=False, action="store_true", help="Whether to crop a number of pixels, derived from a hash of the file content, from the top and left margins")
     parser.add_argument("--noise_residual", default=False, action="store_true", help="Whether to use noise residual")
+    parser.add_argument("--template_bank", default=False, action="store_true", help="Whether to additionally match the bank of templates and output per-template scores")
+    parser.add_argument("--shard", type=parse_shard, help="Only process shard i out of N, given as i/N")
+    parser.add_argument("--format", type=str, choices=FORMATS, help="Output format. By default inferred from the file extension, csv unless .parquet or .pq")
+    parser.add_argument("--append", default=False, action="store_true", help="Append to an existing output file")
+    parser.add_argument("--deduplicate", default=False, action="store_true", help="Score byte-identical files only once and copy their results to the duplicates")
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes. By default, images are processed in the main process.")
+    parser.add_argument("--decode_workers", type=int, help="Number of decoder processes of the staged pipeline, which hands over the coefficients to the scoring processes through shared memory")
+    parser.add_argument("--score_workers", type=int, help="Number of scoring processes of the staged pipeline")
+    parser.add_argument("--num_slabs", type=int, help="Number of shared memory slabs of the staged pipeline, defaults to two per scoring process")
+    parser.add_argument("--slab_mb", type=int, help="Size of each shared memory slab in MB, defaults to 128")
+    parser.add_argument("--cost_model", type=str, choices=COST_MODELS, default=COST_FILE_SIZE, help="With worker processes, estimate the processing time of each image from its file size or from its number of blocks, and process the most expensive images first")
+    parser.add_argument("--statistics", default=False, action="store_true", help="Whether to output further statistics of the per-block scores, computed in a single pass: standard deviation, quantiles, fraction of blocks above thresholds, histogram, and agreement between Cb and Cr")
+    parser.add_argument("--histogram_bins", type=int, default=DEFAULT_NUM_BINS, help="Number of histogram bins over [-1, 1], which also determines the resolution of the quantiles")
+    parser.add_argument("--quantiles", type=float, nargs="+", default=list(DEFAULT_QUANTILES), help="Quantiles in range [0, 1] to estimate from the histogram")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=list(DEFAULT_THRESHOLDS), help="Report the fraction of blocks with scores above each of these thresholds")
+    parser.add_argument("--roi", type=parse_roi, action="append", help="Only score the blocks within and around the region of interest given as left,top,right,bottom in pixels. Can be given multiple times, and adds score and complement score columns per region.")
+    parser.add_argument("--roi_context_blocks", type=int, default=DEFAULT_CONTEXT_BLOCKS, help="Number of blocks around each region of interest whose scores make up its complement score")
+    parser.add_argument("--verify_fraction", type=float, help="Score this random fraction of images a second time with the original reference implementations, and add the reference scores, their differences and the timings of both to the results")
+    parser.add_argument("--verify_tolerance", type=float, default=DEFAULT_TOLERANCE, help="Stop with an error if the scores of any verified image differ from the reference scores by more than this")
+    parser.add_argument("--decoder", type=str, choices=DECODERS, default=DECODER_DCT_COEFFICIENT, help="Decoder backend. dct_coefficient_decoder decodes all components through libjpeg, chroma decodes only the Cb and Cr coefficients of sequential JPEG files in pure Python.")
+    parser.add_argument("--summary", default=False, action="store_true", help="Write the number of images and the count, mean, variance, range and histogram of the Cb and Cr scores per camera make, model and estimated quality factor to a csv file next to the output, e.g., output_summary.csv for output.csv")
+    parser.add_argument("--summary_bins", type=int, default=DEFAULT_SUMMARY_BINS, help="Number of histogram bins of the summary over [-1, 1]")
+    parser.add_argument("--verify_seed", type=int, default=0, help="Changes which images are selected for verification")
+    parser.add_argument("--kernel_backend", type=str, choices=kernels.BACKENDS, default=kernels.BACKEND_NUMPY, help="Implementation of the hot loops. The numba kernels require numba and are compiled on first use.")
     args = vars(parser.parse_args())
 
-    detector = DctTemplateMatchingDetector()
-
-    loop(data_dir=args["data_dir"],
-         output_csv=args["output_csv"],
-         detector=detector,
-         quality_factor_estimator_filename=args["quality_factor_estimator_filename"],
-         quality=args["quality"],
-         reduce_444_chroma=args["reduce_444_chroma"],
-         crop_top_left_margins=args["crop"],
-         use_noise_residual=args["noise_residual"])
+    run(args)
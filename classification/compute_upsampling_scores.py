@@ -0,0 +1,184 @@
+from utils.constants import COL_FILENAME, COL_HEIGHT, COL_WIDTH, COL_CB_SIMPLE_UPSAMPLING_SCORE, COL_CR_SIMPLE_UPSAMPLING_SCORE, COL_SIMPLE_UPSAMPLING
+from utils.upsampling import count_simple_upsampling_matches, SIMPLE_UPSAMPLING_THRESHOLD, DEFAULT_CHUNK_ROWS
+from utils.color_conversion import rgb_to_ycbcr_chunked
+from utils.result_writer import get_result_writer, FORMATS
+from utils.logger import setup_custom_logger
+from utils import kernels
+import numpy as np
+import traceback
+import argparse
+import os
+import re
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Only losslessly stored images keep the chroma samples exactly as the decoder wrote them
+DECODED_FILE_EXTENSIONS = ".(png|ppm|bmp|tif|tiff)$"
+
+# Re-encoding as JPEG changes the copied chroma samples, such that these files are rejected
+JPEG_FILE_EXTENSIONS = ".(jpg|jpeg)$"
+
+
+def find_img_filenames(data_dir):
+    """
+    Recursively finds all losslessly stored decoded images in the given data directory. JPEG files are skipped with a warning.
+    :param data_dir: directory to look for images (recursively)
+    :return: sorted list of paths
+    """
+    filenames = [os.path.join(dp, f) for dp, dn, filenames in os.walk(data_dir) for f in filenames]
+    img_filenames = [filename for filename in filenames if re.search(DECODED_FILE_EXTENSIONS, os.path.basename(filename).lower()) is not None]
+
+    num_jpeg_files = sum(re.search(JPEG_FILE_EXTENSIONS, os.path.basename(filename).lower()) is not None for filename in filenames)
+    if num_jpeg_files > 0:
+        log.warning("Skipping {} JPEG files in {}: lossy compression alters the chroma samples, so simple upsampling can only be detected in losslessly stored images. Decode the JPEG files to png or ppm first, e.g., with djpeg.".format(num_jpeg_files, data_dir))
+
+    return sorted(img_filenames)
+
+
+def simple_upsampling_scores(rgb, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Determines for the Cb and Cr channels of a decoded image whether the values inside each 2x2 block are copies of the top-left block member, see utils.upsampling.has_undergone_simple_upsampling.
+    The image is converted to YCbCr a few rows at a time into a single float32 buffer, and the 2x2 blocks of each chunk are compared right away, such that neither the full YCbCr image nor an array of blocks is built.
+    :param rgb: decoded RGB image of shape [height, width, 3]
+    :param chunk_rows: number of rows to convert and compare at once. Must be even, such that no 2x2 block is split between chunks.
+    :return: Cb and Cr scores in range [0, 1], NaN for images smaller than 2x2 pixels
+    """
+    if chunk_rows < 2 or chunk_rows % 2 != 0:
+        raise ValueError("Number of rows per chunk must be even")
+
+    height, width = rgb.shape[:2]
+    buffer = np.empty((min(chunk_rows, height), width, 3), dtype=np.float32)
+
+    cb_num_matching_values = 0
+    cr_num_matching_values = 0
+    num_blocks = 0
+    for top in range(0, height, chunk_rows):
+        rows = rgb[top:top + chunk_rows]
+        ycbcr = rgb_to_ycbcr_chunked(rows, out=buffer[:len(rows)], chunk_rows=chunk_rows)
+
+        chunk_matching_values, chunk_blocks = count_simple_upsampling_matches(ycbcr[:, :, 1])
+        cb_num_matching_values += chunk_matching_values
+        chunk_matching_values, _ = count_simple_upsampling_matches(ycbcr[:, :, 2])
+        cr_num_matching_values += chunk_matching_values
+        num_blocks += chunk_blocks
+
+    if num_blocks == 0:
+        return np.nan, np.nan
+
+    return cb_num_matching_values / (3 * num_blocks), cr_num_matching_values / (3 * num_blocks)
+
+
+def analyze_image(img_filename, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    :param img_filename: path to decoded image
+    :param chunk_rows: number of rows to convert and compare at once
+    :return: result row, or None if the image could not be read
+    """
+    # We don't want the whole execution being terminated by a single malformed image, thus log exceptions and keep on going with the next image.
+    try:
+        from PIL import Image
+
+        with Image.open(img_filename) as img:
+            if img.mode in ["1", "L", "I", "F"]:
+                log.warning("Image {} has no chroma channels".format(img_filename))
+                return None
+            rgb = np.asarray(img.convert("RGB"))
+
+        cb_score, cr_score = simple_upsampling_scores(rgb, chunk_rows=chunk_rows)
+
+    except Exception:
+        log.error("Error processing image {}".format(img_filename))
+        log.error(traceback.format_exc())
+        return None
+
+    return {
+        COL_FILENAME: img_filename,
+        COL_HEIGHT: rgb.shape[0],
+        COL_WIDTH: rgb.shape[1],
+        COL_CB_SIMPLE_UPSAMPLING_SCORE: cb_score,
+        COL_CR_SIMPLE_UPSAMPLING_SCORE: cr_score,
+        COL_SIMPLE_UPSAMPLING: bool(cb_score > SIMPLE_UPSAMPLING_THRESHOLD and cr_score > SIMPLE_UPSAMPLING_THRESHOLD),
+    }
+
+
+def _analyze_task(args):
+    return analyze_image(*args)
+
+
+class _MainProcess(object):
+    """
+    Stands in for a process pool when processing in the main process
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    @staticmethod
+    def imap(func, iterable, chunksize=1):
+        return map(func, iterable)
+
+
+def loop(data_dir, output_csv, num_workers=None, chunk_rows=DEFAULT_CHUNK_ROWS, output_format=None, append=False):
+    """
+    Determines for all decoded images in the given directory whether their chroma channels have undergone simple upsampling, i.e., whether the decoder copied each chroma sample into a 2x2 block instead of interpolating.
+    :param data_dir: directory to look for decoded images (recursively)
+    :param output_csv: where to store the results. Results are written as csv unless the file extension is .parquet or .pq.
+    :param num_workers: (optional) number of worker processes, defaults to the number of CPUs. With 0, images are processed in the main process.
+    :param chunk_rows: number of rows to convert and compare at once
+    :param output_format: (optional) "csv" or "parquet" to override the format inferred from the output file extension
+    :param append: whether to append to an existing output file
+    :return: number of analyzed images
+    """
+    if chunk_rows < 2 or chunk_rows % 2 != 0:
+        raise ValueError("Number of rows per chunk must be even")
+
+    from tqdm import tqdm
+    import multiprocessing
+
+    img_filenames = find_img_filenames(data_dir)
+    tasks = [(img_filename, chunk_rows) for img_filename in img_filenames]
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    writer = get_result_writer(output_csv, output_format=output_format, append=append)
+
+    num_analyzed = 0
+    with multiprocessing.Pool(num_workers) if num_workers > 0 else _MainProcess() as pool:
+        # Results come back in input order
+        for row in tqdm(pool.imap(_analyze_task, tasks, chunksize=4), total=len(tasks)):
+            if row is None:
+                continue
+
+            writer.write(row)
+            num_analyzed += 1
+
+    writer.close()
+
+    log.info("Analyzed {} out of {} images".format(num_analyzed, len(tasks)))
+    return num_analyzed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", type=str, help="Path to directory of decoded images (png, ppm, bmp, or tif). JPEG files are skipped.")
+    parser.add_argument("output_csv", type=str, help="Where to put resulting csv (or Parquet) file")
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes, defaults to the number of CPUs. 0 processes all images in the main process.")
+    parser.add_argument("--chunk_rows", type=int, default=DEFAULT_CHUNK_ROWS, help="Number of rows to convert and compare at once. Must be even.")
+    parser.add_argument("--format", type=str, choices=FORMATS, help="Output format. By default inferred from the file extension, csv unless .parquet or .pq")
+    parser.add_argument("--append", default=False, action="store_true", help="Append to an existing output file")
+    parser.add_argument("--kernel_backend", type=str, choices=kernels.BACKENDS, default=kernels.BACKEND_NUMPY, help="Implementation of the hot loops. The numba kernels require numba and are compiled on first use.")
+    args = vars(parser.parse_args())
+
+    kernels.set_backend(args["kernel_backend"])
+
+    loop(data_dir=args["data_dir"],
+         output_csv=args["output_csv"],
+         num_workers=args["num_workers"],
+         chunk_rows=args["chunk_rows"],
+         output_format=args["format"],
+         append=args["append"])
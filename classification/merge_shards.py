@@ -0,0 +1,151 @@
+from classification.compute_scores_dct_matching import iterate_inputs, get_input_shard_index, run, read_arguments, get_arguments_filename
+from utils.constants import COL_FILENAME
+from utils.group_summary import GroupSummary, get_summary_filename
+from utils.jpeg_io import STDIN
+from utils.result_writer import read_results, infer_format, FORMAT_PARQUET
+from utils.logger import setup_custom_logger
+import pandas as pd
+import argparse
+import sys
+import os
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+def check_shards(data_dir, shard_csv_template, num_shards, quality=None, strict=False):
+    """
+    Loads the per-shard outputs and checks them against the files each shard is expected to contain.
+    :param data_dir: directory or archive the shards were computed on
+    :param shard_csv_template: path to the per-shard csv or Parquet output files with "{}" as placeholder for the shard index
+    :param num_shards: total number of shards
+    :param quality: (optional) quality restriction the shards were computed with
+    :param strict: whether to consider a shard failed if any of its expected files is missing from the output. Otherwise, missing files are only reported because images that cannot be decoded are skipped by the loop.
+    :return: list of data frames of the successful shards, and list of indices of failed shards, as 2-tuple
+    """
+    # Determine which files belong to which shard
+    expected_filenames = [set() for _ in range(num_shards)]
+    inputs, _ = iterate_inputs(data_dir, quality, read_data=False)
+    for img_filename, _ in inputs:
+        expected_filenames[get_input_shard_index(img_filename, data_dir, num_shards)].add(img_filename)
+
+    dfs = []
+    failed_shards = []
+    for shard_index in range(num_shards):
+        shard_csv = shard_csv_template.format(shard_index)
+        if not os.path.exists(shard_csv):
+            log.error("Shard {}: output {} does not exist".format(shard_index, shard_csv))
+            failed_shards.append(shard_index)
+            continue
+
+        try:
+            df = read_results(shard_csv)
+        except Exception as e:
+            log.error("Shard {}: cannot read {}: {}".format(shard_index, shard_csv, e))
+            failed_shards.append(shard_index)
+            continue
+
+        filenames = set(df[COL_FILENAME])
+        num_duplicates = len(df) - len(filenames)
+        unexpected = filenames - expected_filenames[shard_index]
+        missing = expected_filenames[shard_index] - filenames
+
+        if num_duplicates > 0:
+            log.error("Shard {}: {} duplicate rows".format(shard_index, num_duplicates))
+        if len(unexpected) > 0:
+            log.error("Shard {}: {} rows do not belong to this shard, e.g., {}".format(shard_index, len(unexpected), sorted(unexpected)[0]))
+        if len(missing) > 0:
+            log.warning("Shard {}: {} of {} files missing, e.g., {}".format(shard_index, len(missing), len(expected_filenames[shard_index]), sorted(missing)[0]))
+
+        if num_duplicates > 0 or len(unexpected) > 0 or (strict and len(missing) > 0):
+            failed_shards.append(shard_index)
+            continue
+
+        dfs.append(df)
+
+    return dfs, failed_shards
+
+
+def merge(dfs, output_csv):
+    """
+    Concatenates the per-shard results and sorts them by file name, as the single-node loop would output them.
+    :param dfs: list of data frames
+    :param output_csv: where to store the merged results. Written as Parquet if the file extension is .parquet or .pq, as csv otherwise.
+    :return: merged data frame
+    """
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    df = df.sort_values(COL_FILENAME, kind="stable").reset_index(drop=True)
+    if FORMAT_PARQUET == infer_format(output_csv):
+        df.to_parquet(output_csv, index=False)
+    else:
+        df.to_csv(output_csv, index=False)
+    return df
+
+
+def merge_summaries(shard_csvs, output_csv):
+    """
+    Merges the per-shard summaries written by loop with a GroupSummary into the summary of the merged output
+    :param shard_csvs: paths to the per-shard output files
+    :param output_csv: path to the merged output file
+    :return: merged GroupSummary, or None if the shards have no summaries
+    """
+    summary_filenames = [get_summary_filename(shard_csv) for shard_csv in shard_csvs]
+    missing = [summary_filename for summary_filename in summary_filenames if not os.path.exists(summary_filename)]
+    if len(missing) == len(summary_filenames):
+        return None
+    if len(missing) > 0:
+        # A partial summary would silently disagree with the merged output
+        log.warning("Not merging summaries because {} of {} are missing, e.g., {}".format(len(missing), len(summary_filenames), missing[0]))
+        return None
+
+    summary = GroupSummary.read(summary_filenames[0])
+    for summary_filename in summary_filenames[1:]:
+        summary.merge(GroupSummary.read(summary_filename))
+
+    summary.write(get_summary_filename(output_csv))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", type=str, help="Path to data directory or archive the shards were computed on")
+    parser.add_argument("output_csv", type=str, help="Where to put merged csv (or Parquet) file")
+    parser.add_argument("shard_csv_template", type=str, help="Path to per-shard csv or Parquet files with {} as placeholder for the shard index, e.g., /tmp/output_{}.csv")
+    parser.add_argument("--num_shards", type=int, required=True, help="Total number of shards")
+    parser.add_argument("--quality", type=int, help="Quality restriction the shards were computed with")
+    parser.add_argument("--strict", default=False, action="store_true", help="Consider shards with missing files as failed")
+    parser.add_argument("--rerun_failed", default=False, action="store_true", help="Re-run failed shards before merging, with the arguments recorded next to the shard outputs")
+    args = vars(parser.parse_args())
+
+    if STDIN == args["data_dir"]:
+        raise ValueError("Shards computed on stdin cannot be checked")
+    if "{}" not in args["shard_csv_template"]:
+        raise ValueError("Shard csv template must contain {} as placeholder for the shard index")
+
+    dfs, failed_shards = check_shards(args["data_dir"], args["shard_csv_template"], args["num_shards"], quality=args["quality"], strict=args["strict"])
+
+    if len(failed_shards) > 0 and args["rerun_failed"]:
+        # Each shard records its arguments before it starts. A shard that failed before doing so is re-run with the arguments of another shard.
+        arguments_filenames = [get_arguments_filename(args["shard_csv_template"].format(shard_index)) for shard_index in range(args["num_shards"])]
+        existing_arguments_filenames = [arguments_filename for arguments_filename in arguments_filenames if os.path.exists(arguments_filename)]
+        if len(existing_arguments_filenames) == 0:
+            raise ValueError("Re-running failed shards requires the arguments recorded next to the shard outputs, e.g., {}".format(arguments_filenames[0]))
+
+        for shard_index in failed_shards:
+            arguments_filename = arguments_filenames[shard_index] if os.path.exists(arguments_filenames[shard_index]) else existing_arguments_filenames[0]
+            shard_args = read_arguments(arguments_filename)
+            if shard_args["shard"][1] != args["num_shards"]:
+                raise ValueError("{} was computed with {} shards instead of {}".format(arguments_filename, shard_args["shard"][1], args["num_shards"]))
+
+            shard_args.update(data_dir=args["data_dir"], output_csv=args["shard_csv_template"].format(shard_index), shard=(shard_index, args["num_shards"]), append=False)
+            log.info("Re-running shard {}/{} with the arguments from {}".format(shard_index, args["num_shards"], arguments_filename))
+            run(shard_args)
+
+        dfs, failed_shards = check_shards(args["data_dir"], args["shard_csv_template"], args["num_shards"], quality=args["quality"], strict=args["strict"])
+
+    if len(failed_shards) > 0:
+        log.error("Failed shards: {}. Re-run them with --shard i/{} or pass --rerun_failed.".format(" ".join(map(str, failed_shards)), args["num_shards"]))
+        sys.exit(1)
+
+    merge(dfs, args["output_csv"])
+    merge_summaries([args["shard_csv_template"].format(shard_index) for shard_index in range(args["num_shards"])], args["output_csv"])
@@ -0,0 +1,250 @@
+from utils.constants import COL_FILENAME, COL_ENCODER, COL_QUALITY, COL_SAMPLE, DECODER_DCT_COEFFICIENT
+from classification.compute_scores_dct_matching import score_decoder
+from detectors.dct.dct_template_matching_detector import DctTemplateMatchingDetector
+from data.quality_factor_estimator import QualityFactorEstimator
+from data.create_data import get_encoder
+from utils.chroma_decoder import open_decoder, DECODERS
+from utils.result_writer import get_result_writer, FORMATS
+from utils.logger import setup_custom_logger
+from utils import kernels
+from tqdm import tqdm
+import multiprocessing
+import itertools
+import traceback
+import argparse
+import random
+import queue
+import os
+import re
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Rough ratio of the peak memory of encoding and scoring one variant to the size of its source file
+MEMORY_PER_SOURCE_BYTE = 16
+
+SOURCE_FILE_EXTENSIONS = ".(nef|dng|png|ppm|jpg|jpeg)$"
+
+# State of each worker process, set up by _init_worker
+_worker = dict()
+
+
+def _init_worker(quality_factor_estimator_filename, keep_dir, decoder_name):
+    _worker["detector"] = DctTemplateMatchingDetector()
+    _worker["quality_factor_estimator"] = QualityFactorEstimator(quality_factor_estimator_filename)
+    _worker["encoders"] = dict()
+    _worker["keep_dir"] = keep_dir
+    _worker["decoder_name"] = decoder_name
+
+
+def encode(encoder, source_filename, quality, cjpeg_args):
+    """
+    Encodes the given source image into memory, choosing the encoder method depending on the type of source.
+    :param encoder: Encoder instance
+    :param source_filename: path to raw, png, ppm or jpeg image
+    :param quality: JPEG quality factor
+    :param cjpeg_args: additional command line arguments to cjpeg
+    :return: JPEG file as bytes
+    """
+    ext = os.path.splitext(source_filename)[1].lower()
+    if ext in [".nef", ".dng"]:
+        return encoder.dcraw_cjpeg(source_filename, None, quality, cjpeg_args=cjpeg_args)
+    elif ext == ".png":
+        return encoder.png_cjpeg(source_filename, None, quality, cjpeg_args=cjpeg_args)
+    elif ext == ".ppm":
+        return encoder.cjpeg(source_filename, None, quality, cjpeg_args=cjpeg_args)
+    elif ext in [".jpg", ".jpeg"]:
+        return encoder.djpeg_cjpeg(source_filename, None, quality, cjpeg_args=cjpeg_args)
+
+    raise ValueError("Unknown input format")
+
+
+def draw_variant_settings(rng, crops, keep_fraction):
+    """
+    Draws the random settings of one variant, such that they depend only on the seed and the variant, and not on the worker process that runs it
+    :param rng: random.Random instance seeded for this variant
+    :param crops: list of 2-tuples of pixels to crop from the top and left margins, where None draws random offsets
+    :param keep_fraction: fraction of encoded files to keep on disk
+    :return: whether to keep the encoded file, and list of crop offsets as 2-tuples
+    """
+    keep = keep_fraction > 0 and rng.random() < keep_fraction
+    # Upper bound is inclusive
+    crop_offsets = [(rng.randint(0, 7), rng.randint(0, 7)) if crop is None else crop for crop in crops]
+    return keep, crop_offsets
+
+
+def run_variant(source_filename, encoder_name, quality, sample, crops, reduce_444_chroma, use_noise_residual, keep=False):
+    """
+    Encodes one variant of a source image into memory and scores it once per crop setting.
+    Runs in a worker process.
+    :param crops: list of 2-tuples of pixels to crop from the top and left margins, where (0, 0) disables cropping
+    :param keep: whether to keep the encoded file on disk
+    :return: list of result rows
+    """
+    if encoder_name not in _worker["encoders"]:
+        _worker["encoders"][encoder_name] = get_encoder(encoder_name)
+    encoder = _worker["encoders"][encoder_name]
+
+    cjpeg_args = [] if sample is None else ["-sample", sample]
+    data = encode(encoder, source_filename, quality, cjpeg_args)
+
+    # Optionally keep a sample of the encoded files
+    if keep:
+        sample_suffix = "" if sample is None else "_sample_{}".format(sample)
+        keep_filename = os.path.join(_worker["keep_dir"], encoder_name, os.path.splitext(os.path.basename(source_filename))[0] + "{}_quality_{}.jpg".format(sample_suffix, quality))
+        os.makedirs(os.path.dirname(keep_filename), exist_ok=True)
+        with open(keep_filename, "wb") as f:
+            f.write(data)
+
+    rows = []
+    # The encoded file is passed to the decoder as bytes, see open_decoder
+    with open_decoder(data, _worker["decoder_name"]) as decoder:
+        for crop_offsets in crops:
+            row = score_decoder(decoder, source_filename, _worker["detector"], _worker["quality_factor_estimator"],
+                                reduce_444_chroma=reduce_444_chroma,
+                                crop_top_left_margins=crop_offsets != (0, 0),
+                                use_noise_residual=use_noise_residual,
+                                crop_offsets=crop_offsets)
+            if row is None:
+                continue
+
+            rows.append(dict({
+                COL_FILENAME: source_filename,
+                COL_ENCODER: encoder_name,
+                COL_QUALITY: quality,
+                COL_SAMPLE: "" if sample is None else sample,
+            }, **row))
+
+    return rows
+
+
+def run_experiment(source_filenames, output_filename, quality_factor_estimator_filename, encoder_names, quality_factors, samples=(None,), crops=((0, 0),), reduce_444_chroma=False, use_noise_residual=False, num_workers=None, max_in_flight_mb=1024, keep_fraction=0., keep_dir=None, seed=0, output_format=None, decoder_name=DECODER_DCT_COEFFICIENT):
+    """
+    Runs a grid of (encoder, quality factor, chroma subsampling, crop) settings over the given source images.
+    Each variant is encoded into memory, decoded and scored without writing it to disk. Only the results table is written.
+    :param source_filenames: list of raw, png, ppm or jpeg images
+    :param output_filename: where to store the results
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param encoder_names: list of encoder names as in create_data.py
+    :param quality_factors: list of JPEG quality factors
+    :param samples: list of cjpeg -sample arguments such as "2x2", where None uses the encoder's default
+    :param crops: list of 2-tuples of pixels to crop from the top and left margins, where (0, 0) disables cropping and None draws random offsets
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param num_workers: number of worker processes, defaults to the number of CPUs
+    :param max_in_flight_mb: memory budget in MB. Variants are only submitted while the estimated memory of all variants in flight stays below this budget.
+    :param keep_fraction: fraction of encoded files to keep on disk
+    :param keep_dir: where to keep encoded files
+    :param seed: seed for selecting the encoded files to keep and for drawing random crop offsets. Each variant draws from its own generator, seeded with the seed plus the index of the variant, such that runs are reproducible regardless of the number of workers.
+    :param output_format: (optional) "csv" or "parquet" to override the format inferred from the output file extension
+    :param decoder_name: decoder backend, see utils.chroma_decoder.open_decoder
+    :return: number of result rows written
+    """
+    if keep_fraction > 0 and keep_dir is None:
+        raise ValueError("Keeping encoded files requires a directory")
+
+    tasks = list(itertools.product(source_filenames, encoder_names, quality_factors, samples))
+    max_in_flight_bytes = max_in_flight_mb * 1024 * 1024
+
+    # Worker callbacks report finished tasks through this queue
+    done_queue = queue.Queue()
+    writer = get_result_writer(output_filename, output_format=output_format)
+    num_rows = 0
+
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(quality_factor_estimator_filename, keep_dir, decoder_name)) as pool:
+        in_flight_bytes = 0
+        in_flight = dict()
+
+        def collect():
+            # Wait for the next task to finish
+            task_id, rows, error = done_queue.get()
+            nonlocal in_flight_bytes, num_rows
+            in_flight_bytes -= in_flight.pop(task_id)
+            if error is not None:
+                log.error("Error processing variant {}".format(tasks[task_id]))
+                log.error(error)
+            for row in rows:
+                writer.write(row)
+            num_rows += len(rows)
+            progress.update(1)
+
+        with tqdm(total=len(tasks)) as progress:
+            for task_id, (source_filename, encoder_name, quality, sample) in enumerate(tasks):
+                cost = os.path.getsize(source_filename) * MEMORY_PER_SOURCE_BYTE
+
+                # Bound the memory in flight, but always allow one task to run
+                while len(in_flight) > 0 and in_flight_bytes + cost > max_in_flight_bytes:
+                    collect()
+
+                in_flight[task_id] = cost
+                in_flight_bytes += cost
+                keep, crop_offsets = draw_variant_settings(random.Random(seed + task_id), crops, keep_fraction)
+                pool.apply_async(run_variant,
+                                 (source_filename, encoder_name, quality, sample, crop_offsets, reduce_444_chroma, use_noise_residual, keep),
+                                 callback=lambda rows, task_id=task_id: done_queue.put((task_id, rows, None)),
+                                 error_callback=lambda e, task_id=task_id: done_queue.put((task_id, [], "".join(traceback.format_exception(type(e), e, e.__traceback__)))))
+
+            while len(in_flight) > 0:
+                collect()
+
+    writer.close()
+    return num_rows
+
+
+def parse_crop(crop):
+    """
+    Parses a crop setting of the form "top,left", or "random"
+    :param crop: string like "3,5"
+    :return: 2-tuple of top and left offsets, or None for random offsets
+    """
+    if "random" == crop:
+        return None
+
+    match = re.match("^([0-7]),([0-7])$", crop)
+    if match is None:
+        raise argparse.ArgumentTypeError("Expected crop as top,left with offsets in range [0, 7], or random")
+    return int(match.group(1)), int(match.group(2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir", type=str, help="Path to directory of source images (raw, png, ppm or jpeg)")
+    parser.add_argument("output_csv", type=str, help="Where to put resulting csv (or Parquet) file")
+    parser.add_argument("quality_factor_estimator_filename", type=str, help="Path to state of quality factor estimator as HDF5 file")
+    parser.add_argument("--encoders", nargs="+", type=str, help="Encoders to use", required=True)
+    parser.add_argument("--quality_factors", nargs="+", type=int, help="JPEG encoding quality factors", required=True)
+    parser.add_argument("--samples", nargs="+", type=str, help="HxV chroma subsampling settings. If not given, uses each encoder's default")
+    parser.add_argument("--crops", nargs="+", type=parse_crop, default=[(0, 0)], help="Crop settings as top,left pixel offsets, or random")
+    parser.add_argument("--reduce_444_chroma", default=False, action="store_true", help="Whether to downsample full-resolution chroma channels")
+    parser.add_argument("--noise_residual", default=False, action="store_true", help="Whether to use noise residual")
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--max_in_flight_mb", type=int, default=1024, help="Memory budget in MB for variants in flight")
+    parser.add_argument("--keep_fraction", type=float, default=0., help="Fraction of encoded files to keep")
+    parser.add_argument("--keep_dir", type=str, help="Where to keep encoded files")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for selecting the encoded files to keep and for drawing random crop offsets")
+    parser.add_argument("--format", type=str, choices=FORMATS, help="Output format. By default inferred from the file extension, csv unless .parquet or .pq")
+    parser.add_argument("--decoder", type=str, choices=DECODERS, default=DECODER_DCT_COEFFICIENT, help="Decoder backend. dct_coefficient_decoder decodes all components through libjpeg, chroma decodes only the Cb and Cr coefficients of sequential JPEG files in pure Python.")
+    parser.add_argument("--kernel_backend", type=str, choices=kernels.BACKENDS, default=kernels.BACKEND_NUMPY, help="Implementation of the hot loops. The numba kernels require numba and are compiled on first use.")
+    args = vars(parser.parse_args())
+
+    kernels.set_backend(args["kernel_backend"])
+
+    source_filenames = sorted([os.path.join(dp, f) for dp, dn, filenames in os.walk(args["input_dir"]) for f in filenames if re.search(SOURCE_FILE_EXTENSIONS, f.lower()) is not None])
+
+    run_experiment(source_filenames=source_filenames,
+                   output_filename=args["output_csv"],
+                   quality_factor_estimator_filename=args["quality_factor_estimator_filename"],
+                   encoder_names=args["encoders"],
+                   quality_factors=args["quality_factors"],
+                   samples=args["samples"] if args["samples"] is not None else [None],
+                   crops=args["crops"],
+                   reduce_444_chroma=args["reduce_444_chroma"],
+                   use_noise_residual=args["noise_residual"],
+                   num_workers=args["num_workers"],
+                   max_in_flight_mb=args["max_in_flight_mb"],
+                   keep_fraction=args["keep_fraction"],
+                   keep_dir=args["keep_dir"],
+                   seed=args["seed"],
+                   output_format=args["format"],
+                   decoder_name=args["decoder"])
@@ -0,0 +1,186 @@
+from classification.compute_scores_dct_matching import score_decoder, get_crop_offsets, complete_row
+from detectors.dct.dct_template_matching_detector import DctTemplateMatchingDetector
+from detectors.dct.dct_template_bank_detector import DctTemplateBankDetector
+from data.quality_factor_estimator import QualityFactorEstimator
+from utils.constants import COL_FILENAME, COL_FRAME, COL_CB_SCORE, COL_CR_SCORE, COL_CB_RUNNING_MEAN, COL_CR_RUNNING_MEAN, COL_CB_RUNNING_STD, COL_CR_RUNNING_STD, DECODER_DCT_COEFFICIENT
+from utils.chroma_decoder import open_decoder, DECODERS
+from utils.jpeg_io import split_jpeg_stream, insert_default_huffman_tables, read_exif_make_and_model, ARCHIVE_SEPARATOR, STDIN, TMP_DIR
+from utils.result_writer import get_result_writer, FORMATS
+from utils.logger import setup_custom_logger
+from utils import kernels
+import numpy as np
+import traceback
+import argparse
+import tempfile
+import sys
+import os
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+class RunningStatistics(object):
+    def __init__(self):
+        """
+        Mean and standard deviation of a sequence of values, updated one value at a time with Welford's algorithm
+        """
+        self._count = 0
+        self._mean = 0.
+        self._sum_squared_differences = 0.
+
+    def update(self, value):
+        self._count += 1
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._sum_squared_differences += delta * (value - self._mean)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._mean if self._count > 0 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self._sum_squared_differences / self._count) if self._count > 0 else np.nan
+
+
+def iterate_frames(video_filename):
+    """
+    Walks the JPEG frames of a Motion-JPEG video in memory. Container structures such as AVI or QuickTime headers are skipped.
+    :param video_filename: path to AVI or MOV file, or to a file of concatenated JPEG frames, or "-" to read the frames from stdin
+    :return: generator of JPEG frames as bytes
+    """
+    if STDIN == video_filename:
+        yield from split_jpeg_stream(sys.stdin.buffer)
+        return
+
+    with open(video_filename, "rb") as f:
+        yield from split_jpeg_stream(f)
+
+
+def score_stream(video_filename, detector, quality_factor_estimator, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, decoder_name=DECODER_DCT_COEFFICIENT):
+    """
+    Scores the frames of a Motion-JPEG video one after another.
+    State that frames of a stream share is set up once: the quality factor estimator caches the estimate of each distinct quantization table, camera make and model are read from the Exif segment of the first frame only, and PyCoefficientDecoder decodes all frames from the same memory-backed temporary file. ChromaCoefficientDecoder decodes the frames in memory.
+    :param video_filename: path to video file, or "-" for stdin
+    :param detector: detector instance
+    :param quality_factor_estimator: quality factor estimator instance
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_top_left_margins: Whether to crop a number of pixels, derived from the file content, from top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param decoder_name: decoder backend, see utils.chroma_decoder.open_decoder
+    :return: generator of result rows per frame, which include the frame index and the running mean and standard deviation of the scores over all frames so far
+    """
+    # PyCoefficientDecoder only accepts paths
+    decode_from_file = DECODER_DCT_COEFFICIENT == decoder_name
+
+    cb_statistics = RunningStatistics()
+    cr_statistics = RunningStatistics()
+    make_and_model = None
+
+    with tempfile.NamedTemporaryFile(suffix=".jpg", dir=TMP_DIR) as f:
+        for frame_index, frame in enumerate(iterate_frames(video_filename)):
+            frame_name = "{}{}{:08d}.jpg".format("stdin" if STDIN == video_filename else video_filename, ARCHIVE_SEPARATOR, frame_index)
+
+            # We don't want the whole stream being aborted by a single corrupt frame, thus log exceptions and keep on going with the next frame.
+            try:
+                # Frames without Huffman tables rely on the tables of the JPEG standard
+                frame = insert_default_huffman_tables(frame)
+
+                if decode_from_file:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(frame)
+                    f.flush()
+
+                if make_and_model is None:
+                    make_and_model = read_exif_make_and_model(frame)
+
+                with open_decoder(f.name if decode_from_file else frame, decoder_name) as decoder:
+                    row = score_decoder(decoder, frame_name, detector, quality_factor_estimator, reduce_444_chroma=reduce_444_chroma, crop_top_left_margins=crop_top_left_margins, use_noise_residual=use_noise_residual, crop_offsets=get_crop_offsets(frame) if crop_top_left_margins else None)
+                if row is None:
+                    continue
+
+            except Exception:
+                log.error("Error processing frame {}".format(frame_name))
+                log.error(traceback.format_exc())
+                continue
+
+            cb_statistics.update(row[COL_CB_SCORE])
+            cr_statistics.update(row[COL_CR_SCORE])
+
+            row = complete_row(row, *make_and_model)
+            row[COL_FILENAME] = frame_name
+            row[COL_FRAME] = frame_index
+            row[COL_CB_RUNNING_MEAN] = cb_statistics.mean
+            row[COL_CR_RUNNING_MEAN] = cr_statistics.mean
+            row[COL_CB_RUNNING_STD] = cb_statistics.std
+            row[COL_CR_RUNNING_STD] = cr_statistics.std
+            yield row
+
+
+def loop(video_filename, output_csv, detector, quality_factor_estimator_filename, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, output_format=None, append=False, decoder_name=DECODER_DCT_COEFFICIENT):
+    """
+    Computes the detection scores of all frames of a Motion-JPEG video
+    :param video_filename: path to AVI or MOV file, or to a file of concatenated JPEG frames, or "-" to read the frames from stdin
+    :param output_csv: where to store the results. Results are written as csv unless the file extension is .parquet or .pq.
+    :param detector: detector instance
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_top_left_margins: Whether to crop a number of pixels, derived from the file content, from top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param output_format: (optional) "csv" or "parquet" to override the format inferred from the output file extension
+    :param append: whether to append to an existing output file
+    :param decoder_name: decoder backend, see utils.chroma_decoder.open_decoder
+    :return: number of scored frames
+    """
+    quality_factor_estimator = QualityFactorEstimator(quality_factor_estimator_filename)
+    writer = get_result_writer(output_csv, output_format=output_format, append=append)
+
+    num_frames = 0
+    row = None
+    for row in score_stream(video_filename, detector, quality_factor_estimator, reduce_444_chroma=reduce_444_chroma, crop_top_left_margins=crop_top_left_margins, use_noise_residual=use_noise_residual, decoder_name=decoder_name):
+        writer.write(row)
+        num_frames += 1
+
+    writer.close()
+
+    if row is not None:
+        log.info("Scored {} frames, Cb score {:.4f} +- {:.4f}, Cr score {:.4f} +- {:.4f}".format(num_frames, row[COL_CB_RUNNING_MEAN], row[COL_CB_RUNNING_STD], row[COL_CR_RUNNING_MEAN], row[COL_CR_RUNNING_STD]))
+    else:
+        log.warning("No frames found in {}".format(video_filename))
+
+    return num_frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video_filename", type=str, help="Path to Motion-JPEG video (AVI, MOV, or concatenated JPEG frames), or - to read the frames from stdin")
+    parser.add_argument("output_csv", type=str, help="Where to put resulting csv (or Parquet) file")
+    parser.add_argument("quality_factor_estimator_filename", type=str, help="Path to state of quality factor estimator as HDF5 file")
+
+    parser.add_argument("--reduce_444_chroma", default=False, action="store_true", help="Whether to downsample full-resolution chroma channels")
+    parser.add_argument("--crop", default=False, action="store_true", help="Whether to crop a number of pixels, derived from a hash of the file content, from the top and left margins")
+    parser.add_argument("--noise_residual", default=False, action="store_true", help="Whether to use noise residual")
+    parser.add_argument("--template_bank", default=False, action="store_true", help="Whether to additionally match the bank of templates and output per-template scores")
+    parser.add_argument("--format", type=str, choices=FORMATS, help="Output format. By default inferred from the file extension, csv unless .parquet or .pq")
+    parser.add_argument("--append", default=False, action="store_true", help="Append to an existing output file")
+    parser.add_argument("--decoder", type=str, choices=DECODERS, default=DECODER_DCT_COEFFICIENT, help="Decoder backend. dct_coefficient_decoder decodes all components through libjpeg, chroma decodes only the Cb and Cr coefficients of sequential JPEG files in pure Python.")
+    parser.add_argument("--kernel_backend", type=str, choices=kernels.BACKENDS, default=kernels.BACKEND_NUMPY, help="Implementation of the hot loops. The numba kernels require numba and are compiled on first use.")
+    args = vars(parser.parse_args())
+
+    kernels.set_backend(args["kernel_backend"])
+
+    loop(video_filename=args["video_filename"],
+         output_csv=args["output_csv"],
+         detector=DctTemplateBankDetector() if args["template_bank"] else DctTemplateMatchingDetector(),
+         quality_factor_estimator_filename=args["quality_factor_estimator_filename"],
+         reduce_444_chroma=args["reduce_444_chroma"],
+         crop_top_left_margins=args["crop"],
+         use_noise_residual=args["noise_residual"],
+         output_format=args["format"],
+         append=args["append"],
+         decoder_name=args["decoder"])
@@ -0,0 +1,336 @@
+from classification.compute_scores_dct_matching import score_image, get_make_and_model, complete_row
+from utils.constants import COL_FILENAME, DECODER_DCT_COEFFICIENT
+from detectors.dct.dct_template_matching_detector import DctTemplateMatchingDetector
+from detectors.dct.dct_template_bank_detector import DctTemplateBankDetector
+from data.quality_factor_estimator import QualityFactorEstimator
+from utils.jpeg_io import read_exif_make_and_model
+from utils.chroma_decoder import DECODERS
+from utils.logger import setup_custom_logger
+from utils import kernels
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import collections
+import socketserver
+import threading
+import traceback
+import argparse
+import exiftool
+import queue
+import json
+import time
+import csv
+import io
+import os
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Number of most recent requests to compute latency statistics over
+LATENCY_WINDOW = 1000
+
+
+class ScoringRequest(object):
+    def __init__(self, img_filename=None, data=None, name=None):
+        """
+        A single request to score either a file on disk or the raw bytes of a JPEG file
+        :param img_filename: path to jpg file
+        :param data: JPEG file content as bytes
+        :param name: name to report in the filename column for raw bytes
+        """
+        self.img_filename = img_filename
+        self.data = data
+        self.name = name if name is not None else img_filename
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class ScoringService(object):
+    def __init__(self, detector, quality_factor_estimator, reduce_444_chroma=False, crop_top_left_margins=False, use_noise_residual=False, max_batch_size=16, batch_timeout=0.005, decoder_name=DECODER_DCT_COEFFICIENT):
+        """
+        Keeps the detector, the quality factor estimator and an exiftool instance warm and scores incoming requests in batches on a background thread.
+        :param detector: detector instance
+        :param quality_factor_estimator: quality factor estimator instance
+        :param reduce_444_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+        :param crop_top_left_margins: Whether to crop a number of pixels, derived from the file content, from top and left margins
+        :param use_noise_residual: whether to use noise residual instead of image
+        :param max_batch_size: maximum number of requests to process together
+        :param batch_timeout: how long to wait (in seconds) for further requests to join a batch
+        :param decoder_name: decoder backend, see utils.chroma_decoder.open_decoder
+        """
+        self._detector = detector
+        self._quality_factor_estimator = quality_factor_estimator
+        self._reduce_444_chroma = reduce_444_chroma
+        self._crop_top_left_margins = crop_top_left_margins
+        self._use_noise_residual = use_noise_residual
+        self._max_batch_size = max_batch_size
+        self._batch_timeout = batch_timeout
+        self._decoder_name = decoder_name
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._et = None
+
+        # Statistics
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._num_processed = 0
+        self._num_failed = 0
+        self._num_batches = 0
+        self._max_queue_depth = 0
+        self._started = time.monotonic()
+
+    def start(self):
+        # Use single exiftool instance for all requests
+        self._et = exiftool.ExifToolHelper()
+        self._et.run()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Sentinel tells the worker thread to finish
+        self._queue.put(None)
+        self._thread.join()
+        self._et.terminate()
+
+    def submit(self, request):
+        """
+        Enqueues a scoring request
+        :param request: ScoringRequest
+        :return: future that resolves to the result row, or to None if the image failed the sanity check
+        """
+        self._queue.put(request)
+        with self._stats_lock:
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return request.future
+
+    def stats(self):
+        """
+        :return: dict of latency (in milliseconds) and queue-depth statistics
+        """
+        with self._stats_lock:
+            latencies = np.array(self._latencies) * 1000.
+            return {
+                "uptime_seconds": time.monotonic() - self._started,
+                "num_processed": self._num_processed,
+                "num_failed": self._num_failed,
+                "num_batches": self._num_batches,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth,
+                "latency_ms_mean": float(np.mean(latencies)) if len(latencies) > 0 else None,
+                "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+                "latency_ms_p95": float(np.percentile(latencies, 95)) if len(latencies) > 0 else None,
+                "latency_ms_max": float(np.max(latencies)) if len(latencies) > 0 else None,
+            }
+
+    def _next_batch(self):
+        # Block until the first request arrives
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+
+        # Collect further requests that arrive within the batch timeout
+        deadline = time.monotonic() + self._batch_timeout
+        while len(batch) < self._max_batch_size:
+            try:
+                request = self._queue.get(timeout=max(0., deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                # Put sentinel back so that the worker stops after this batch
+                self._queue.put(None)
+                break
+            batch.append(request)
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            self._process_batch(batch)
+
+    def _get_metadata(self, img_filename):
+        try:
+            return self._et.get_metadata(img_filename)[0]
+        except Exception:
+            return {}
+
+    def _process_batch(self, batch):
+        # exiftool only accepts paths, thus retrieve metadata for all requests with files on disk with a single exiftool call. The Exif segment of requests with raw bytes is parsed in memory.
+        img_filenames = [request.img_filename for request in batch if request.data is None]
+        metadata = []
+        if len(img_filenames) > 0:
+            try:
+                metadata = self._et.get_metadata(img_filenames)
+            except Exception:
+                # A single unreadable file fails the whole call, thus fall back to one call per file
+                metadata = [self._get_metadata(img_filename) for img_filename in img_filenames]
+        metadata = iter(metadata)
+
+        for request in batch:
+            try:
+                make, model = get_make_and_model(next(metadata)) if request.data is None else read_exif_make_and_model(request.data)
+                # Raw bytes are passed to the decoder directly, see open_decoder
+                row = score_image(request.img_filename if request.data is None else request.name, self._detector, self._quality_factor_estimator, reduce_444_chroma=self._reduce_444_chroma, crop_top_left_margins=self._crop_top_left_margins, use_noise_residual=self._use_noise_residual, decoder_name=self._decoder_name, data=request.data)
+                if row is not None:
+                    row = complete_row(row, make, model)
+                    row[COL_FILENAME] = request.name
+                request.future.set_result(row)
+                failed = row is None
+
+            except Exception as e:
+                log.error("Error processing image {}".format(request.name))
+                log.error(traceback.format_exc())
+                request.future.set_exception(e)
+                failed = True
+
+            with self._stats_lock:
+                self._latencies.append(time.monotonic() - request.enqueued)
+                self._num_processed += 1
+                self._num_failed += int(failed)
+
+        with self._stats_lock:
+            self._num_batches += 1
+
+
+def row_to_csv(row):
+    """
+    Formats a result row like the output of compute_scores_dct_matching.py
+    :param row: dict of result columns
+    :return: header line and row line as string
+    """
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames=list(row.keys()), lineterminator="\n")
+    writer.writeheader()
+    writer.writerow(row)
+    return f.getvalue()
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /stats returns latency and queue-depth statistics.
+    POST /score scores a single image. The body is either a JSON object {"filename": "/path/to/img.jpg"} (with content type application/json), or the raw bytes of a JPEG file. For raw bytes, the query parameter name sets the filename column.
+    Append ?format=csv to receive a csv header and row instead of JSON.
+    """
+    # Set by serve()
+    service = None
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send(self, status, body, content_type="application/json"):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, obj):
+        # Numpy scalars are not serializable by default
+        self._send(status, json.dumps(obj, default=lambda x: x.item()))
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/stats":
+            return self._send_json(404, {"error": "Not found"})
+
+        self._send_json(200, self.service.stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path != "/score":
+            return self._send_json(404, {"error": "Not found"})
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                img_filename = json.loads(body)["filename"]
+            except (ValueError, KeyError):
+                return self._send_json(400, {"error": "Expected JSON object with key filename"})
+            request = ScoringRequest(img_filename=img_filename)
+        else:
+            request = ScoringRequest(data=body, name=query.get("name", [""])[0])
+
+        try:
+            row = self.service.submit(request).result()
+        except Exception as e:
+            return self._send_json(500, {"error": str(e)})
+
+        if row is None:
+            return self._send_json(422, {"error": "Sanity check failed"})
+
+        if query.get("format", ["json"])[0] == "csv":
+            return self._send(200, row_to_csv(row), content_type="text/csv")
+        self._send_json(200, row)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8000, unix_socket=None):
+    """
+    Serves the scoring API until interrupted
+    :param service: started ScoringService
+    :param host: host to bind to
+    :param port: TCP port to listen on
+    :param unix_socket: if given, listen on this Unix socket path instead of TCP
+    """
+    ScoringRequestHandler.service = service
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, ScoringRequestHandler)
+        log.info("Listening on {}".format(unix_socket))
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+        log.info("Listening on {}:{}".format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("quality_factor_estimator_filename", type=str, help="Path to state of quality factor estimator as HDF5 file")
+
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="TCP port to listen on")
+    parser.add_argument("--unix_socket", type=str, help="Listen on the given Unix socket path instead of TCP")
+    parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum number of requests to process together")
+    parser.add_argument("--batch_timeout", type=float, default=0.005, help="Seconds to wait for further requests to join a batch")
+    parser.add_argument("--reduce_444_chroma", default=False, action="store_true", help="Whether to downsample full-resolution chroma channels")
+    parser.add_argument("--crop", default=False, action="store_true", help="Whether to crop a number of pixels, derived from a hash of the file content, from the top and left margins")
+    parser.add_argument("--noise_residual", default=False, action="store_true", help="Whether to use noise residual")
+    parser.add_argument("--template_bank", default=False, action="store_true", help="Whether to additionally match the bank of templates and output per-template scores")
+    parser.add_argument("--decoder", type=str, choices=DECODERS, default=DECODER_DCT_COEFFICIENT, help="Decoder backend. dct_coefficient_decoder decodes all components through libjpeg, chroma decodes only the Cb and Cr coefficients of sequential JPEG files in pure Python.")
+    parser.add_argument("--kernel_backend", type=str, choices=kernels.BACKENDS, default=kernels.BACKEND_NUMPY, help="Implementation of the hot loops. The numba kernels require numba and are compiled on first use.")
+    args = vars(parser.parse_args())
+
+    kernels.set_backend(args["kernel_backend"])
+
+    service = ScoringService(detector=DctTemplateBankDetector() if args["template_bank"] else DctTemplateMatchingDetector(),
+                             quality_factor_estimator=QualityFactorEstimator(args["quality_factor_estimator_filename"]),
+                             reduce_444_chroma=args["reduce_444_chroma"],
+                             crop_top_left_margins=args["crop"],
+                             use_noise_residual=args["noise_residual"],
+                             max_batch_size=args["max_batch_size"],
+                             batch_timeout=args["batch_timeout"],
+                             decoder_name=args["decoder"])
+    service.start()
+
+    try:
+        serve(service, host=args["host"], port=args["port"], unix_socket=args["unix_socket"])
+    finally:
+        service.stop()
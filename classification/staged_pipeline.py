@@ -0,0 +1,227 @@
+from classification.compute_scores_dct_matching import score_decoder, get_make_and_model, get_crop_offsets, complete_row, dispatch_longest_first
+from data.quality_factor_estimator import QualityFactorEstimator
+from utils.constants import COL_FILENAME, DECODER_DCT_COEFFICIENT
+from utils.chroma_decoder import open_decoder
+from utils.scheduling import COST_FILE_SIZE
+from utils.slab_pool import SlabPool
+from utils.jpeg_io import read_exif_make_and_model
+from utils.logger import setup_custom_logger
+import multiprocessing
+import traceback
+import queue
+import os
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Default size of each shared memory slab. Holds the Cb and Cr coefficients of 4:2:0 images of up to about 260 megapixels.
+DEFAULT_SLAB_MB = 128
+
+# Seconds to wait for a result before checking whether all stage processes are still alive
+LIVENESS_CHECK_INTERVAL = 1.
+
+
+class ChromaCoefficients(object):
+    def __init__(self, header, cb_dct_coefs, cr_dct_coefs):
+        """
+        Provides the part of the PyCoefficientDecoder interface that score_decoder uses, backed by the chroma coefficients decoded in another process.
+        :param header: dict of block counts, sampling factors and quantization tables, as returned by read_header
+        :param cb_dct_coefs: flat Cb coefficients as returned by the decoder
+        :param cr_dct_coefs: flat Cr coefficients as returned by the decoder
+        """
+        self._header = header
+        self._dct_coefs = {1: cb_dct_coefs, 2: cr_dct_coefs}
+
+    @staticmethod
+    def read_header(decoder):
+        """
+        :param decoder: PyCoefficientDecoder or ChromaCoefficientDecoder instance
+        :return: dict of everything besides the chroma coefficients that score_decoder reads from the decoder
+        """
+        return {
+            "height_in_blocks": [decoder.get_height_in_blocks(c) for c in range(3)],
+            "width_in_blocks": [decoder.get_width_in_blocks(c) for c in range(3)],
+            "v_samp_factor": [decoder.v_samp_factor(c) for c in range(3)],
+            "h_samp_factor": [decoder.h_samp_factor(c) for c in range(3)],
+            "max_v_samp_factor": decoder.max_v_samp_factor,
+            "max_h_samp_factor": decoder.max_h_samp_factor,
+            "quantization_tables": {c: decoder.get_quantization_table(c) for c in [1, 2]},
+        }
+
+    @property
+    def max_v_samp_factor(self):
+        return self._header["max_v_samp_factor"]
+
+    @property
+    def max_h_samp_factor(self):
+        return self._header["max_h_samp_factor"]
+
+    def v_samp_factor(self, c):
+        return self._header["v_samp_factor"][c]
+
+    def h_samp_factor(self, c):
+        return self._header["h_samp_factor"][c]
+
+    def get_height_in_blocks(self, c):
+        return self._header["height_in_blocks"][c]
+
+    def get_width_in_blocks(self, c):
+        return self._header["width_in_blocks"][c]
+
+    def get_dct_coefficients(self, c):
+        return self._dct_coefs[c]
+
+    def get_quantization_table(self, c):
+        return self._header["quantization_tables"][c]
+
+
+def _decode_stage(slab_pool, decoder_name, crop_top_left_margins, decode_queue, score_queue, result_queue):
+    """
+    Decodes images and hands their chroma coefficients to the scoring stage through the slab pool, together with the crop offsets derived from the file content.
+    Blocks while all slabs are in use.
+    """
+    import exiftool
+
+    with exiftool.ExifToolHelper() as et:
+        while True:
+            task = decode_queue.get()
+            if task is None:
+                return
+
+            index, img_filename, data = task
+            try:
+                # Archive members and streamed images are passed to the decoder as bytes, see open_decoder
+                with open_decoder(img_filename if data is None else data, decoder_name) as decoder:
+                    header = ChromaCoefficients.read_header(decoder)
+                    arrays = [decoder.get_dct_coefficients(1), decoder.get_dct_coefficients(2)]
+
+                # Camera make and model. exiftool only accepts paths, thus the Exif segment of images given as bytes is parsed in memory.
+                if data is None:
+                    metadata = et.get_metadata(img_filename)
+                    if isinstance(metadata, list):
+                        metadata = metadata[0]
+                    make, model = get_make_and_model(metadata)
+                else:
+                    make, model = read_exif_make_and_model(data)
+
+                # Crop offsets depend on the file content, which only the decoder processes have
+                crop_offsets = get_crop_offsets(img_filename if data is None else data) if crop_top_left_margins else None
+
+            except Exception:
+                # Skip images that cannot be decoded
+                log.error("Error processing image {}".format(img_filename))
+                log.error(traceback.format_exc())
+                result_queue.put((index, None))
+                continue
+
+            if slab_pool.fits(arrays):
+                slab_index = slab_pool.acquire()
+                layout = slab_pool.write_arrays(slab_index, arrays)
+                score_queue.put((index, img_filename, header, make, model, crop_offsets, slab_index, layout))
+            else:
+                log.warning("Coefficients of image {} exceed the slab size, passing them through a pipe instead".format(img_filename))
+                score_queue.put((index, img_filename, header, make, model, crop_offsets, None, arrays))
+
+
+def _score_stage(slab_pool, detector, quality_factor_estimator_filename, score_args, score_queue, result_queue):
+    """
+    Scores the chroma coefficients in place and returns each slab to the pool afterwards
+    """
+    quality_factor_estimator = QualityFactorEstimator(quality_factor_estimator_filename)
+
+    while True:
+        task = score_queue.get()
+        if task is None:
+            return
+
+        index, img_filename, header, make, model, crop_offsets, slab_index, arrays = task
+        try:
+            if slab_index is not None:
+                arrays = slab_pool.read_arrays(slab_index, arrays)
+
+            row = score_decoder(ChromaCoefficients(header, *arrays), img_filename, detector, quality_factor_estimator, crop_offsets=crop_offsets, **score_args)
+            if row is not None:
+                row = complete_row(row, make, model)
+                row[COL_FILENAME] = img_filename
+
+        except Exception:
+            log.error("Error processing image {}".format(img_filename))
+            log.error(traceback.format_exc())
+            row = None
+
+        finally:
+            # Drop the views before the slab is overwritten by the next image
+            arrays = None
+            if slab_index is not None:
+                slab_pool.release(slab_index)
+
+        result_queue.put((index, row))
+
+
+def score_inputs_staged(inputs, detector, quality_factor_estimator_filename, num_decode_workers, num_score_workers, num_slabs=None, slab_mb=DEFAULT_SLAB_MB, cost_model=COST_FILE_SIZE, max_pending=None, total=None, decoder_name=DECODER_DCT_COEFFICIENT, **score_args):
+    """
+    Scores inputs in a two-stage pipeline. Decoder processes write the Cb and Cr coefficients into shared memory slabs, from which scoring processes read them without copying.
+    Both stages can be sized independently, and recycling a fixed number of slabs bounds the memory of decoded images in flight.
+    Inputs are dispatched longest-processing-time first, and results are yielded in input order.
+    :param inputs: iterable of 3-tuples of input name, JPEG file content as bytes or None, and name of the input this is a duplicate of or None. Duplicates are not scored.
+    :param detector: detector instance
+    :param quality_factor_estimator_filename: persistent state of quality factor estimator
+    :param num_decode_workers: number of decoder processes
+    :param num_score_workers: number of scoring processes
+    :param num_slabs: (optional) number of shared memory slabs. Defaults to two per scoring process, such that each scoring process has the next image ready when it finishes the current one.
+    :param slab_mb: size of each slab in MB. Images whose coefficients do not fit are passed through a pipe instead.
+    :param cost_model: how to estimate the processing time of an image, see utils.scheduling
+    :param max_pending: (optional) maximum number of inputs to read ahead, see dispatch_longest_first
+    :param total: (optional) number of inputs for the progress bar
+    :param decoder_name: decoder backend of the decoder processes, see utils.chroma_decoder.open_decoder
+    :param score_args: further arguments to score_decoder
+    :return: generator of 3-tuples of input name, result row or None, and name of the input this is a duplicate of or None, in input order
+    """
+    from tqdm import tqdm
+
+    if num_slabs is None:
+        num_slabs = 2 * num_score_workers
+
+    slab_pool = SlabPool(num_slabs, slab_mb * 1024 * 1024)
+    decode_queue = multiprocessing.Queue()
+    score_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+
+    decode_workers = [multiprocessing.Process(target=_decode_stage, args=(slab_pool, decoder_name, score_args.get("crop_top_left_margins", False), decode_queue, score_queue, result_queue), daemon=True) for _ in range(num_decode_workers)]
+    score_workers = [multiprocessing.Process(target=_score_stage, args=(slab_pool, detector, quality_factor_estimator_filename, score_args, score_queue, result_queue), daemon=True) for _ in range(num_score_workers)]
+    for worker in decode_workers + score_workers:
+        worker.start()
+
+    def submit(index, img_filename, data):
+        decode_queue.put((index, img_filename, data))
+
+    def wait():
+        while True:
+            try:
+                return result_queue.get(timeout=LIVENESS_CHECK_INTERVAL)
+            except queue.Empty:
+                # A crashed process would otherwise leave us waiting forever
+                if not all(worker.is_alive() for worker in decode_workers + score_workers):
+                    raise RuntimeError("A pipeline process died unexpectedly")
+
+    try:
+        with tqdm(total=total) as progress:
+            # Images waiting for a decoder and images holding a slab count as in flight
+            yield from dispatch_longest_first(inputs, submit, wait, max_in_flight=2 * num_decode_workers + num_slabs, cost_model=cost_model, max_pending=max_pending, progress=progress)
+
+        # Stop the decoders first, such that no more images arrive at the scoring stage
+        for _ in decode_workers:
+            decode_queue.put(None)
+        for worker in decode_workers:
+            worker.join()
+        for _ in score_workers:
+            score_queue.put(None)
+        for worker in score_workers:
+            worker.join()
+
+    finally:
+        for worker in decode_workers + score_workers:
+            if worker.is_alive():
+                worker.terminate()
+        slab_pool.close()
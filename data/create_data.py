@@ -4,8 +4,8 @@ from data.encoders.libjpeg_turbo_encoder import LibjpegTurboEncoder
 from data.encoders.libjpeg_dct_scaling_encoder import LibjpegDctScalingEncoder
 from data.encoders.mozjpeg_encoder import MozjpegEncoder
 from data.encoders.pillow_encoder import PillowEncoder
+from data.encoders.encoder import EncodeTask, METHOD_DCRAW_CJPEG
 from utils.logger import setup_custom_logger
-from tqdm import tqdm
 import argparse
 import os
 import re
@@ -14,7 +14,28 @@ import re
 log = setup_custom_logger(os.path.basename(__file__))
 
 
-def loop(input_files, output_dir, encoders, quality_factors, qtables=None, sample=None):
+def get_encoder(encoder_name):
+    """
+    :param encoder_name: name of the encoder
+    :return: encoder instance
+    """
+    if encoder_name == LibjpegDctScalingEncoder.name():
+        return LibjpegDctScalingEncoder()
+    elif encoder_name == LibjpegSimpleScalingEncoder.name():
+        return LibjpegSimpleScalingEncoder()
+    elif encoder_name == LibjpegNoScalingEncoder.name():
+        return LibjpegNoScalingEncoder()
+    elif encoder_name == LibjpegTurboEncoder.name():
+        return LibjpegTurboEncoder()
+    elif encoder_name == MozjpegEncoder.name():
+        return MozjpegEncoder()
+    elif encoder_name == PillowEncoder.name():
+        return PillowEncoder()
+    else:
+        raise ValueError("Unknown encoder")
+
+
+def loop(input_files, output_dir, encoders, quality_factors, qtables=None, sample=None, max_concurrency=None):
     """
     Convert all given raw files to JPEG files with all given encoders and quality factors
     :param input_files: List of raw files to process
@@ -22,7 +43,11 @@ def loop(input_files, output_dir, encoders, quality_factors, qtables=None, sampl
     :param encoders: instances of encoders to use
     :param quality_factors: list of quality factors
     :param qtables: optional path to text file containing quantization tables to use
+    :param max_concurrency: (optional) maximum number of dcraw | cjpeg pipelines running at the same time, defaults to the number of CPUs
+    :return: number of failed pipelines
     """
+    from tqdm import tqdm
+
     cjpeg_additional_args = []
     if qtables is not None:
         cjpeg_additional_args.extend(["-qtables", qtables])
@@ -34,7 +59,9 @@ def loop(input_files, output_dir, encoders, quality_factors, qtables=None, sampl
         if not os.path.exists(encoder_output_dir):
             os.makedirs(encoder_output_dir)
 
-    for input_file in tqdm(input_files, desc="Create JPEGs from raw images"):
+    # Collect raw files per encoder, such that their pipelines can run concurrently
+    tasks = {encoder.name(): [] for encoder in encoders}
+    for input_file in tqdm(input_files, desc="Prepare encoding tasks"):
         # Loop over quality factors
         for quality in quality_factors:
             filename = os.path.basename(input_file)
@@ -51,7 +78,23 @@ def loop(input_files, output_dir, encoders, quality_factors, qtables=None, sampl
                 if ".png" == input_file_ext:
                     encoder.png_cjpeg(input_file, output_file, quality, cjpeg_args=cjpeg_additional_args)
                 else:
-                    encoder.dcraw_cjpeg(input_file, output_file, quality, cjpeg_args=cjpeg_additional_args)
+                    tasks[encoder.name()].append(EncodeTask(METHOD_DCRAW_CJPEG, input_file, output_file, quality, cjpeg_args=cjpeg_additional_args))
+
+    num_failed = 0
+    for encoder in encoders:
+        encoder_tasks = tasks[encoder.name()]
+        for result in tqdm(encoder.run_encode_many(encoder_tasks, max_concurrency=max_concurrency), total=len(encoder_tasks), desc="Create JPEGs from raw images with {}".format(encoder.name())):
+            if result.error is not None:
+                # Do not leave truncated output behind, such that the next run retries the image
+                if os.path.exists(result.task.output_filename):
+                    os.remove(result.task.output_filename)
+                log.error("Failed to encode {}: {}".format(result.task.input_filename, result.error))
+                num_failed += 1
+
+    if num_failed > 0:
+        log.error("{} pipelines failed".format(num_failed))
+
+    return num_failed
 
 
 if __name__ == "__main__":
@@ -62,6 +105,7 @@ if __name__ == "__main__":
     parser.add_argument("--quality_factors", nargs="+", type=int, help="JPEG encoding quality factors", required=True)
     parser.add_argument("--qtables", type=str, help="Encode with quantization table from given file path")
     parser.add_argument("--sample", type=str, help="HxV chroma subsampling")
+    parser.add_argument("--max_concurrency", type=int, help="Maximum number of dcraw | cjpeg pipelines running at the same time, defaults to the number of CPUs")
     args = vars(parser.parse_args())
 
     input_dir = args["input_dir"]
@@ -69,22 +113,7 @@ if __name__ == "__main__":
     encoder_names = args["encoders"]
     quality_factors = args["quality_factors"]
 
-    encoders = []
-    for encoder_name in encoder_names:
-        if encoder_name == LibjpegDctScalingEncoder.name():
-            encoders.append(LibjpegDctScalingEncoder())
-        elif encoder_name == LibjpegSimpleScalingEncoder.name():
-            encoders.append(LibjpegSimpleScalingEncoder())
-        elif encoder_name == LibjpegNoScalingEncoder.name():
-            encoders.append(LibjpegNoScalingEncoder())
-        elif encoder_name == LibjpegTurboEncoder.name():
-            encoders.append(LibjpegTurboEncoder())
-        elif encoder_name == MozjpegEncoder.name():
-            encoders.append(MozjpegEncoder())
-        elif encoder_name == PillowEncoder.name():
-            encoders.append(PillowEncoder())
-        else:
-            raise ValueError("Unknown encoder")
+    encoders = [get_encoder(encoder_name) for encoder_name in encoder_names]
 
     if not os.path.exists(input_dir):
         raise ValueError("Input directory does not exist")
@@ -92,4 +121,4 @@ if __name__ == "__main__":
     img_files = [os.path.join(dp, f) for dp, dn, filenames in os.walk(input_dir) for f in filenames if re.search(".(nef|dng)$", f.lower()) is not None]
     img_files = sorted(img_files)
 
-    loop(img_files, output_dir, encoders, quality_factors, args["qtables"], args["sample"])
+    loop(img_files, output_dir, encoders, quality_factors, args["qtables"], args["sample"], args["max_concurrency"])
@@ -1,10 +1,11 @@
-from utils.constants import constants, DCRAW_EXECUTABLE_KEY
+from utils.constants import get_executable, DCRAW_EXECUTABLE_KEY
 from utils.logger import setup_custom_logger
 import numpy as np
 import subprocess
 import collections
 import tempfile
-import imageio
+import asyncio
+import signal
 import abc
 import os
 
@@ -12,6 +13,74 @@ import os
 log = setup_custom_logger(os.path.basename(__file__))
 
 
+# Encoding methods that can be run concurrently through Encoder.encode_many
+METHOD_CJPEG = "cjpeg"
+METHOD_DCRAW_CJPEG = "dcraw_cjpeg"
+METHOD_DCRAW_CONVERT_CJPEG = "dcraw_convert_cjpeg"
+METHOD_DJPEG_CJPEG = "djpeg_cjpeg"
+PIPELINE_METHODS = [METHOD_CJPEG, METHOD_DCRAW_CJPEG, METHOD_DCRAW_CONVERT_CJPEG, METHOD_DJPEG_CJPEG]
+
+
+# method: one of PIPELINE_METHODS
+# upstream_args: additional command line arguments to dcraw or djpeg
+EncodeTask = collections.namedtuple("EncodeTask", ["method", "input_filename", "output_filename", "quality", "cjpeg_args", "upstream_args"])
+EncodeTask.__new__.__defaults__ = ((), ())
+
+# Exit code and stderr output of one process of a pipeline
+StageResult = collections.namedtuple("StageResult", ["command_line", "returncode", "stderr"])
+
+# output: output filename, or JPEG file as bytes if the task's output filename is None. None if the task failed.
+# stages: list of StageResult in pipeline order
+# error: None on success, otherwise a message naming the failing stages, see describe_failure
+EncodeResult = collections.namedtuple("EncodeResult", ["task", "output", "stages", "error"])
+
+# Exit codes of a process killed by SIGPIPE, directly or as reported by a shell
+SIGPIPE_RETURNCODES = {-signal.SIGPIPE, 128 + signal.SIGPIPE}
+
+
+def failed_stages(stages):
+    """
+    Determines which stages of a pipeline caused it to fail. An upstream stage that was killed by SIGPIPE only lost its reader, thus it is not blamed if a downstream stage failed as well.
+    :param stages: list of StageResult in pipeline order
+    :return: list of indices of the stages to blame, empty if all stages succeeded
+    """
+    blamed = []
+    for i, stage in enumerate(stages):
+        if stage.returncode == 0:
+            continue
+        if stage.returncode in SIGPIPE_RETURNCODES and any(downstream_stage.returncode != 0 for downstream_stage in stages[i + 1:]):
+            continue
+        blamed.append(i)
+    return blamed
+
+
+def describe_failure(stages):
+    """
+    :param stages: list of StageResult in pipeline order
+    :return: message naming the stages to blame first, followed by any other failed stages, each with its exit code and stderr output. None if all stages succeeded.
+    """
+    blamed = failed_stages(stages)
+    if len(blamed) == 0:
+        return None
+
+    others = [i for i, stage in enumerate(stages) if stage.returncode != 0 and i not in blamed]
+    return "; ".join("{} exited with code {}: {}".format(stages[i].command_line[0], stages[i].returncode, stages[i].stderr.decode("utf-8", errors="replace").strip()) for i in blamed + others)
+
+
+class PipelineError(subprocess.CalledProcessError):
+    def __init__(self, stages):
+        """
+        Raised by Encoder.run_pipeline. Carries the exit code, command line and stderr output of the first stage to blame, see failed_stages, and names all failed stages in its message.
+        :param stages: list of StageResult in pipeline order
+        """
+        stage = stages[failed_stages(stages)[0]]
+        super().__init__(stage.returncode, stage.command_line, stderr=stage.stderr)
+        self.stages = stages
+
+    def __str__(self):
+        return describe_failure(self.stages)
+
+
 class Encoder(abc.ABC):
     def __init__(self):
         super().__init__()
@@ -38,93 +107,304 @@ class Encoder(abc.ABC):
 
         return isinstance(args, collections.abc.Sequence)
 
-    def dcraw_cjpeg(self, input_filename, output_filename, quality, dcraw_args=(), cjpeg_args=()):
+    @staticmethod
+    def _outfile_args(output_filename):
+        # Without -outfile, cjpeg writes to stdout
+        return [] if output_filename is None else ["-outfile", output_filename]
+
+    @staticmethod
+    def _output(cjpeg_process, output_filename):
+        return cjpeg_process.stdout if output_filename is None else output_filename
+
+    def encoder_cjpeg_args(self):
         """
-        Converts a raw image to JPEG by piping the output of dcraw into cjpeg.
-        :param input_filename: path to raw file
-        :param output_filename: path to output JPEG file
-        :param quality: JPEG quality for compression
-        :param dcraw_args: list of additional command line arguments to dcraw
+        Hook for subclasses to pass arguments to every invocation of cjpeg
+        :return: list of cjpeg command line arguments that precede the caller's arguments
+        """
+        return []
+
+    def cjpeg_command_line(self, output_filename, quality, cjpeg_args=(), input_filename=None):
+        """
+        :param output_filename: path to output JPEG file, or None to write the JPEG file to stdout
+        :param quality: JPEG quality for compression. Skipped if cjpeg_args contain -qtables.
         :param cjpeg_args: list of additional command line arguments to cjpeg
-        :return: output filename
+        :param input_filename: (optional) path to input image. If not given, cjpeg reads from stdin.
+        :return: cjpeg command line as list
         """
-        # Ensure dcraw_args and cjpeg_args to be collections
-        if not self._is_tuple_or_list(dcraw_args) or not self._is_tuple_or_list(cjpeg_args):
-            raise ValueError("Additional arguments to dcraw and cjpeg must be a list or a tuple")
+        # Ensure cjpeg_args to be a collection
+        if not self._is_tuple_or_list(cjpeg_args):
+            raise ValueError("Additional arguments to cjpeg must be a list or a tuple")
 
-        # Convert to ppm first
-        dcraw_command_line = [constants[DCRAW_EXECUTABLE_KEY], "-w", "-c", input_filename]
-        if len(dcraw_args) > 0:
-            # Insert at position 1
-            dcraw_command_line[1:1] = list(dcraw_args)
+        cjpeg_args = self.encoder_cjpeg_args() + list(cjpeg_args)
 
-        # Then save as jpeg file
         # Skip quality if qtables is set
         if "-qtables" not in cjpeg_args:
             cjpeg_command_line = [self.cjpeg_executable, "-quality", str(quality)]
         else:
             cjpeg_command_line = [self.cjpeg_executable]
 
-        cjpeg_command_line = cjpeg_command_line + ["-outfile", output_filename]
+        cjpeg_command_line = cjpeg_command_line + self._outfile_args(output_filename)
+        if input_filename is not None:
+            cjpeg_command_line.append(input_filename)
+
         if len(cjpeg_args) > 0:
             # Insert at position 1
-            cjpeg_command_line[1:1] = list(cjpeg_args)
+            cjpeg_command_line[1:1] = cjpeg_args
 
-        # Pipe output from dcraw directly into cjpeg. This relieves us from keeping track of temporary files.
-        dcraw_process = subprocess.Popen(dcraw_command_line, stdout=subprocess.PIPE)
-        cjpeg_process = subprocess.run(cjpeg_command_line, stdin=dcraw_process.stdout, stdout=subprocess.PIPE, check=True)
+        return cjpeg_command_line
 
-        # TODO report errors
-        # djpeg_process.stdout.close()
-
-        return output_filename
-
-    def dcraw_convert_cjpeg(self, input_filename, output_filename, quality, dcraw_args=(), cjpeg_args=()):
+    def dcraw_command_line(self, input_filename, dcraw_args=()):
         """
-        Converts a raw image to JPEG by piping the output of dcraw into cjpeg, but swaps the R and B channels before JPEG compression.
         :param input_filename: path to raw file
-        :param output_filename: path to output JPEG file
-        :param quality: JPEG quality for compression
         :param dcraw_args: list of additional command line arguments to dcraw
-        :param cjpeg_args: list of additional command line arguments to cjpeg
-        :return: output filename
+        :return: dcraw command line as list, which writes a ppm image to stdout
         """
-        # Ensure dcraw_args and cjpeg_args to be collections
-        if not self._is_tuple_or_list(dcraw_args) or not self._is_tuple_or_list(cjpeg_args):
-            raise ValueError("Additional arguments to dcraw and cjpeg must be a list or a tuple")
+        # Ensure dcraw_args to be a collection
+        if not self._is_tuple_or_list(dcraw_args):
+            raise ValueError("Additional arguments to dcraw must be a list or a tuple")
 
-        # Convert to ppm first
-        dcraw_command_line = [constants[DCRAW_EXECUTABLE_KEY], "-w", "-c", input_filename]
+        dcraw_command_line = [get_executable(DCRAW_EXECUTABLE_KEY), "-w", "-c", input_filename]
         if len(dcraw_args) > 0:
             # Insert at position 1
             dcraw_command_line[1:1] = list(dcraw_args)
 
-        # Swap color channels
-        convert_command_line = ["convert", "ppm:-", "-separate", "+channel", "-swap", "0,2", "-combine", "-colorspace", "RGB", "ppm:-"]
+        return dcraw_command_line
 
-        # Then save as jpeg file
-        # Skip quality if qtables is set
-        if "-qtables" not in cjpeg_args:
-            cjpeg_command_line = [self.cjpeg_executable, "-quality", str(quality)]
-        else:
-            cjpeg_command_line = [self.cjpeg_executable]
+    def djpeg_command_line(self, input_filename, output_filename=None, djpeg_args=()):
+        """
+        :param input_filename: path to JPEG file
+        :param output_filename: (optional) path to output image. If not given, djpeg writes to stdout.
+        :param djpeg_args: list of additional command line arguments to djpeg
+        :return: djpeg command line as list
+        """
+        # Ensure djpeg_args to be a collection
+        if not self._is_tuple_or_list(djpeg_args):
+            raise ValueError("Additional arguments to djpeg must be a list or tuple")
 
-        cjpeg_command_line = cjpeg_command_line + ["-outfile", output_filename]
-        if len(cjpeg_args) > 0:
+        djpeg_command_line = [self.djpeg_executable] + self._outfile_args(output_filename) + [input_filename]
+        if len(djpeg_args) > 0:
             # Insert at position 1
-            cjpeg_command_line[1:1] = list(cjpeg_args)
+            djpeg_command_line[1:1] = list(djpeg_args)
 
-        # Pipe output from dcraw directly into cjpeg. This relieves us from keeping track of temporary files.
-        dcraw_process = subprocess.Popen(dcraw_command_line, stdout=subprocess.PIPE)
-        convert_process = subprocess.Popen(convert_command_line, stdin=dcraw_process.stdout, stdout=subprocess.PIPE)
-        dcraw_process.stdout.close()
-        cjpeg_process = subprocess.run(cjpeg_command_line, stdin=convert_process.stdout, stdout=subprocess.PIPE, check=True)
-        convert_process.stdout.close()
+        return djpeg_command_line
 
-        # TODO report errors
-        # djpeg_process.stdout.close()
+    @staticmethod
+    def swap_channels_command_line():
+        """
+        :return: ImageMagick command line as list that swaps the R and B channels of a ppm image from stdin to stdout
+        """
+        return ["convert", "ppm:-", "-separate", "+channel", "-swap", "0,2", "-combine", "-colorspace", "RGB", "ppm:-"]
 
-        return output_filename
+    def pipeline_command_lines(self, method, input_filename, output_filename, quality, upstream_args=(), cjpeg_args=()):
+        """
+        Assembles the command lines of the processes that make up an encoding method, where each process reads the output of its predecessor from stdin.
+        :param method: one of PIPELINE_METHODS, named like the method of this class that runs the same pipeline
+        :param input_filename: path to input image
+        :param output_filename: path to output JPEG file, or None to write the JPEG file to stdout
+        :param quality: JPEG quality for compression
+        :param upstream_args: list of additional command line arguments to dcraw or djpeg
+        :param cjpeg_args: list of additional command line arguments to cjpeg
+        :return: list of command lines
+        """
+        if METHOD_CJPEG == method:
+            if len(upstream_args) > 0:
+                raise ValueError("cjpeg has no upstream process")
+            return [self.cjpeg_command_line(output_filename, quality, cjpeg_args, input_filename=input_filename)]
+        elif METHOD_DCRAW_CJPEG == method:
+            return [self.dcraw_command_line(input_filename, upstream_args), self.cjpeg_command_line(output_filename, quality, cjpeg_args)]
+        elif METHOD_DCRAW_CONVERT_CJPEG == method:
+            return [self.dcraw_command_line(input_filename, upstream_args), self.swap_channels_command_line(), self.cjpeg_command_line(output_filename, quality, cjpeg_args)]
+        elif METHOD_DJPEG_CJPEG == method:
+            return [self.djpeg_command_line(input_filename, djpeg_args=upstream_args), self.cjpeg_command_line(output_filename, quality, cjpeg_args)]
+
+        raise ValueError("Unknown encoding method")
+
+    def run_pipeline(self, command_lines, output_filename):
+        """
+        Runs processes that each read the output of their predecessor from stdin, and checks the exit codes of all of them.
+        :param command_lines: list of command lines, of which the last one is cjpeg
+        :param output_filename: path to output JPEG file, or None to return the JPEG file as bytes
+        :return: output filename, or JPEG file as bytes if output_filename is None
+        :raises PipelineError: if any process failed
+        """
+        upstream_processes = []
+        # stderr of the upstream processes goes to temporary files, which cannot fill up and block a process while cjpeg runs
+        upstream_stderrs = []
+        stdin = None
+        try:
+            for command_line in command_lines[:-1]:
+                upstream_stderrs.append(tempfile.TemporaryFile())
+                process = subprocess.Popen(command_line, stdin=stdin, stdout=subprocess.PIPE, stderr=upstream_stderrs[-1])
+                upstream_processes.append(process)
+                if stdin is not None:
+                    # Only the successor holds the read end, such that the predecessor notices when the successor exits
+                    stdin.close()
+                stdin = process.stdout
+
+            cjpeg_process = subprocess.run(command_lines[-1], stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        finally:
+            if stdin is not None:
+                stdin.close()
+            for process in upstream_processes:
+                process.wait()
+
+            stages = []
+            for process, stderr_file in zip(upstream_processes, upstream_stderrs):
+                stderr_file.seek(0)
+                stages.append(StageResult(command_line=process.args, returncode=process.returncode, stderr=stderr_file.read()))
+            for stderr_file in upstream_stderrs:
+                stderr_file.close()
+
+        stages.append(StageResult(command_line=cjpeg_process.args, returncode=cjpeg_process.returncode, stderr=cjpeg_process.stderr))
+        if len(failed_stages(stages)) > 0:
+            raise PipelineError(stages)
+
+        return self._output(cjpeg_process, output_filename)
+
+    async def _run_pipeline_async(self, task):
+        """
+        Runs the pipeline of the given task in subprocesses connected by os-level pipes, and collects the exit code and stderr output of every process.
+        :param task: EncodeTask
+        :return: EncodeResult
+        """
+        try:
+            command_lines = self.pipeline_command_lines(task.method, task.input_filename, task.output_filename, task.quality, task.upstream_args, task.cjpeg_args)
+        except ValueError as e:
+            return EncodeResult(task=task, output=None, stages=[], error=str(e))
+        except KeyError as e:
+            return EncodeResult(task=task, output=None, stages=[], error="Executable {} is not configured".format(e))
+
+        processes = []
+        stdin = None
+        try:
+            for i, command_line in enumerate(command_lines):
+                if i < len(command_lines) - 1:
+                    # Connect to the successor by a pipe that bypasses the event loop
+                    read_fd, write_fd = os.pipe()
+                    stdout = write_fd
+                else:
+                    read_fd, write_fd = None, None
+                    stdout = asyncio.subprocess.PIPE
+
+                try:
+                    process = await asyncio.create_subprocess_exec(*command_line, stdin=stdin, stdout=stdout, stderr=asyncio.subprocess.PIPE)
+                except BaseException:
+                    if read_fd is not None:
+                        os.close(read_fd)
+                    raise
+                finally:
+                    # The children hold their own copies. Closing ours is what lets a process see end of file, or a broken pipe, when its neighbor exits.
+                    if stdin is not None:
+                        os.close(stdin)
+                        stdin = None
+                    if write_fd is not None:
+                        os.close(write_fd)
+
+                processes.append(process)
+                stdin = read_fd
+
+            # Drain stderr of all processes and stdout of cjpeg at the same time, such that no process blocks on a full pipe
+            outputs = await asyncio.gather(*[process.communicate() for process in processes])
+
+        except (OSError, asyncio.CancelledError) as e:
+            # Failed to start a process, e.g., because an executable is missing, or the caller stopped consuming results
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+            # Reap the killed processes
+            await asyncio.gather(*[process.wait() for process in processes])
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+            stages = [StageResult(command_line=command_line, returncode=process.returncode, stderr=b"") for command_line, process in zip(command_lines, processes)]
+            return EncodeResult(task=task, output=None, stages=stages, error=str(e))
+
+        stages = [StageResult(command_line=command_line, returncode=process.returncode, stderr=stderr) for command_line, process, (_, stderr) in zip(command_lines, processes, outputs)]
+
+        error = describe_failure(stages)
+        if error is not None:
+            return EncodeResult(task=task, output=None, stages=stages, error=error)
+
+        output = outputs[-1][0] if task.output_filename is None else task.output_filename
+        return EncodeResult(task=task, output=output, stages=stages, error=None)
+
+    async def encode_many(self, tasks, max_concurrency=None):
+        """
+        Runs many encoding pipelines concurrently, e.g., dcraw | cjpeg for a directory of raw images.
+        Failing pipelines do not raise, but are reported through the error field of their result.
+        :param tasks: iterable of EncodeTask
+        :param max_concurrency: (optional) maximum number of pipelines running at the same time, defaults to the number of CPUs
+        :return: asynchronous generator of EncodeResult, in order of completion
+        """
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count()
+        if max_concurrency < 1:
+            raise ValueError("Maximum concurrency must be positive")
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(task):
+            async with semaphore:
+                return await self._run_pipeline_async(task)
+
+        futures = [asyncio.ensure_future(run(task)) for task in tasks]
+        try:
+            for future in asyncio.as_completed(futures):
+                yield await future
+        finally:
+            # Stop pipelines that have not been consumed when the caller stops early
+            for future in futures:
+                future.cancel()
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    def run_encode_many(self, tasks, max_concurrency=None):
+        """
+        Blocking version of encode_many for callers without an event loop
+        :param tasks: iterable of EncodeTask
+        :param max_concurrency: (optional) maximum number of pipelines running at the same time, defaults to the number of CPUs
+        :return: generator of EncodeResult, in order of completion
+        """
+        loop = asyncio.new_event_loop()
+        # Older Python versions only watch for exiting child processes of the current event loop
+        asyncio.set_event_loop(loop)
+        results = self.encode_many(tasks, max_concurrency=max_concurrency)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def dcraw_cjpeg(self, input_filename, output_filename, quality, dcraw_args=(), cjpeg_args=()):
+        """
+        Converts a raw image to JPEG by piping the output of dcraw into cjpeg.
+        :param input_filename: path to raw file
+        :param output_filename: path to output JPEG file, or None to return the JPEG file as bytes
+        :param quality: JPEG quality for compression
+        :param dcraw_args: list of additional command line arguments to dcraw
+        :param cjpeg_args: list of additional command line arguments to cjpeg
+        :return: output filename, or JPEG file as bytes if output_filename is None
+        """
+        # Pipe output from dcraw directly into cjpeg. This relieves us from keeping track of temporary files.
+        command_lines = self.pipeline_command_lines(METHOD_DCRAW_CJPEG, input_filename, output_filename, quality, dcraw_args, cjpeg_args)
+        return self.run_pipeline(command_lines, output_filename)
+
+    def dcraw_convert_cjpeg(self, input_filename, output_filename, quality, dcraw_args=(), cjpeg_args=()):
+        """
+        Converts a raw image to JPEG by piping the output of dcraw into cjpeg, but swaps the R and B channels before JPEG compression.
+        :param input_filename: path to raw file
+        :param output_filename: path to output JPEG file, or None to return the JPEG file as bytes
+        :param quality: JPEG quality for compression
+        :param dcraw_args: list of additional command line arguments to dcraw
+        :param cjpeg_args: list of additional command line arguments to cjpeg
+        :return: output filename, or JPEG file as bytes if output_filename is None
+        """
+        command_lines = self.pipeline_command_lines(METHOD_DCRAW_CONVERT_CJPEG, input_filename, output_filename, quality, dcraw_args, cjpeg_args)
+        return self.run_pipeline(command_lines, output_filename)
 
     def auto_cjpeg(self, input, output_filename, quality, cjpeg_args=()):
         """
@@ -153,58 +433,30 @@ class Encoder(abc.ABC):
         with tempfile.NamedTemporaryFile(suffix=".ppm") as f:
             convert_command_line = ["convert", input_filename, f.name]
             convert_process = subprocess.run(convert_command_line, stdout=subprocess.PIPE, check=True)
-            self.cjpeg(f.name, output_filename, quality, cjpeg_args)
+            return self.cjpeg(f.name, output_filename, quality, cjpeg_args)
 
     def img_cjpeg(self, img, output_filename, quality, cjpeg_args=()):
         """
         Saves a given ndarray as JPEG image
         :param img: ndarray
-        :param output_filename: path to output JPEG file
+        :param output_filename: path to output JPEG file, or None to return the JPEG file as bytes
         :param quality: JPEG quality factor
         :param cjpeg_args: additional command line arguments to pass on to cjpeg
         """
+        import imageio
         with tempfile.NamedTemporaryFile(suffix=".ppm") as f:
             imageio.imwrite(f.name, img)
 
-            self.cjpeg(f.name, output_filename, quality, cjpeg_args)
+            return self.cjpeg(f.name, output_filename, quality, cjpeg_args)
 
     def cjpeg(self, input_filename, output_filename, quality, cjpeg_args=()):
-        # Ensure cjpeg_args to be collections
-        if not self._is_tuple_or_list(cjpeg_args):
-            raise ValueError("Additional arguments to cjpeg must be a list or a tuple")
-
-        # Concatenate cjpeg command line
-        # Skip quality if qtables is set
-        if "-qtables" not in cjpeg_args:
-            cjpeg_command_line = [self.cjpeg_executable, "-quality", str(quality)]
-        else:
-            cjpeg_command_line = [self.cjpeg_executable]
-
-        cjpeg_command_line = cjpeg_command_line + ["-outfile", output_filename, input_filename]
-
-        if len(cjpeg_args) > 0:
-            # Insert at position 1
-            cjpeg_command_line[1:1] = list(cjpeg_args)
-
         # Raise error if exit code is non-zero
-        cjpeg_process = subprocess.run(cjpeg_command_line, stdout=subprocess.PIPE, check=True)
-
-        return output_filename
+        command_lines = self.pipeline_command_lines(METHOD_CJPEG, input_filename, output_filename, quality, cjpeg_args=cjpeg_args)
+        return self.run_pipeline(command_lines, output_filename)
 
     def djpeg(self, input_filename, output_filename, djpeg_args=()):
-        # Ensure djpeg_args to be a collection
-        if not self._is_tuple_or_list(djpeg_args):
-            raise ValueError("Additional arguments to djpeg must be a list or tuple")
-
-        # Concatenate djpeg command line
-        djpeg_command_line = [self.djpeg_executable, "-outfile", output_filename, input_filename]
-
-        if len(djpeg_args) > 0:
-            # Insert at position 1
-            djpeg_command_line[1:1] = list(djpeg_args)
-
         # Raise error if exit code is non-zero
-        djpeg_process = subprocess.run(djpeg_command_line, stdout=subprocess.PIPE, check=True)
+        djpeg_process = subprocess.run(self.djpeg_command_line(input_filename, output_filename, djpeg_args), stdout=subprocess.PIPE, check=True)
 
         return output_filename
 
@@ -212,39 +464,15 @@ class Encoder(abc.ABC):
         """
         Recompresses a given jpeg image
         :param input_filename: file path to image to be recompressed
-        :param output_filename: file path where to store recompressed image
+        :param output_filename: file path where to store recompressed image, or None to return the JPEG file as bytes
         :param quality: quality factor for cjpeg
         :param djpeg_args: tuple/list of additional arguments for djpeg command
         :param cjpeg_args: tuple/list of additional arguments for cjpeg
-        :return: output raw_filename
+        :return: output raw_filename, or JPEG file as bytes if output_filename is None
         """
-        # Ensure djpeg_args and cjpeg_args to be collections
-        if not self._is_tuple_or_list(djpeg_args) or not self._is_tuple_or_list(cjpeg_args):
-            raise ValueError("Additional arguments to djpeg and cjpeg must be a list or a tuple")
-
-        # Djpeg command line
-        djpeg_command_line = [self.djpeg_executable, input_filename]
-        if len(djpeg_args) > 0:
-            # Insert at position 1
-            djpeg_command_line[1:1] = list(djpeg_args)
-
-        # Skip quality if qtables is set
-        if "-qtables" not in cjpeg_args:
-            cjpeg_command_line = [self.cjpeg_executable, "-quality", str(quality)]
-        else:
-            cjpeg_command_line = [self.cjpeg_executable]
-
-        cjpeg_command_line = cjpeg_command_line + ["-outfile", output_filename]
-
-        if len(cjpeg_args) > 0:
-            # Insert at position 1
-            cjpeg_command_line[1:1] = list(cjpeg_args)
-
         # Pipe output from djpeg directly into cjpeg
-        djpeg_process = subprocess.Popen(djpeg_command_line, stdout=subprocess.PIPE)
-        cjpeg_process = subprocess.run(cjpeg_command_line, stdin=djpeg_process.stdout, stdout=subprocess.PIPE, check=True)
-
-        return output_filename
+        command_lines = self.pipeline_command_lines(METHOD_DJPEG_CJPEG, input_filename, output_filename, quality, djpeg_args, cjpeg_args)
+        return self.run_pipeline(command_lines, output_filename)
 
     def dcraw(self, input_filename, output_filename, dcraw_args=()):
         """
@@ -256,7 +484,7 @@ class Encoder(abc.ABC):
         """
         assert os.path.splitext(output_filename)[1] == ".ppm", "Only ppm output supported"
         # Convert to ppm
-        dcraw_command_line = [constants[DCRAW_EXECUTABLE_KEY], "-w", "-c", input_filename]
+        dcraw_command_line = [get_executable(DCRAW_EXECUTABLE_KEY), "-w", "-c", input_filename]
         if len(dcraw_args) > 0:
             # Insert at position 1
             dcraw_command_line[1:1] = list(dcraw_args)
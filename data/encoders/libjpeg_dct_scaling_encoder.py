@@ -1,5 +1,5 @@
 from data.encoders.encoder import Encoder
-from utils.constants import LIBJPEG_CJPEG_EXECUTABLE_KEY, LIBJPEG_DJPEG_EXECUTABLE_KEY, constants, LIBJPEG_DCT_SCALING
+from utils.constants import LIBJPEG_CJPEG_EXECUTABLE_KEY, LIBJPEG_DJPEG_EXECUTABLE_KEY, get_executable, LIBJPEG_DCT_SCALING
 
 
 class LibjpegDctScalingEncoder(Encoder):
@@ -9,8 +9,8 @@ class LibjpegDctScalingEncoder(Encoder):
 
     @property
     def cjpeg_executable(self):
-        return constants[LIBJPEG_CJPEG_EXECUTABLE_KEY]
+        return get_executable(LIBJPEG_CJPEG_EXECUTABLE_KEY)
 
     @property
     def djpeg_executable(self):
-        return constants[LIBJPEG_DJPEG_EXECUTABLE_KEY]
+        return get_executable(LIBJPEG_DJPEG_EXECUTABLE_KEY)
@@ -1,5 +1,5 @@
 from data.encoders.encoder import Encoder
-from utils.constants import LIBJPEG_TURBO_CJPEG_EXECUTABLE_KEY, LIBJPEG_TURBO_DJPEG_EXECUTABLE_KEY, LIBJPEG_TURBO, constants
+from utils.constants import LIBJPEG_TURBO_CJPEG_EXECUTABLE_KEY, LIBJPEG_TURBO_DJPEG_EXECUTABLE_KEY, LIBJPEG_TURBO, get_executable
 
 
 class LibjpegTurboEncoder(Encoder):
@@ -9,8 +9,8 @@ class LibjpegTurboEncoder(Encoder):
 
     @property
     def cjpeg_executable(self):
-        return constants[LIBJPEG_TURBO_CJPEG_EXECUTABLE_KEY]
+        return get_executable(LIBJPEG_TURBO_CJPEG_EXECUTABLE_KEY)
 
     @property
     def djpeg_executable(self):
-        return constants[LIBJPEG_TURBO_DJPEG_EXECUTABLE_KEY]
+        return get_executable(LIBJPEG_TURBO_DJPEG_EXECUTABLE_KEY)
@@ -1,5 +1,5 @@
 from data.encoders.encoder import Encoder
-from utils.constants import constants, MOZJPEG, MOZJPEG_CJPEG_EXECUTABLE_KEY, MOZJPEG_DJPEG_EXECUTABLE_KEY
+from utils.constants import get_executable, MOZJPEG, MOZJPEG_CJPEG_EXECUTABLE_KEY, MOZJPEG_DJPEG_EXECUTABLE_KEY
 
 
 class MozjpegEncoder(Encoder):
@@ -9,8 +9,8 @@ class MozjpegEncoder(Encoder):
 
     @property
     def cjpeg_executable(self):
-        return constants[MOZJPEG_CJPEG_EXECUTABLE_KEY]
+        return get_executable(MOZJPEG_CJPEG_EXECUTABLE_KEY)
 
     @property
     def djpeg_executable(self):
-        return constants[MOZJPEG_DJPEG_EXECUTABLE_KEY]
+        return get_executable(MOZJPEG_DJPEG_EXECUTABLE_KEY)
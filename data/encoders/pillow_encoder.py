@@ -1,12 +1,48 @@
-from data.encoders.encoder import Encoder
-from utils.constants import PILLOW
-from PIL import Image
-import tempfile
+from data.encoders.encoder import Encoder, EncodeResult, METHOD_CJPEG, PIPELINE_METHODS
+from utils.constants import get_executable, DCRAW_EXECUTABLE_KEY, PILLOW
+import numpy as np
+import subprocess
+import functools
+import asyncio
+import io
+import re
+
+
+# Pillow's subsampling settings for the luma sampling factors given to cjpeg -sample
+SAMPLE_TO_SUBSAMPLING = {
+    "1x1": 0,  # 4:4:4
+    "2x1": 1,  # 4:2:2
+    "2x2": 2,  # 4:2:0
+}
+
+
+def read_qtables(qtables_filename):
+    """
+    Reads quantization tables in the text format of cjpeg -qtables: whitespace-separated integers, 64 per table in natural (not zig-zag) order, with comments starting at #.
+    :param qtables_filename: path to text file
+    :return: list of tables, each a list of 64 integers
+    """
+    with open(qtables_filename, "r") as f:
+        text = re.sub("#.*", "", f.read())
+
+    values = [int(v) for v in text.split()]
+    if len(values) == 0 or len(values) % 64 != 0:
+        raise ValueError("Quantization table file must contain multiples of 64 values")
+
+    return [values[i:i + 64] for i in range(0, len(values), 64)]
 
 
 class PillowEncoder(Encoder):
     def __init__(self):
+        """
+        Encodes in process through Pillow's bindings to libjpeg(-turbo), which avoids spawning a cjpeg process and writing temporary files for every image.
+        The cjpeg arguments -sample (1x1, 2x1 or 2x2), -qtables, -optimize and -progressive are translated into Pillow's save options.
+        Pillow's libjpeg-turbo always downsamples chroma by averaging, thus -nosmooth is accepted as is. Arguments that have no Pillow equivalent raise a ValueError.
+        Raw images are still developed by a dcraw process, but its output is read from memory.
+        """
         super().__init__()
+        # Parsed quantization table files
+        self._qtables = dict()
 
     @classmethod
     def name(cls):
@@ -18,12 +54,171 @@ class PillowEncoder(Encoder):
     def djpeg_executable(self):
         raise ValueError("Not applicable")
 
+    def save_options(self, quality, cjpeg_args=()):
+        """
+        Translates cjpeg arguments into options for PIL.Image.save
+        :param quality: JPEG quality factor. Ignored if -qtables is given, as in the other encoders.
+        :param cjpeg_args: list of cjpeg command line arguments
+        :return: dict of save options
+        """
+        if not self._is_tuple_or_list(cjpeg_args):
+            raise ValueError("Additional arguments to cjpeg must be a list or a tuple")
+
+        options = {"format": "JPEG", "quality": quality}
+        cjpeg_args = list(cjpeg_args)
+        while len(cjpeg_args) > 0:
+            arg = cjpeg_args.pop(0)
+            if "-sample" == arg:
+                # Only the luma sampling factors matter, chroma components are sampled 1x1
+                sample = cjpeg_args.pop(0).split(",")[0].lower()
+                if sample not in SAMPLE_TO_SUBSAMPLING:
+                    raise ValueError("Sampling factors {} are not supported by Pillow".format(sample))
+                options["subsampling"] = SAMPLE_TO_SUBSAMPLING[sample]
+            elif "-qtables" == arg:
+                qtables_filename = cjpeg_args.pop(0)
+                if qtables_filename not in self._qtables:
+                    self._qtables[qtables_filename] = read_qtables(qtables_filename)
+                options["qtables"] = self._qtables[qtables_filename]
+                del options["quality"]
+            elif "-optimize" == arg:
+                options["optimize"] = True
+            elif "-progressive" == arg:
+                options["progressive"] = True
+            elif arg in ["-nosmooth", "-baseline"]:
+                # Simple downsampling is all that Pillow does, and Pillow only writes baseline tables anyway
+                continue
+            else:
+                raise ValueError("cjpeg argument {} is not supported by Pillow".format(arg))
+
+        return options
+
+    def save(self, img, output_filename, quality, cjpeg_args=()):
+        """
+        Compresses an image in process
+        :param img: PIL image or ndarray of shape [height, width, 3] as uint8
+        :param output_filename: path to output JPEG file, or None to return the JPEG file as bytes
+        :param quality: JPEG quality factor
+        :param cjpeg_args: cjpeg command line arguments, see save_options
+        :return: output filename, or JPEG file as bytes if output_filename is None
+        """
+        from PIL import Image
+
+        options = self.save_options(quality, cjpeg_args)
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+        if img.mode not in ["RGB", "L"]:
+            img = img.convert("RGB")
+
+        if output_filename is None:
+            # Return JPEG file as bytes
+            f = io.BytesIO()
+            img.save(f, **options)
+            return f.getvalue()
+
+        img.save(output_filename, **options)
+        return output_filename
+
+    def cjpeg(self, input_filename, output_filename, quality, cjpeg_args=()):
+        from PIL import Image
+        with Image.open(input_filename) as img:
+            return self.save(img, output_filename, quality, cjpeg_args)
+
+    def png_cjpeg(self, input_filename, output_filename, quality, cjpeg_args=()):
+        # Pillow reads png files directly
+        return self.cjpeg(input_filename, output_filename, quality, cjpeg_args)
+
+    def img_cjpeg(self, img, output_filename, quality, cjpeg_args=()):
+        return self.save(img, output_filename, quality, cjpeg_args)
+
+    def djpeg_cjpeg(self, input_filename, output_filename, quality, djpeg_args=(), cjpeg_args=()):
+        if not self._is_tuple_or_list(djpeg_args) or len(djpeg_args) > 0:
+            raise ValueError("djpeg arguments are not supported by Pillow")
+
+        return self.cjpeg(input_filename, output_filename, quality, cjpeg_args)
+
+    def djpeg(self, input_filename, output_filename, djpeg_args=()):
+        from PIL import Image
+        if not self._is_tuple_or_list(djpeg_args) or len(djpeg_args) > 0:
+            raise ValueError("djpeg arguments are not supported by Pillow")
+
+        with Image.open(input_filename) as img:
+            img.save(output_filename)
+
+        return output_filename
+
     def dcraw_cjpeg(self, input_filename, output_filename, quality, dcraw_args=(), cjpeg_args=()):
-        with tempfile.NamedTemporaryFile(suffix=".ppm") as ppm_file:
-            self.dcraw(input_filename, ppm_file.name)
+        from PIL import Image
+        if not self._is_tuple_or_list(dcraw_args):
+            raise ValueError("Additional arguments to dcraw must be a list or a tuple")
+
+        # Read the developed image from memory instead of a temporary ppm file
+        dcraw_command_line = [get_executable(DCRAW_EXECUTABLE_KEY), "-w", "-c"] + list(dcraw_args) + [input_filename]
+        dcraw_process = subprocess.run(dcraw_command_line, stdout=subprocess.PIPE, check=True)
+
+        with Image.open(io.BytesIO(dcraw_process.stdout)) as img:
+            return self.save(img, output_filename, quality, cjpeg_args)
+
+    def dcraw_convert_cjpeg(self, input_filename, output_filename, quality, dcraw_args=(), cjpeg_args=()):
+        from PIL import Image
+        if not self._is_tuple_or_list(dcraw_args):
+            raise ValueError("Additional arguments to dcraw must be a list or a tuple")
+
+        dcraw_command_line = [get_executable(DCRAW_EXECUTABLE_KEY), "-w", "-c"] + list(dcraw_args) + [input_filename]
+        dcraw_process = subprocess.run(dcraw_command_line, stdout=subprocess.PIPE, check=True)
+
+        with Image.open(io.BytesIO(dcraw_process.stdout)) as img:
+            # Swap the R and B channels before compression
+            rgb = np.asarray(img.convert("RGB"))[:, :, ::-1]
+            return self.save(np.ascontiguousarray(rgb), output_filename, quality, cjpeg_args)
+
+    async def _run_pipeline_async(self, task):
+        """
+        Runs the encoding method of the given task in a thread of the event loop's default executor. Pillow releases the GIL while compressing, thus encode_many still runs tasks concurrently.
+        :param task: EncodeTask
+        :return: EncodeResult without stages, as cjpeg runs in process
+        """
+        if task.method not in PIPELINE_METHODS:
+            return EncodeResult(task=task, output=None, stages=[], error="Unknown encoding method")
+
+        if METHOD_CJPEG == task.method:
+            if len(task.upstream_args) > 0:
+                return EncodeResult(task=task, output=None, stages=[], error="cjpeg has no upstream process")
+            encode = functools.partial(self.cjpeg, task.input_filename, task.output_filename, task.quality, task.cjpeg_args)
+        else:
+            encode = functools.partial(getattr(self, task.method), task.input_filename, task.output_filename, task.quality, task.upstream_args, task.cjpeg_args)
+
+        try:
+            output = await asyncio.get_event_loop().run_in_executor(None, encode)
+        except (ValueError, OSError, subprocess.CalledProcessError) as e:
+            return EncodeResult(task=task, output=None, stages=[], error=str(e))
+
+        return EncodeResult(task=task, output=output, stages=[], error=None)
+
+
+if __name__ == "__main__":
+    from decoder import PyCoefficientDecoder
+    import tempfile
+    import time
+
+    encoder = PillowEncoder()
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(64, 96, 3)).astype(np.uint8)
 
-            img = Image.open(ppm_file.name)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        qtables_filename = tmp_dir + "/qtables.txt"
+        with open(qtables_filename, "w") as f:
+            f.write("# Luma\n" + " ".join(str(v) for v in range(1, 65)) + "\n# Chroma\n" + " ".join(str(v) for v in range(2, 66)) + "\n")
 
-            img.save(output_filename, quality=quality)
+        # Sampling factors and quantization tables end up in the file
+        for sample, (v_samp_factor, h_samp_factor) in [("1x1", (1, 1)), ("2x1", (1, 2)), ("2x2", (2, 2))]:
+            output_filename = encoder.img_cjpeg(img, tmp_dir + "/{}.jpg".format(sample), 90, cjpeg_args=["-sample", sample, "-qtables", qtables_filename])
+            decoder = PyCoefficientDecoder(output_filename)
+            assert (decoder.v_samp_factor(0), decoder.h_samp_factor(0)) == (v_samp_factor, h_samp_factor)
+            assert np.array_equal(decoder.get_quantization_table(0).ravel(), np.arange(1, 65))
+            assert np.array_equal(decoder.get_quantization_table(1).ravel(), np.arange(2, 66))
 
-            return output_filename
+    start = time.perf_counter()
+    num_images = 1000
+    for _ in range(num_images):
+        encoder.img_cjpeg(img, None, 90, cjpeg_args=["-sample", "2x2"])
+    print("Encoded {:.0f} images per second".format(num_images / (time.perf_counter() - start)))
@@ -1,7 +1,6 @@
 import numpy as np
 import argparse
 import random
-import h5py
 import os
 import re
 from utils.logger import setup_custom_logger
@@ -17,6 +16,8 @@ KEY_QUANTIZATION_TABLE = "quantization_table"
 class QualityFactorEstimator(object):
     def __init__(self, storage_file):
         self._storage_file = storage_file
+        # Estimates of previously seen quantization tables. Images of the same camera or video stream mostly share their tables.
+        self._cache = dict()
 
         if os.path.exists(storage_file):
             # Load state from file
@@ -29,6 +30,7 @@ class QualityFactorEstimator(object):
             self._quantization_tables = np.empty((0, 64), dtype=np.int)
 
     def append_quality_factor(self, quality_factor, quantization_table):
+        self._cache.clear()
         self._quality_factors = np.concatenate((self._quality_factors, np.array(quality_factor).reshape((1,))), axis=0)
         self._quantization_tables = np.concatenate((self._quantization_tables, quantization_table.ravel()[None, :]), axis=0)
 
@@ -40,6 +42,12 @@ class QualityFactorEstimator(object):
         :return: estimated quality factor, and difference between the query and the best-matching known quantization table), as 2-tuple
         """
         assert len(self._quantization_tables) > 0, "No known quantization tables as the moment"
+        key = np.asarray(query_table, dtype=np.float64).tobytes()
+        if key not in self._cache:
+            self._cache[key] = self._find_nearest_quality_factor(query_table)
+        return self._cache[key]
+
+    def _find_nearest_quality_factor(self, query_table):
         distances = np.linalg.norm(self._quantization_tables - query_table.ravel(), axis=1)
         min_distance_idx = np.argmin(distances)
         quality_factor_min_distance = self._quality_factors[min_distance_idx]
@@ -47,11 +55,14 @@ class QualityFactorEstimator(object):
         return quality_factor_min_distance, min_distance
 
     def load(self):
+        import h5py
+        self._cache.clear()
         with h5py.File(self._storage_file, "r") as f:
             self._quality_factors = np.array(f[KEY_QUALITY_FACTOR])
             self._quantization_tables = np.array(f[KEY_QUANTIZATION_TABLE])
 
     def persist(self):
+        import h5py
         with h5py.File(self._storage_file, "w") as f:
             f[KEY_QUALITY_FACTOR] = self._quality_factors
             f[KEY_QUANTIZATION_TABLE] = self._quantization_tables
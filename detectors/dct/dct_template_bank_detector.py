@@ -0,0 +1,103 @@
+from detectors.dct.dct_template_matching_detector import DctTemplateMatchingDetector
+import collections
+import numpy as np
+
+
+# Names of the built-in templates
+COLUMN_ALTERNATING = "column_alternating"
+ROW_ALTERNATING = "row_alternating"
+COLUMN_AND_ROW_ALTERNATING = "column_and_row_alternating"
+COLUMN_PERIOD_4 = "column_period_4"
+
+
+class DctTemplateBankDetector(DctTemplateMatchingDetector):
+    def __init__(self, patterns=None, aggregator=None):
+        """
+        Matches several templates at once. Each block is normalized only once and then correlated against all templates with a single matrix multiplication.
+        :param patterns: (optional) ordered dict mapping template names to 8x8 patterns in spatial domain. Defaults to the built-in patterns, of which the first one is the template of DctTemplateMatchingDetector.
+        :param aggregator: (optional) ScoreAggregator instance that computes further statistics over the detection map of the first template
+        """
+        super().__init__(aggregator=aggregator)
+        if patterns is None:
+            patterns = self.get_patterns()
+
+        self._template_names = list(patterns.keys())
+
+        # Set up template matrix of shape [63, num_templates]
+        templates = [self.normalize_template(self.template_from_pattern(w)) for w in patterns.values()]
+        self._template_matrix = np.stack(templates, axis=1)
+
+    @staticmethod
+    def get_patterns():
+        """
+        :return: ordered dict mapping template names to 8x8 patterns in spatial domain
+        """
+        patterns = collections.OrderedDict()
+
+        # Alternating columns, as caused by horizontal 2x subsampling
+        w = np.ones((8, 8))
+        w[:, 1::2] = 2
+        patterns[COLUMN_ALTERNATING] = w
+
+        # Alternating rows, for vertical 2x subsampling
+        w = np.ones((8, 8))
+        w[1::2, :] = 2
+        patterns[ROW_ALTERNATING] = w
+
+        # Alternating columns and rows
+        w = np.ones((8, 8))
+        w[:, 1::2] += 1
+        w[1::2, :] += 1
+        patterns[COLUMN_AND_ROW_ALTERNATING] = w
+
+        # Pairs of columns alternating with a period of 4, as caused by horizontal 4x subsampling (4:1:1)
+        w = np.ones((8, 8))
+        w[:, 2::4] = 2
+        w[:, 3::4] = 2
+        patterns[COLUMN_PERIOD_4] = w
+
+        return patterns
+
+    @property
+    def template_names(self):
+        return self._template_names
+
+    def detect_map(self, dct_blocks, quantization_table=None):
+        """
+        Correlates all templates with each DCT block using the normalized cross-correlation.
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param quantization_table: (optional) if given, dct_blocks are quantized coefficients that are correlated without building the dequantized array
+        :return: map of size [num_vertical_blocks, num_horizontal_blocks, num_templates] that indicates how strongly each block is correlated with each template.
+        """
+        if quantization_table is not None:
+            return self.correlate_quantized(dct_blocks, quantization_table, self._template_matrix)
+
+        # Correlate with all templates at once
+        return self.correlate_blocks(dct_blocks, self._template_matrix)
+
+    def detect_template_scores(self, dct_blocks, quantization_table=None):
+        """
+        Averages the scores over all DCT blocks, separately for each template.
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param quantization_table: (optional) if given, dct_blocks are quantized coefficients that are correlated without building the dequantized array
+        :return: vector of length num_templates with one score per template
+        """
+        detection_map = self.detect_map(dct_blocks, quantization_table=quantization_table)
+        return np.mean(detection_map, axis=(0, 1))
+
+    def detect_score(self, dct_blocks, quantization_table=None):
+        """
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param quantization_table: (optional) if given, dct_blocks are quantized coefficients that are correlated without building the dequantized array
+        :return: score of the first template
+        """
+        return self.detect_template_scores(dct_blocks, quantization_table=quantization_table)[0]
+
+    def best_template(self, template_scores):
+        """
+        :param template_scores: scores as returned by detect_template_scores
+        :return: name of the template with the highest score, ignoring NaN scores, or an empty string if all scores are NaN, e.g., for images without blocks
+        """
+        if np.all(np.isnan(template_scores)):
+            return ""
+        return self._template_names[int(np.nanargmax(template_scores))]
@@ -1,14 +1,26 @@
 from detectors.detector import Detector
-from scipy.fftpack import dct
+from utils.dct import dct_2d
+from utils import kernels
 import numpy as np
 
 
 EPSILON = 1e-7
 
+# Number of blocks to convert to floating point at once when working on quantized coefficients
+CHUNK_SIZE_BLOCKS = 16384
+
 
 class DctTemplateMatchingDetector(Detector):
-    def __init__(self):
+    def __init__(self, aggregator=None):
+        """
+        :param aggregator: (optional) ScoreAggregator instance that computes further statistics over the detection map, see detect_statistics
+        """
         super().__init__()
+        self._aggregator = aggregator
+
+    @property
+    def aggregator(self):
+        return self._aggregator
 
     @staticmethod
     def get_template():
@@ -20,42 +32,157 @@ class DctTemplateMatchingDetector(Detector):
         w = np.ones((8, 8))
         w[:, 1::2] = 2
 
+        return DctTemplateMatchingDetector.template_from_pattern(w)
+
+    @staticmethod
+    def template_from_pattern(w):
+        """
+        Transforms a spatial 8x8 pattern into a template in DCT domain.
+        :param w: 8x8 block in spatial domain
+        :return: 8x8 block of DCT coefficient template
+        """
         # Set DC term to zero
         w = w - np.mean(w)
 
-        # Transform into DCT domain
-        coefs = dct(dct(w, axis=1, norm="ortho"), axis=0, norm="ortho")
+        # Transform into DCT domain. Avoids importing scipy, which dominates the startup time otherwise.
+        coefs = dct_2d(w)
 
         return coefs
 
-    def detect_map(self, dct_blocks):
+    @staticmethod
+    def normalize_template(template):
         """
-        Correlates the chroma dimples template with each DCT block using the normalized cross-correlation.
-        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
-        :return: map of size [num_vertical_blocks, num_horizontal_blocks] that indicates how strongly each block is correlated with the template.
+        Prepares a template for the normalized cross-correlation.
+        :param template: 8x8 block of DCT coefficients
+        :return: the 63 AC coefficients of the template, made zero-mean and unit-variance
         """
-        # Retrieve template
-        template = self.get_template().ravel()
+        # Only consider AC coefficients
+        template = template.ravel()[1:]
 
+        # Make zero-mean and unit-variance
+        return (template - np.mean(template)) / np.std(template)
+
+    @staticmethod
+    def normalize_blocks(dct_blocks):
+        """
+        Prepares DCT blocks for the normalized cross-correlation.
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :return: the 63 AC coefficients of each block, made zero-mean and unit-variance, of shape [num_vertical_blocks, num_horizontal_blocks, 63]
+        """
         # Only consider AC coefficients
-        template = template[1:]
         dct_blocks = dct_blocks[:, :, 1:]
 
-        # Make zero-mean and unit-variance
-        template = (template - np.mean(template)) / np.std(template)
+        # Make each DCT block zero-mean and unit-variance
+        return (dct_blocks - np.mean(dct_blocks, axis=2)[:, :, None]) / (np.std(dct_blocks, axis=2)[:, :, None] + EPSILON)
+
+    @staticmethod
+    def correlate_blocks(dct_blocks, template_matrix):
+        """
+        Computes the normalized cross-correlation of each DCT block with each template.
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param template_matrix: normalized templates of shape [63, num_templates]
+        :return: map of size [num_vertical_blocks, num_horizontal_blocks, num_templates]
+        """
+        if kernels.BACKEND_NUMBA == kernels.get_backend():
+            return kernels.numba_kernels().correlate_blocks(dct_blocks, np.ascontiguousarray(template_matrix), EPSILON)
 
         # Make each DCT block zero-mean and unit-variance
-        dct_blocks = (dct_blocks - np.mean(dct_blocks, axis=2)[:, :, None]) / (np.std(dct_blocks, axis=2)[:, :, None] + EPSILON)
+        dct_blocks = DctTemplateMatchingDetector.normalize_blocks(dct_blocks)
+
+        # Correlate with all templates at once
+        return np.dot(dct_blocks, template_matrix) / float(len(template_matrix))
+
+    @staticmethod
+    def correlate_quantized(dct_coefs, quantization_table, template_matrix):
+        """
+        Computes the normalized cross-correlation on quantized DCT coefficients without dequantizing them.
+        Because the normalized template is zero-mean, the correlation of a block x with a template t is (x . t) / (63 * (std(x) + EPSILON)).
+        With x = c * q for quantized coefficients c and quantization table q, the quantization table is folded into the template and into the moments: x . t = c . (q * t), mean(x) = c . q / 63, and mean(x^2) = c^2 . q^2 / 63.
+        Blocks are processed in chunks of rows, such that only small floating point copies of the coefficients are created.
+        Blocks whose AC coefficients are all zero, as is common in flat regions, are skipped, and only the remaining blocks are correlated.
+        :param dct_coefs: quantized DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64], usually int16
+        :param quantization_table: quantization table with 64 entries
+        :param template_matrix: normalized templates of shape [63, num_templates]
+        :return: map of size [num_vertical_blocks, num_horizontal_blocks, num_templates]
+        """
+        num_vertical_blocks, num_horizontal_blocks = dct_coefs.shape[:2]
+        num_coefs, num_templates = template_matrix.shape
+
+        # Only consider AC coefficients
+        q = quantization_table.ravel()[1:].astype(np.float64)
+
+        # Fold quantization table into templates and first moment, last column yields the block mean
+        weights = np.concatenate([q[:, None] * template_matrix, q[:, None]], axis=1) / float(num_coefs)
+        # Fold quantization table into second moment
+        weights_squared = q ** 2 / float(num_coefs)
+
+        if kernels.BACKEND_NUMBA == kernels.get_backend():
+            return kernels.numba_kernels().correlate_quantized(dct_coefs, weights, weights_squared, EPSILON)
+
+        # Blocks without any non-zero AC coefficient have zero mean and variance, and thus a correlation of exactly zero
+        correlation = np.zeros((num_vertical_blocks, num_horizontal_blocks, num_templates), dtype=np.float64)
+        chunk_rows = max(1, CHUNK_SIZE_BLOCKS // max(1, num_horizontal_blocks))
+        for row in range(0, num_vertical_blocks, chunk_rows):
+            chunk = dct_coefs[row:row + chunk_rows, :, 1:]
+
+            # Compact the blocks with non-zero AC coefficients into a dense matrix of shape [num_nonzero_blocks, 63]
+            nonzero_mask = np.any(chunk != 0, axis=2)
+            coefs = chunk[nonzero_mask].astype(np.float64)
+            if len(coefs) == 0:
+                continue
+
+            moments = np.dot(coefs, weights)
+            mean = moments[:, -1]
+            mean_squared = np.dot(coefs * coefs, weights_squared)
+            std = np.sqrt(np.maximum(mean_squared - mean ** 2, 0))
+
+            correlation[row:row + chunk_rows][nonzero_mask] = moments[:, :-1] / (std + EPSILON)[:, None]
 
-        # Correlate with DCT blocks
-        correlation = np.dot(dct_blocks, template) / float(len(template))
         return correlation
 
-    def detect_score(self, dct_blocks):
+    def detect_map(self, dct_blocks, quantization_table=None):
+        """
+        Correlates the chroma dimples template with each DCT block using the normalized cross-correlation.
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param quantization_table: (optional) if given, dct_blocks are quantized coefficients that are correlated without building the dequantized array
+        :return: map of size [num_vertical_blocks, num_horizontal_blocks] that indicates how strongly each block is correlated with the template.
+        """
+        # Retrieve template
+        template = self.normalize_template(self.get_template())
+
+        if quantization_table is not None:
+            return self.correlate_quantized(dct_blocks, quantization_table, template[:, None])[:, :, 0]
+
+        return self.correlate_blocks(dct_blocks, template[:, None])[:, :, 0]
+
+    def detect_score(self, dct_blocks, quantization_table=None):
         """
         Averages the scores over all DCT blocks.
         :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param quantization_table: (optional) if given, dct_blocks are quantized coefficients that are correlated without building the dequantized array
         :return: scalar value that indicates how strongly, on average, all blocks are correlated with the expected template.
         """
-        detection_map = self.detect_map(dct_blocks)
+        detection_map = self.detect_map(dct_blocks, quantization_table=quantization_table)
         return np.mean(detection_map)
+
+    def aggregate_map(self, detection_map):
+        """
+        Summarizes a detection map by the statistics of the aggregator.
+        :param detection_map: map as returned by detect_map. For several templates, only the first template is summarized.
+        :return: dict of statistics, see ScoreAggregator.aggregate
+        """
+        if self._aggregator is None:
+            raise ValueError("Detector has no aggregator")
+
+        if detection_map.ndim == 3:
+            detection_map = detection_map[:, :, 0]
+        return self._aggregator.aggregate(detection_map)
+
+    def detect_statistics(self, dct_blocks, quantization_table=None):
+        """
+        Computes the statistics of the aggregator over all DCT blocks.
+        :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param quantization_table: (optional) if given, dct_blocks are quantized coefficients that are correlated without building the dequantized array
+        :return: dict of statistics, see ScoreAggregator.aggregate
+        """
+        return self.aggregate_map(self.detect_map(dct_blocks, quantization_table=quantization_table))
@@ -0,0 +1,122 @@
+from utils import kernels
+import numpy as np
+
+
+# Normalized cross-correlations lie in [-1, 1]
+HISTOGRAM_RANGE = (-1., 1.)
+DEFAULT_NUM_BINS = 100
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+DEFAULT_THRESHOLDS = (0.1, 0.25, 0.5)
+
+# Keys of the statistics returned by ScoreAggregator.aggregate
+STAT_MEAN = "mean"
+STAT_STD = "std"
+STAT_QUANTILE = "q{:g}"
+STAT_ABOVE_THRESHOLD = "above_{:g}"
+STAT_HISTOGRAM = "hist_{:03d}"
+
+
+def aggregate_map(values, num_bins, thresholds):
+    """
+    Computes sums, histogram and above-threshold counts of a detection map
+    :param values: detection map of any shape
+    :param num_bins: number of equally wide histogram bins over HISTOGRAM_RANGE. Values outside the range are counted in the first or last bin.
+    :param thresholds: array of thresholds
+    :return: sum, sum of squares, histogram counts, and number of values strictly above each threshold
+    """
+    low, high = HISTOGRAM_RANGE
+    values = np.ascontiguousarray(values, dtype=np.float64).ravel()
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    if kernels.BACKEND_NUMBA == kernels.get_backend():
+        return kernels.numba_kernels().aggregate_map(values, low, high, num_bins, thresholds)
+
+    bins = np.clip(((values - low) * (num_bins / (high - low))).astype(np.int64), 0, num_bins - 1)
+    histogram = np.bincount(bins, minlength=num_bins)
+    above_counts = np.count_nonzero(values[:, None] > thresholds[None, :], axis=0)
+    return np.sum(values), np.dot(values, values), histogram, above_counts
+
+
+def histogram_quantiles(histogram, quantiles):
+    """
+    Estimates quantiles from a histogram over HISTOGRAM_RANGE by interpolating linearly within the bin that contains each quantile
+    :param histogram: counts per bin
+    :param quantiles: quantiles in range [0, 1]
+    :return: array of estimated quantiles, NaN if the histogram is empty
+    """
+    low, high = HISTOGRAM_RANGE
+    total = np.sum(histogram)
+    if total == 0:
+        return np.full(len(quantiles), np.nan)
+
+    bin_width = (high - low) / len(histogram)
+    cumulative = np.cumsum(histogram)
+
+    estimates = []
+    for quantile in quantiles:
+        rank = quantile * total
+        # First bin whose cumulative count reaches the rank, skipping empty bins
+        i = min(int(np.searchsorted(cumulative, rank, side="left")), len(histogram) - 1)
+        while histogram[i] == 0 and i < len(histogram) - 1:
+            i += 1
+        below = cumulative[i] - histogram[i]
+        fraction = (rank - below) / histogram[i] if histogram[i] > 0 else 0.
+        estimates.append(low + bin_width * (i + min(max(fraction, 0.), 1.)))
+
+    return np.array(estimates)
+
+
+class ScoreAggregator(object):
+    def __init__(self, num_bins=DEFAULT_NUM_BINS, quantiles=DEFAULT_QUANTILES, thresholds=DEFAULT_THRESHOLDS):
+        """
+        Summarizes a detection map by several statistics, which are all derived from a single pass over the map.
+        :param num_bins: number of histogram bins over the range of correlations [-1, 1]. Determines the resolution of the quantiles.
+        :param quantiles: quantiles in range [0, 1] to estimate from the histogram
+        :param thresholds: report the fraction of blocks whose correlation exceeds each of these thresholds
+        """
+        if num_bins < 1:
+            raise ValueError("Histogram requires at least one bin")
+
+        self._num_bins = num_bins
+        self._quantiles = tuple(quantiles)
+        self._thresholds = tuple(thresholds)
+
+    @property
+    def num_bins(self):
+        return self._num_bins
+
+    def aggregate(self, detection_map):
+        """
+        :param detection_map: map of per-block scores of any shape
+        :return: dict of mean, standard deviation, quantiles, above-threshold fractions and histogram counts, keyed by the STAT_* names
+        """
+        num_values = detection_map.size
+        total, total_squared, histogram, above_counts = aggregate_map(detection_map, self._num_bins, self._thresholds)
+
+        if num_values > 0:
+            mean = total / num_values
+            std = np.sqrt(max(total_squared / num_values - mean ** 2, 0.))
+        else:
+            mean = std = np.nan
+
+        statistics = {STAT_MEAN: mean, STAT_STD: std}
+        for quantile, estimate in zip(self._quantiles, histogram_quantiles(histogram, self._quantiles)):
+            statistics[STAT_QUANTILE.format(100 * quantile)] = estimate
+        for threshold, count in zip(self._thresholds, above_counts):
+            statistics[STAT_ABOVE_THRESHOLD.format(threshold)] = count / num_values if num_values > 0 else np.nan
+        for i, count in enumerate(histogram):
+            statistics[STAT_HISTOGRAM.format(i)] = int(count)
+
+        return statistics
+
+    @staticmethod
+    def agreement(cb_map, cr_map):
+        """
+        :param cb_map: per-block scores of the Cb channel
+        :param cr_map: per-block scores of the Cr channel of the same shape
+        :return: Pearson correlation between the per-block scores of both channels, NaN if either map is constant
+        """
+        cb_values = cb_map.ravel() - np.mean(cb_map)
+        cr_values = cr_map.ravel() - np.mean(cr_map)
+        denominator = np.sqrt(np.dot(cb_values, cb_values) * np.dot(cr_values, cr_values))
+        return np.dot(cb_values, cr_values) / denominator if denominator > 0 else np.nan
@@ -0,0 +1,466 @@
+from utils.jpeg_io import MARKER_SOI, MARKER_EOI, MARKER_SOS, MARKER_DHT, STANDALONE_MARKERS, SOF_MARKERS, DEFAULT_HUFFMAN_TABLES
+from utils.jpeg_io import jpeg_bytes_as_file
+from utils.constants import DECODER_DCT_COEFFICIENT, DECODER_CHROMA
+import numpy as np
+import contextlib
+import array
+
+
+DECODERS = [DECODER_DCT_COEFFICIENT, DECODER_CHROMA]
+
+MARKER_DQT = 0xDB
+MARKER_DRI = 0xDD
+# Baseline and extended sequential frames with Huffman coding
+SEQUENTIAL_HUFFMAN_SOF_MARKERS = {0xC0, 0xC1}
+RESTART_MARKERS = set(range(0xD0, 0xD8))
+
+# Natural (row-major) position of the coefficients in zig-zag order, followed by entries that absorb runs past the end of corrupt blocks, as in libjpeg
+ZIGZAG_TO_NATURAL = [
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+] + [63] * 16
+
+# Number of bits by which the decoder looks ahead in the bit stream, the maximum length of a Huffman code
+LOOKAHEAD_BITS = 16
+
+# Array type of the 32-bit bit stream windows
+WINDOW_TYPECODE = "I" if array.array("I").itemsize == 4 else "L"
+
+
+def is_jpeg_bytes(img):
+    """
+    :param img: path to JPEG file, or JPEG file content
+    :return: True if the JPEG file is given by its content
+    """
+    return isinstance(img, (bytes, bytearray, memoryview))
+
+
+@contextlib.contextmanager
+def open_decoder(img, decoder_name=DECODER_DCT_COEFFICIENT):
+    """
+    Decodes a JPEG file with the given backend.
+    ChromaCoefficientDecoder parses JPEG files given as bytes directly. PyCoefficientDecoder only accepts paths, thus it reads JPEG files given as bytes from a memory-backed temporary file, which is removed when the context is left.
+    :param img: path to JPEG file, or JPEG file content as bytes
+    :param decoder_name: DECODER_DCT_COEFFICIENT for PyCoefficientDecoder, which decodes through libjpeg, or DECODER_CHROMA for ChromaCoefficientDecoder
+    :return: context manager that yields the decoder instance
+    """
+    if DECODER_CHROMA == decoder_name:
+        yield ChromaCoefficientDecoder(img)
+    elif DECODER_DCT_COEFFICIENT == decoder_name:
+        from decoder import PyCoefficientDecoder
+        if is_jpeg_bytes(img):
+            with jpeg_bytes_as_file(img) as img_path:
+                yield PyCoefficientDecoder(img_path)
+        else:
+            yield PyCoefficientDecoder(img)
+    else:
+        raise ValueError("Unknown decoder")
+
+
+def build_huffman_lookup_table(counts, values):
+    """
+    Builds a table that decodes a Huffman code with a single lookup of the next 16 bits of the bit stream
+    :param counts: number of codes of each length from 1 to 16 bits
+    :param values: symbols in order of increasing code length
+    :return: list of 2^16 entries, each code length << 8 | symbol of the code that the bit pattern starts with, or 0 if it does not start with any code
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.repeat(np.arange(1, LOOKAHEAD_BITS + 1), counts)
+    if len(lengths) != len(values):
+        raise ValueError("Number of Huffman codes does not match the number of symbols")
+
+    # Canonical codes count up within each length and are shifted left when the length increases
+    codes = np.arange(len(lengths)) - np.repeat(np.cumsum(counts) - counts, counts)
+    first_codes = np.zeros(LOOKAHEAD_BITS, dtype=np.int64)
+    for i in range(1, LOOKAHEAD_BITS):
+        first_codes[i] = (first_codes[i - 1] + counts[i - 1]) << 1
+    codes += first_codes[lengths - 1]
+    if np.any(codes >= 1 << lengths):
+        raise ValueError("Invalid Huffman table")
+
+    # Each code covers all bit patterns that start with it
+    spans = 1 << (LOOKAHEAD_BITS - lengths)
+    starts = np.repeat(codes << (LOOKAHEAD_BITS - lengths), spans)
+    offsets = np.arange(np.sum(spans)) - np.repeat(np.cumsum(spans) - spans, spans)
+
+    lookup_table = np.zeros(1 << LOOKAHEAD_BITS, dtype=np.int64)
+    lookup_table[starts + offsets] = np.repeat((lengths << 8) | values, spans)
+    # Python lists are faster to index with scalars than NumPy arrays
+    return lookup_table.tolist()
+
+
+def _bit_windows(segment):
+    """
+    :param segment: entropy-coded data without stuffed zero bytes as uint8 array
+    :return: array of the 32 bits starting at each byte
+    """
+    # Missing data at the end of a truncated scan reads as zeros
+    padded = np.concatenate([segment, np.zeros(8, dtype=np.uint8)]).astype(np.uint32)
+    windows = (padded[:-3] << 24) | (padded[1:-2] << 16) | (padded[2:-1] << 8) | padded[3:]
+    return array.array(WINDOW_TYPECODE, windows.tobytes())
+
+
+class ChromaCoefficientDecoder(object):
+    def __init__(self, img):
+        """
+        Decodes the quantized DCT coefficients of the chroma components of a sequential Huffman-coded JPEG file in pure Python.
+        Provides the part of the PyCoefficientDecoder interface that score_decoder uses. Scans that contain only the luma component are skipped. In interleaved scans, luma blocks are decoded as far as needed to find the chroma blocks, but not stored.
+        The bit stream is decoded with one lookup per Huffman code into a table indexed by the next 16 bits. Unstuffing, splitting at restart markers and building the tables are vectorized with NumPy.
+        :param img: path to JPEG file, or JPEG file content as bytes
+        """
+        if is_jpeg_bytes(img):
+            self._data = bytes(img)
+        else:
+            with open(img, "rb") as f:
+                self._data = f.read()
+
+        self._height = None
+        self._width = None
+        # Frame components as dicts of identifier, sampling factors and quantization table selector
+        self._components = []
+        # Quantization tables in natural order by table selector
+        self._quantization_tables = dict()
+        # Quantization tables of the components when their scan started, as libjpeg latches them
+        self._component_quantization_tables = dict()
+        # Huffman lookup tables by table class and identifier
+        self._huffman_tables = dict()
+        self._restart_interval = 0
+        # Chroma coefficients by component index
+        self._dct_coefs = dict()
+
+        self._parse()
+
+    @property
+    def max_v_samp_factor(self):
+        return max(component["v"] for component in self._components)
+
+    @property
+    def max_h_samp_factor(self):
+        return max(component["h"] for component in self._components)
+
+    def v_samp_factor(self, c):
+        return self._components[c]["v"]
+
+    def h_samp_factor(self, c):
+        return self._components[c]["h"]
+
+    def get_height_in_blocks(self, c):
+        # Ceiling division
+        return -(-self._height * self.v_samp_factor(c) // (8 * self.max_v_samp_factor))
+
+    def get_width_in_blocks(self, c):
+        return -(-self._width * self.h_samp_factor(c) // (8 * self.max_h_samp_factor))
+
+    def get_dct_coefficients(self, c):
+        """
+        :param c: component index, 1 for Cb or 2 for Cr
+        :return: quantized coefficients as int16 array of shape [height_in_blocks, width_in_blocks, 64], each block in natural order
+        """
+        if c == 0:
+            raise ValueError("Luma coefficients are not decoded")
+        if c not in self._dct_coefs:
+            raise ValueError("Component {} is not part of any scan".format(c))
+        return self._dct_coefs[c]
+
+    def get_quantization_table(self, c):
+        """
+        :param c: component index
+        :return: quantization table as uint16 array of shape [8, 8] in natural order
+        """
+        if c in self._component_quantization_tables:
+            return self._component_quantization_tables[c]
+        return self._quantization_tables[self._components[c]["tq"]]
+
+    def _parse(self):
+        data = self._data
+        if data[:2] != bytes([0xFF, MARKER_SOI]):
+            raise ValueError("Missing SOI marker")
+
+        # Positions of all 0xFF bytes, which the scans need to find stuffed bytes, restart markers and their end
+        self._buffer = np.frombuffer(data, dtype=np.uint8)
+        self._ff_positions = np.flatnonzero(self._buffer[:-1] == 0xFF)
+
+        pos = 2
+        while True:
+            if pos + 2 > len(data) or data[pos] != 0xFF:
+                raise ValueError("Expected marker at position {}".format(pos))
+
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+                continue
+            if marker == MARKER_EOI:
+                break
+            if marker in STANDALONE_MARKERS:
+                pos += 2
+                continue
+
+            if pos + 4 > len(data):
+                raise ValueError("Unexpected end of file")
+            segment_length = (data[pos + 2] << 8) | data[pos + 3]
+            segment = data[pos + 4:pos + 2 + segment_length]
+            pos += 2 + segment_length
+
+            if marker == MARKER_DQT:
+                self._read_quantization_tables(segment)
+            elif marker == MARKER_DHT:
+                self._read_huffman_tables(segment)
+            elif marker == MARKER_DRI:
+                self._restart_interval = (segment[0] << 8) | segment[1]
+            elif marker in SOF_MARKERS:
+                self._read_frame_header(marker, segment)
+            elif marker == MARKER_SOS:
+                pos = self._decode_scan(segment, pos)
+                if pos >= len(data):
+                    # Truncated file
+                    break
+
+        if self._height is None:
+            raise ValueError("Missing frame header")
+
+        # Free the file content
+        self._data = self._buffer = self._ff_positions = None
+
+    def _read_quantization_tables(self, segment):
+        pos = 0
+        while pos < len(segment):
+            precision, table_id = segment[pos] >> 4, segment[pos] & 0x0F
+            if precision == 0:
+                zigzag_table = np.frombuffer(segment, dtype=np.uint8, count=64, offset=pos + 1)
+                pos += 65
+            else:
+                zigzag_table = np.frombuffer(segment, dtype=">u2", count=64, offset=pos + 1)
+                pos += 129
+
+            table = np.zeros(64, dtype=np.uint16)
+            table[ZIGZAG_TO_NATURAL[:64]] = zigzag_table
+            self._quantization_tables[table_id] = table.reshape(8, 8)
+
+    def _read_huffman_tables(self, segment):
+        pos = 0
+        while pos < len(segment):
+            table_id = segment[pos]
+            counts = list(segment[pos + 1:pos + 17])
+            num_values = sum(counts)
+            values = list(segment[pos + 17:pos + 17 + num_values])
+            self._huffman_tables[table_id] = build_huffman_lookup_table(counts, values)
+            pos += 17 + num_values
+
+    def _read_frame_header(self, marker, segment):
+        if marker not in SEQUENTIAL_HUFFMAN_SOF_MARKERS:
+            raise ValueError("Only sequential Huffman-coded JPEG files are supported")
+        if segment[0] != 8:
+            raise ValueError("Only 8-bit samples are supported")
+
+        self._height = (segment[1] << 8) | segment[2]
+        self._width = (segment[3] << 8) | segment[4]
+        if self._height == 0:
+            raise ValueError("Image height defined by DNL marker is not supported")
+
+        self._components = [{"id": segment[6 + 3 * i], "h": segment[7 + 3 * i] >> 4, "v": segment[7 + 3 * i] & 0x0F, "tq": segment[8 + 3 * i]} for i in range(segment[5])]
+
+    def _restart_intervals(self, start):
+        """
+        Finds the entropy-coded data of a scan
+        :param start: position after the scan header
+        :return: list of restart intervals as uint8 arrays without stuffed zero bytes, and position of the marker after the scan
+        """
+        ff_positions = self._ff_positions[np.searchsorted(self._ff_positions, start):]
+        next_bytes = self._buffer[ff_positions + 1]
+        is_restart = (next_bytes >= 0xD0) & (next_bytes <= 0xD7)
+        is_stuffed = next_bytes == 0x00
+
+        # The scan ends at the first marker other than a restart marker
+        end_indices = np.flatnonzero(~is_restart & ~is_stuffed)
+        num_positions = end_indices[0] if len(end_indices) > 0 else len(ff_positions)
+        end = ff_positions[num_positions] if len(end_indices) > 0 else len(self._buffer)
+        ff_positions, is_restart, is_stuffed = ff_positions[:num_positions], is_restart[:num_positions], is_stuffed[:num_positions]
+
+        restart_positions = ff_positions[is_restart]
+        stuffed_positions = ff_positions[is_stuffed] + 1
+
+        intervals = []
+        for interval_start, interval_end in zip(np.concatenate([[start], restart_positions + 2]), np.concatenate([restart_positions, [end]])):
+            interval = self._buffer[interval_start:interval_end]
+            stuffed = stuffed_positions[(stuffed_positions >= interval_start) & (stuffed_positions < interval_end)]
+            intervals.append(np.delete(interval, stuffed - interval_start) if len(stuffed) > 0 else interval)
+
+        return intervals, end
+
+    def _decode_scan(self, segment, start):
+        """
+        :param segment: scan header
+        :param start: position after the scan header
+        :return: position of the marker after the scan
+        """
+        if self._height is None:
+            raise ValueError("Scan before frame header")
+
+        num_scan_components = segment[0]
+        component_ids = [component["id"] for component in self._components]
+        scan_components = []
+        for i in range(num_scan_components):
+            c = component_ids.index(segment[1 + 2 * i])
+            table_ids = segment[2 + 2 * i]
+            scan_components.append((c, table_ids >> 4, table_ids & 0x0F))
+
+        # Only the first scan of each component carries its coefficients in sequential mode. Scans of luma only are skipped without decoding.
+        if all(c == 0 for c, _, _ in scan_components):
+            _, end = self._restart_intervals(start)
+            return end
+
+        # Fall back to the tables of the JPEG standard for files without Huffman tables, as Motion-JPEG frames
+        if len(self._huffman_tables) == 0:
+            for table_id, counts, values in DEFAULT_HUFFMAN_TABLES:
+                self._huffman_tables[table_id] = build_huffman_lookup_table(counts, values)
+
+        if num_scan_components == 1:
+            # Non-interleaved scans cover each block of the component once
+            c = scan_components[0][0]
+            mcus_per_row = self.get_width_in_blocks(c)
+            num_mcu_rows = self.get_height_in_blocks(c)
+            block_layout = [(c, 1, 1)]
+        else:
+            # Interleaved scans cover whole MCUs, including the padding blocks at the right and bottom edges
+            mcus_per_row = -(-self._width // (8 * self.max_h_samp_factor))
+            num_mcu_rows = -(-self._height // (8 * self.max_v_samp_factor))
+            block_layout = [(c, self.v_samp_factor(c), self.h_samp_factor(c)) for c, _, _ in scan_components]
+
+        # Blocks of each MCU as tuples of component index, DC and AC lookup tables, output array or None, number of blocks per row of the output, block offsets within the MCU, and MCU size in blocks
+        mcu_blocks = []
+        outputs = dict()
+        for (c, dc_table_id, ac_table_id), (_, v, h) in zip(scan_components, block_layout):
+            output = None
+            if c > 0:
+                output = array.array("h", bytes(2 * 64 * num_mcu_rows * v * mcus_per_row * h))
+                outputs[c] = (output, num_mcu_rows * v, mcus_per_row * h)
+            self._component_quantization_tables[c] = self._quantization_tables[self._components[c]["tq"]]
+            for block_row in range(v):
+                for block_col in range(h):
+                    mcu_blocks.append((c, self._huffman_tables[dc_table_id], self._huffman_tables[0x10 | ac_table_id], output, mcus_per_row * h, block_row, block_col, v, h))
+
+        intervals, end = self._restart_intervals(start)
+        num_mcus = mcus_per_row * num_mcu_rows
+        mcus_per_interval = self._restart_interval if self._restart_interval > 0 else num_mcus
+        natural = ZIGZAG_TO_NATURAL
+
+        try:
+            for interval_index, interval in enumerate(intervals):
+                first_mcu = interval_index * mcus_per_interval
+                if first_mcu >= num_mcus:
+                    break
+
+                windows = _bit_windows(interval)
+                p = 0
+                predictions = [0] * len(self._components)
+
+                for mcu in range(first_mcu, min(first_mcu + mcus_per_interval, num_mcus)):
+                    mcu_row, mcu_col = divmod(mcu, mcus_per_row)
+
+                    for c, dc_table, ac_table, output, row_length, block_row, block_col, v, h in mcu_blocks:
+                        # DC coefficient is coded as difference to the previous block of the component
+                        entry = dc_table[(windows[p >> 3] >> (16 - (p & 7))) & 0xFFFF]
+                        p += entry >> 8
+                        s = entry & 0xFF
+                        if s:
+                            bits = (windows[p >> 3] >> (32 - (p & 7) - s)) & ((1 << s) - 1)
+                            p += s
+                            predictions[c] += bits if bits >> (s - 1) else bits - (1 << s) + 1
+
+                        offset = 0
+                        if output is not None:
+                            offset = ((mcu_row * v + block_row) * row_length + mcu_col * h + block_col) << 6
+                            output[offset] = predictions[c]
+
+                        # AC coefficients are coded as run length of zeros and size of the next non-zero value
+                        k = 1
+                        while k < 64:
+                            entry = ac_table[(windows[p >> 3] >> (16 - (p & 7))) & 0xFFFF]
+                            p += entry >> 8
+                            s = entry & 0x0F
+                            if s == 0:
+                                if entry & 0xFF != 0xF0:
+                                    # End of block
+                                    break
+                                k += 16
+                                continue
+
+                            k += (entry >> 4) & 0x0F
+                            if output is not None:
+                                bits = (windows[p >> 3] >> (32 - (p & 7) - s)) & ((1 << s) - 1)
+                                output[offset + natural[k]] = bits if bits >> (s - 1) else bits - (1 << s) + 1
+                            p += s
+                            k += 1
+
+        except IndexError:
+            raise ValueError("Corrupt entropy-coded data")
+
+        for c, (output, padded_height_in_blocks, padded_width_in_blocks) in outputs.items():
+            dct_coefs = np.frombuffer(output, dtype=np.int16).reshape(padded_height_in_blocks, padded_width_in_blocks, 64)
+            self._dct_coefs[c] = np.ascontiguousarray(dct_coefs[:self.get_height_in_blocks(c), :self.get_width_in_blocks(c)])
+
+        return end
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    import sys
+    import os
+
+    # Cross-check against PyCoefficientDecoder on synthetic images, and optionally on the JPEG files of a given directory
+    from decoder import PyCoefficientDecoder
+    from PIL import Image
+
+    def cross_check(img_filename):
+        decoder = ChromaCoefficientDecoder(img_filename)
+        # Decoding from memory gives the same coefficients
+        with open(img_filename, "rb") as f:
+            assert np.array_equal(ChromaCoefficientDecoder(f.read()).get_dct_coefficients(1), decoder.get_dct_coefficients(1))
+        reference_decoder = PyCoefficientDecoder(img_filename)
+        for c in [1, 2]:
+            assert decoder.get_height_in_blocks(c) == reference_decoder.get_height_in_blocks(c)
+            assert decoder.get_width_in_blocks(c) == reference_decoder.get_width_in_blocks(c)
+            assert (decoder.v_samp_factor(c), decoder.h_samp_factor(c)) == (reference_decoder.v_samp_factor(c), reference_decoder.h_samp_factor(c))
+            assert np.array_equal(decoder.get_quantization_table(c).ravel(), reference_decoder.get_quantization_table(c).ravel())
+            reference_dct_coefs = reference_decoder.get_dct_coefficients(c).reshape(decoder.get_height_in_blocks(c), decoder.get_width_in_blocks(c), 64)
+            assert np.array_equal(decoder.get_dct_coefficients(c), reference_dct_coefs), "Coefficients of component {} of {} differ".format(c, img_filename)
+        assert (decoder.max_v_samp_factor, decoder.max_h_samp_factor) == (reference_decoder.max_v_samp_factor, reference_decoder.max_h_samp_factor)
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (height, width) in enumerate([(8, 8), (17, 33), (61, 97), (128, 96)]):
+            # Smooth image with noise, such that all coefficient sizes occur
+            img = np.clip(np.linspace(0, 255, width)[None, :, None] + rng.normal(0, 40, size=(height, width, 3)), 0, 255).astype(np.uint8)
+            for subsampling in [0, 1, 2]:
+                for quality, optimize in [(50, False), (95, True)]:
+                    img_filename = os.path.join(tmp_dir, "{}_{}_{}.jpg".format(i, subsampling, quality))
+                    Image.fromarray(img).save(img_filename, quality=quality, subsampling=subsampling, optimize=optimize)
+                    cross_check(img_filename)
+
+        # Progressive files are rejected
+        Image.fromarray(img).save(img_filename, progressive=True)
+        try:
+            ChromaCoefficientDecoder(img_filename)
+            assert False, "Progressive file was accepted"
+        except ValueError:
+            pass
+
+    if len(sys.argv) > 1:
+        img_filenames = sorted(os.path.join(dp, f) for dp, dn, filenames in os.walk(sys.argv[1]) for f in filenames if f.lower().endswith((".jpg", ".jpeg")))
+        num_checked = 0
+        start = time.perf_counter()
+        for img_filename in img_filenames:
+            try:
+                PyCoefficientDecoder(img_filename).get_dct_coefficients(1)
+            except Exception:
+                # Files that libjpeg cannot decode either are skipped
+                print("Skipping {}, which PyCoefficientDecoder cannot decode".format(img_filename))
+                continue
+            cross_check(img_filename)
+            num_checked += 1
+        print("Cross-checked {} files in {:.1f}s".format(num_checked, time.perf_counter() - start))
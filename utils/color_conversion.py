@@ -1,11 +1,15 @@
 import numpy as np
 
 
+# Number of rows to convert at once
+DEFAULT_CHUNK_ROWS = 256
+
+
 def ycbcr_to_rgb(img):
     ycbcr_to_rgb_mat = np.array([[1, 0, 1.402], [1, -0.3441, -0.7141], [1, 1.772, 0]], dtype=np.float32)
-    subtraction_mat = 128 * np.ones_like(img, dtype=np.int)
-    subtraction_mat[..., 0] = 0
-    return np.dot(img - subtraction_mat, ycbcr_to_rgb_mat.T)
+    # Offset of the chroma channels, broadcast over all pixels
+    offset = np.array([0, 128, 128])
+    return np.dot(img - offset, ycbcr_to_rgb_mat.T)
 
 
 def rgb_to_ycbcr(img):
@@ -15,9 +19,41 @@ def rgb_to_ycbcr(img):
     return ycbcr
 
 
+def rgb_to_ycbcr_chunked(img, out=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Converts an RGB image to YCbCr in float32 like rgb_to_ycbcr, but only a few rows at a time, such that intermediate arrays stay small.
+    :param img: RGB image of shape [height, width, 3]
+    :param out: (optional) C-contiguous float32 array of shape [height, width, 3] to write the result to. Can be img itself to convert a float32 image in place.
+    :param chunk_rows: number of rows to convert at once
+    :return: YCbCr image as float32 array of shape [height, width, 3]
+    """
+    rgb_to_ycbcr_mat = np.array([[.299, .587, .114], [-.1687, -.3313, .5], [.5, -.4187, -0.0813]], dtype=np.float32)
+
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    elif out.shape != img.shape or out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise ValueError("Output must be a C-contiguous float32 array of the same shape as the image")
+
+    for top in range(0, img.shape[0], chunk_rows):
+        # Copy the rows, such that converting in place does not overwrite pixels that are still needed
+        rows = np.array(img[top:top + chunk_rows], dtype=np.float32)
+        np.dot(rows, rgb_to_ycbcr_mat.T, out=out[top:top + chunk_rows])
+        out[top:top + chunk_rows, :, 1:] += 128
+
+    return out
+
+
 if __name__ == "__main__":
     original_rgb = np.random.random_integers(0, 255, size=(60, 90, 3))
     ycbcr = rgb_to_ycbcr(original_rgb)
     recovered_rgb = ycbcr_to_rgb(ycbcr)
     diff = original_rgb - recovered_rgb
     assert np.max(np.abs(diff)) < 1.
+
+    # Chunked conversion matches the conversion of the whole image, also in place
+    original_rgb = original_rgb.astype(np.uint8)
+    ycbcr = rgb_to_ycbcr(original_rgb)
+    assert np.allclose(rgb_to_ycbcr_chunked(original_rgb, chunk_rows=7), ycbcr, rtol=0, atol=1e-4)
+    rgb = original_rgb.astype(np.float32)
+    assert rgb_to_ycbcr_chunked(rgb, out=rgb, chunk_rows=16) is rgb
+    assert np.allclose(rgb, ycbcr, rtol=0, atol=1e-4)
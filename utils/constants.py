@@ -1,4 +1,3 @@
-import getpass
 import os
 
 
@@ -16,6 +15,48 @@ COL_ESTIMATED_QUALITY_FACTOR = "estimated_quality_factor"
 COL_ESTIMATED_QUALITY_FACTOR_DISTANCE = "estimated_quality_factor_distance"
 COL_CROP_TOP = "crop_top"
 COL_CROP_LEFT = "crop_left"
+COL_DUPLICATE_OF = "duplicate_of"
+COL_ENCODER = "encoder"
+COL_QUALITY = "quality"
+COL_SAMPLE = "sample"
+COL_CB_BEST_TEMPLATE = "cb_best_template"
+COL_CR_BEST_TEMPLATE = "cr_best_template"
+# Per-template score columns, formatted with the template name
+COL_CB_TEMPLATE_SCORE = "cb_score_{}"
+COL_CR_TEMPLATE_SCORE = "cr_score_{}"
+# Per-region-of-interest columns, formatted with the index of the region
+COL_CB_ROI_SCORE = "cb_roi_score_{}"
+COL_CR_ROI_SCORE = "cr_roi_score_{}"
+COL_CB_ROI_COMPLEMENT_SCORE = "cb_roi_complement_score_{}"
+COL_CR_ROI_COMPLEMENT_SCORE = "cr_roi_complement_score_{}"
+COL_ROI_NUM_BLOCKS = "roi_num_blocks_{}"
+COL_ROI_COMPLEMENT_NUM_BLOCKS = "roi_complement_num_blocks_{}"
+# Per-channel statistics columns, formatted with the name of the statistic
+COL_CB_STATISTIC = "cb_{}"
+COL_CR_STATISTIC = "cr_{}"
+COL_CB_CR_AGREEMENT = "cb_cr_agreement"
+# Motion-JPEG frames
+COL_FRAME = "frame"
+COL_CB_RUNNING_MEAN = "cb_running_mean"
+COL_CR_RUNNING_MEAN = "cr_running_mean"
+COL_CB_RUNNING_STD = "cb_running_std"
+COL_CR_RUNNING_STD = "cr_running_std"
+# Verification against the reference implementations
+COL_VERIFIED = "verified"
+COL_CB_REFERENCE_SCORE = "cb_reference_score"
+COL_CR_REFERENCE_SCORE = "cr_reference_score"
+COL_CB_SCORE_DIFFERENCE = "cb_score_difference"
+COL_CR_SCORE_DIFFERENCE = "cr_score_difference"
+COL_SCORE_SECONDS = "score_seconds"
+COL_REFERENCE_SCORE_SECONDS = "reference_score_seconds"
+# Pixel-domain upsampling analysis of decoded images
+COL_HEIGHT = "height"
+COL_WIDTH = "width"
+COL_CB_SIMPLE_UPSAMPLING_SCORE = "cb_simple_upsampling_score"
+COL_CR_SIMPLE_UPSAMPLING_SCORE = "cr_simple_upsampling_score"
+COL_SIMPLE_UPSAMPLING = "simple_upsampling"
+# Per-group summary of the scores
+COL_NUM_IMAGES = "num_images"
 
 # String constants used throughout code
 DCRAW_EXECUTABLE_KEY = "dcraw_exectuable"
@@ -32,20 +73,53 @@ LIBJPEG_TURBO = "libjpeg_turbo"
 LIBJPEG = "libjpeg"
 MOZJPEG = "mozjpeg"
 PILLOW = "pillow"
+DECODER_DCT_COEFFICIENT = "dct_coefficient_decoder"
+DECODER_CHROMA = "chroma"
 
 
-# Paths to executables
-constants = dict()
+def _find_executables():
+    """
+    Selects location of executables depending on machine
+    :return: dict mapping executable keys to paths
+    """
+    executables = dict()
 
-nodename = os.uname().nodename
-username = getpass.getuser()
+    if "faui1-154" == os.uname().nodename:
+        executables[LIBJPEG_CJPEG_EXECUTABLE_KEY] = "/opt/jpeg-9a/build/bin/cjpeg"
+        executables[LIBJPEG_DJPEG_EXECUTABLE_KEY] = "/opt/jpeg-9a/build/bin/djpeg"
+        executables[LIBJPEG_TURBO_CJPEG_EXECUTABLE_KEY] = "/opt/libjpeg-turbo-2.0.1/build/cjpeg"
+        executables[LIBJPEG_TURBO_DJPEG_EXECUTABLE_KEY] = "/opt/libjpeg-turbo-2.0.1/build/djpeg"
+        executables[MOZJPEG_CJPEG_EXECUTABLE_KEY] = "/opt/mozjpeg-3.3.1/build/cjpeg"
+        executables[MOZJPEG_DJPEG_EXECUTABLE_KEY] = "/opt/mozjpeg-3.3.1/build/djpeg"
+        executables[DCRAW_EXECUTABLE_KEY] = "/opt/dcraw"
 
-# Select location of executables depending on machine and user's name
-if "faui1-154" == nodename:
-    constants[LIBJPEG_CJPEG_EXECUTABLE_KEY] = "/opt/jpeg-9a/build/bin/cjpeg"
-    constants[LIBJPEG_DJPEG_EXECUTABLE_KEY] = "/opt/jpeg-9a/build/bin/djpeg"
-    constants[LIBJPEG_TURBO_CJPEG_EXECUTABLE_KEY] = "/opt/libjpeg-turbo-2.0.1/build/cjpeg"
-    constants[LIBJPEG_TURBO_DJPEG_EXECUTABLE_KEY] = "/opt/libjpeg-turbo-2.0.1/build/djpeg"
-    constants[MOZJPEG_CJPEG_EXECUTABLE_KEY] = "/opt/mozjpeg-3.3.1/build/cjpeg"
-    constants[MOZJPEG_DJPEG_EXECUTABLE_KEY] = "/opt/mozjpeg-3.3.1/build/djpeg"
-    constants[DCRAW_EXECUTABLE_KEY] = "/opt/dcraw"
+    return executables
+
+
+# Paths to executables, looked up on first use, which keeps importing this module cheap
+_executables = None
+
+
+def _get_executables():
+    global _executables
+    if _executables is None:
+        _executables = _find_executables()
+    return _executables
+
+
+def get_executable(key):
+    """
+    :param key: one of the *_EXECUTABLE_KEY constants
+    :return: path to the executable
+    :raises KeyError: if no path is configured for this machine
+    """
+    return _get_executables()[key]
+
+
+def set_executable(key, path):
+    """
+    Overrides the path to an executable for this process
+    :param key: one of the *_EXECUTABLE_KEY constants
+    :param path: path to the executable
+    """
+    _get_executables()[key] = path
@@ -0,0 +1,60 @@
+import functools
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def dct_matrix(n=8):
+    """
+    Computes the orthonormal DCT-II basis, such that D @ x equals scipy.fftpack.dct(x, norm="ortho") for a vector x of length n.
+    :param n: transform size
+    :return: n x n matrix D with the basis functions in its rows
+    """
+    k = np.arange(n)
+    d = np.sqrt(2. / n) * np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    d[0] /= np.sqrt(2.)
+    d.flags.writeable = False
+    return d
+
+
+def dct_2d(blocks):
+    """
+    Orthonormal 2-D DCT of all blocks at once without going through scipy
+    :param blocks: array of shape [..., n, n] in spatial domain
+    :return: array of shape [..., n, n] of DCT coefficients
+    """
+    d = dct_matrix(blocks.shape[-1])
+    return d @ blocks @ d.T
+
+
+def idct_2d(blocks):
+    """
+    Inverse of dct_2d
+    :param blocks: array of shape [..., n, n] of DCT coefficients
+    :return: array of shape [..., n, n] in spatial domain
+    """
+    d = dct_matrix(blocks.shape[-1])
+    return d.T @ blocks @ d
+
+
+def blocks_to_channel(dct_blocks):
+    """
+    Transforms 8x8 DCT blocks into spatial domain and arranges them as image channel
+    :param dct_blocks: DCT coefficients of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :return: image channel of shape [num_vertical_blocks * 8, num_horizontal_blocks * 8]
+    """
+    num_vertical_blocks, num_horizontal_blocks = dct_blocks.shape[:2]
+    blocks_8x8 = idct_2d(dct_blocks.reshape(num_vertical_blocks, num_horizontal_blocks, 8, 8).astype(np.float64))
+    return blocks_8x8.transpose(0, 2, 1, 3).reshape(num_vertical_blocks * 8, num_horizontal_blocks * 8)
+
+
+def channel_to_blocks(channel):
+    """
+    Splits an image channel into 8x8 blocks and transforms them into DCT domain
+    :param channel: image channel whose height and width are multiples of 8
+    :return: DCT coefficients of shape [height // 8, width // 8, 64]
+    """
+    height, width = channel.shape
+    num_vertical_blocks = height // 8
+    num_horizontal_blocks = width // 8
+    blocks_8x8 = channel.reshape(num_vertical_blocks, 8, num_horizontal_blocks, 8).transpose(0, 2, 1, 3)
+    return dct_2d(blocks_8x8).reshape(num_vertical_blocks, num_horizontal_blocks, 64)
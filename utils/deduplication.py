@@ -0,0 +1,69 @@
+import collections
+import hashlib
+import os
+
+
+# Number of bytes from the beginning of a file to hash before hashing the full file
+PARTIAL_HASH_SIZE = 1 << 16
+
+# Number of bytes to read at once when hashing a full file
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def partial_hash(filename, num_bytes=PARTIAL_HASH_SIZE):
+    """
+    :param filename: path to file
+    :param num_bytes: number of bytes from the beginning of the file to hash
+    :return: hex digest of the first bytes of the file
+    """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read(num_bytes)).hexdigest()
+
+
+def full_hash(filename):
+    """
+    :param filename: path to file
+    :return: hex digest of the whole file
+    """
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def content_fingerprint(data):
+    """
+    :param data: file content as bytes
+    :return: fingerprint of the file content
+    """
+    return len(data), hashlib.sha1(data).hexdigest()
+
+
+def _group_by(filenames, key):
+    groups = collections.defaultdict(list)
+    for filename in filenames:
+        groups[key(filename)].append(filename)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicate_files(filenames):
+    """
+    Finds byte-identical files. Files are first grouped by size, then files of equal size by a hash of their first bytes, and only files that still collide are hashed completely.
+    :param filenames: list of file paths
+    :return: dict that maps each duplicate to the first file in the given order with identical content. Files without duplicates and the first file of each group of duplicates are not contained.
+    """
+    duplicates = dict()
+    for same_size in _group_by(filenames, os.path.getsize):
+        for same_partial_hash in _group_by(same_size, partial_hash):
+            # Files smaller than the partial hash size are already known to be identical
+            if os.path.getsize(same_partial_hash[0]) <= PARTIAL_HASH_SIZE:
+                same_contents = [same_partial_hash]
+            else:
+                same_contents = _group_by(same_partial_hash, full_hash)
+
+            for same_content in same_contents:
+                for filename in same_content[1:]:
+                    duplicates[filename] = same_content[0]
+
+    return duplicates
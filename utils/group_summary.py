@@ -0,0 +1,247 @@
+from utils.constants import COL_EXIF_MAKE, COL_EXIF_MODEL, COL_ESTIMATED_QUALITY_FACTOR, COL_CB_SCORE, COL_CR_SCORE, COL_NUM_IMAGES
+import numpy as np
+import os
+
+
+# Images are grouped by camera and quality factor
+GROUP_COLUMNS = [COL_EXIF_MAKE, COL_EXIF_MODEL, COL_ESTIMATED_QUALITY_FACTOR]
+SCORE_COLUMNS = [COL_CB_SCORE, COL_CR_SCORE]
+
+# Scores are means of normalized cross-correlations and lie in [-1, 1]
+HISTOGRAM_RANGE = (-1., 1.)
+DEFAULT_NUM_BINS = 40
+
+# Summary columns per score column
+SUMMARY_COUNT = "{}_count"
+SUMMARY_MEAN = "{}_mean"
+SUMMARY_VARIANCE = "{}_variance"
+SUMMARY_MIN = "{}_min"
+SUMMARY_MAX = "{}_max"
+SUMMARY_HISTOGRAM_PREFIX = "{}_hist_"
+SUMMARY_HISTOGRAM = SUMMARY_HISTOGRAM_PREFIX + "{:03d}"
+
+SUMMARY_SUFFIX = "_summary.csv"
+
+
+def get_summary_filename(output_filename):
+    """
+    :param output_filename: path to the main output file
+    :return: path to the summary file next to it
+    """
+    return os.path.splitext(output_filename)[0] + SUMMARY_SUFFIX
+
+
+class _ScoreReducer(object):
+    def __init__(self, num_bins):
+        """
+        Maintains count, mean, sum of squared deviations from the mean, extrema and histogram of a stream of scores. NaN scores are skipped.
+        :param num_bins: number of equally wide histogram bins over HISTOGRAM_RANGE. Scores outside the range are counted in the first or last bin.
+        """
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = np.zeros(num_bins, dtype=np.int64)
+
+    def update(self, value):
+        if value is None or np.isnan(value):
+            return
+
+        # Welford's update, which is stable even for many scores close to the mean
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        low, high = HISTOGRAM_RANGE
+        num_bins = len(self.histogram)
+        self.histogram[min(max(int((value - low) * (num_bins / (high - low))), 0), num_bins - 1)] += 1
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+
+        # Pairwise combination of Chan et al.
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+
+    def columns(self, col):
+        """
+        :param col: name of the score column
+        :return: dict of summary columns
+        """
+        columns = {
+            SUMMARY_COUNT.format(col): self.count,
+            SUMMARY_MEAN.format(col): self.mean if self.count > 0 else np.nan,
+            # Sample variance, as pandas computes it
+            SUMMARY_VARIANCE.format(col): self.m2 / (self.count - 1) if self.count > 1 else np.nan,
+            SUMMARY_MIN.format(col): self.min if self.count > 0 else np.nan,
+            SUMMARY_MAX.format(col): self.max if self.count > 0 else np.nan,
+        }
+        for i, count in enumerate(self.histogram):
+            columns[SUMMARY_HISTOGRAM.format(col, i)] = int(count)
+
+        return columns
+
+    @classmethod
+    def from_columns(cls, summary_row, col, num_bins):
+        """
+        Restores the reducer from a row of a summary file
+        :param summary_row: dict-like row as written by columns
+        :param col: name of the score column
+        :param num_bins: number of histogram bins
+        :return: reducer instance
+        """
+        reducer = cls(num_bins)
+        reducer.count = int(summary_row[SUMMARY_COUNT.format(col)])
+        if reducer.count > 0:
+            reducer.mean = float(summary_row[SUMMARY_MEAN.format(col)])
+            reducer.m2 = float(summary_row[SUMMARY_VARIANCE.format(col)]) * (reducer.count - 1) if reducer.count > 1 else 0.
+            reducer.min = float(summary_row[SUMMARY_MIN.format(col)])
+            reducer.max = float(summary_row[SUMMARY_MAX.format(col)])
+        reducer.histogram = np.array([summary_row[SUMMARY_HISTOGRAM.format(col, i)] for i in range(num_bins)], dtype=np.int64)
+        return reducer
+
+
+class GroupSummary(object):
+    def __init__(self, num_bins=DEFAULT_NUM_BINS):
+        """
+        Summarizes the Cb and Cr scores per camera make, camera model and estimated quality factor while the results are written, such that the per-group statistics need no second pass over the results table.
+        Summaries of different runs, e.g., of the shards of a data set, can be merged. Their statistics then equal those of a single run over all images.
+        :param num_bins: number of histogram bins over the score range [-1, 1]
+        """
+        if num_bins < 1:
+            raise ValueError("Histogram requires at least one bin")
+
+        self._num_bins = num_bins
+        # Maps group keys to the number of images and the reducer of each score column
+        self._groups = dict()
+
+    @property
+    def num_bins(self):
+        return self._num_bins
+
+    @staticmethod
+    def _group_key(row):
+        # Missing make or model are empty strings in the results table, and quality factors are integers
+        make, model, quality_factor = [row.get(col) for col in GROUP_COLUMNS]
+        make = "" if make is None else str(make)
+        model = "" if model is None else str(model)
+        return make, model, int(quality_factor)
+
+    def _group(self, key):
+        if key not in self._groups:
+            self._groups[key] = [0, {col: _ScoreReducer(self._num_bins) for col in SCORE_COLUMNS}]
+        return self._groups[key]
+
+    def update(self, row):
+        """
+        Adds a result row
+        :param row: dict with at least the group and score columns
+        """
+        group = self._group(self._group_key(row))
+        group[0] += 1
+        for col, reducer in group[1].items():
+            reducer.update(row.get(col))
+
+    def merge(self, other):
+        """
+        Adds the statistics of another summary
+        :param other: GroupSummary with the same number of bins
+        """
+        if other.num_bins != self._num_bins:
+            raise ValueError("Cannot merge summaries with different numbers of bins")
+
+        for key, (num_images, reducers) in other._groups.items():
+            group = self._group(key)
+            group[0] += num_images
+            for col, reducer in reducers.items():
+                group[1][col].merge(reducer)
+
+    def to_frame(self):
+        """
+        :return: data frame with one row per group, sorted by make, model and quality factor
+        """
+        import pandas as pd
+
+        rows = []
+        for key in sorted(self._groups):
+            num_images, reducers = self._groups[key]
+            row = dict(zip(GROUP_COLUMNS, key))
+            row[COL_NUM_IMAGES] = num_images
+            for col in SCORE_COLUMNS:
+                row.update(reducers[col].columns(col))
+            rows.append(row)
+
+        columns = GROUP_COLUMNS + [COL_NUM_IMAGES] + [summary_col for col in SCORE_COLUMNS for summary_col in _ScoreReducer(self._num_bins).columns(col)]
+        return pd.DataFrame(rows, columns=columns)
+
+    def write(self, summary_filename):
+        """
+        :param summary_filename: path to output csv file
+        """
+        self.to_frame().to_csv(summary_filename, index=False)
+
+    @classmethod
+    def read(cls, summary_filename):
+        """
+        Restores a summary from a file written by write, such that it can be merged with other summaries
+        :param summary_filename: path to summary csv file
+        :return: GroupSummary instance
+        """
+        import pandas as pd
+
+        # Missing make or model stay empty strings
+        df = pd.read_csv(summary_filename, keep_default_na=False, float_precision="round_trip", dtype={COL_EXIF_MAKE: str, COL_EXIF_MODEL: str})
+        histogram_prefix = SUMMARY_HISTOGRAM_PREFIX.format(SCORE_COLUMNS[0])
+        num_bins = sum(1 for col in df.columns if col.startswith(histogram_prefix))
+
+        summary = cls(num_bins=num_bins)
+        for _, summary_row in df.iterrows():
+            key = summary._group_key(summary_row)
+            summary._groups[key] = [int(summary_row[COL_NUM_IMAGES]), {col: _ScoreReducer.from_columns(summary_row, col, num_bins) for col in SCORE_COLUMNS}]
+
+        return summary
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    rows = [{COL_EXIF_MAKE: make, COL_EXIF_MODEL: "", COL_ESTIMATED_QUALITY_FACTOR: quality_factor, COL_CB_SCORE: cb_score, COL_CR_SCORE: np.nan}
+            for make, quality_factor, cb_score in zip(rng.choice(["A", "B"], 1000), rng.choice([75, 90], 1000), rng.normal(0.3, 0.2, 1000))]
+
+    # Merging summaries of two halves equals the summary of all rows
+    summary = GroupSummary()
+    first_half, second_half = GroupSummary(), GroupSummary()
+    for i, row in enumerate(rows):
+        summary.update(row)
+        (first_half if i < 400 else second_half).update(row)
+    first_half.merge(second_half)
+
+    df = summary.to_frame()
+    merged_df = first_half.to_frame()
+    assert np.allclose(df.select_dtypes("number").values, merged_df.select_dtypes("number").values, rtol=1e-12, equal_nan=True)
+
+    # Statistics agree with those computed over the whole table
+    for _, summary_row in df.iterrows():
+        cb_scores = np.array([row[COL_CB_SCORE] for row in rows if row[COL_EXIF_MAKE] == summary_row[COL_EXIF_MAKE] and row[COL_ESTIMATED_QUALITY_FACTOR] == summary_row[COL_ESTIMATED_QUALITY_FACTOR]])
+        assert summary_row[COL_NUM_IMAGES] == len(cb_scores)
+        assert np.isclose(summary_row[SUMMARY_MEAN.format(COL_CB_SCORE)], np.mean(cb_scores), rtol=1e-12)
+        assert np.isclose(summary_row[SUMMARY_VARIANCE.format(COL_CB_SCORE)], np.var(cb_scores, ddof=1), rtol=1e-12)
+        assert summary_row[SUMMARY_COUNT.format(COL_CR_SCORE)] == 0
+
+    # Written summaries are restored exactly
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        summary.write(tmp_dir + "/summary.csv")
+        restored_df = GroupSummary.read(tmp_dir + "/summary.csv").to_frame()
+        assert df.equals(restored_df)
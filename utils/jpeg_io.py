@@ -0,0 +1,426 @@
+import contextlib
+import tempfile
+import tarfile
+import zipfile
+import struct
+import os
+import re
+
+
+# Prefer a memory-backed directory for temporary files if available
+TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+@contextlib.contextmanager
+def jpeg_bytes_as_file(data, suffix=".jpg"):
+    """
+    Makes an in-memory JPEG file available under a file name, for libraries that only accept paths.
+    The temporary file is created in a memory-backed directory if possible and removed when the context is left.
+    :param data: JPEG file content as bytes
+    :param suffix: file name suffix of the temporary file
+    :return: path to temporary file
+    """
+    with tempfile.NamedTemporaryFile(suffix=suffix, dir=TMP_DIR) as f:
+        f.write(data)
+        f.flush()
+        yield f.name
+
+
+# Separates archive path and member name in reported file names, e.g., archive.tar!member/path.jpg
+ARCHIVE_SEPARATOR = "!"
+
+# Input name that denotes a stream of concatenated JPEG files on stdin
+STDIN = "-"
+
+# JPEG markers
+MARKER_SOI = 0xD8
+MARKER_EOI = 0xD9
+MARKER_SOS = 0xDA
+MARKER_DHT = 0xC4
+MARKER_APP1 = 0xE1
+# Markers without length field
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+# Start-of-frame markers SOF0 to SOF15, except for DHT, JPG and DAC
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Exif segment identifier, followed by a TIFF structure, and the IFD0 tags and type of camera make and model
+EXIF_HEADER = b"Exif\x00\x00"
+EXIF_TAG_MAKE = 0x010F
+EXIF_TAG_MODEL = 0x0110
+EXIF_TYPE_ASCII = 2
+
+# Huffman tables of the JPEG standard (ITU T.81, Annex K.3) as (table class and identifier, number of codes per length, values). Motion-JPEG frames often omit their Huffman tables and rely on these.
+DEFAULT_HUFFMAN_TABLES = [
+    # DC luminance
+    (0x00, [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], list(range(12))),
+    # DC chrominance
+    (0x01, [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], list(range(12))),
+    # AC luminance
+    (0x10, [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7D], [
+        0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+        0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xA1, 0x08, 0x23, 0x42, 0xB1, 0xC1, 0x15, 0x52, 0xD1, 0xF0,
+        0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0A, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x25, 0x26, 0x27, 0x28,
+        0x29, 0x2A, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+        0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+        0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7A, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+        0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5, 0xA6, 0xA7,
+        0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3, 0xC4, 0xC5,
+        0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA, 0xE1, 0xE2,
+        0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xF1, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+        0xF9, 0xFA,
+    ]),
+    # AC chrominance
+    (0x11, [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77], [
+        0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+        0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xA1, 0xB1, 0xC1, 0x09, 0x23, 0x33, 0x52, 0xF0,
+        0x15, 0x62, 0x72, 0xD1, 0x0A, 0x16, 0x24, 0x34, 0xE1, 0x25, 0xF1, 0x17, 0x18, 0x19, 0x1A, 0x26,
+        0x27, 0x28, 0x29, 0x2A, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+        0x49, 0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+        0x69, 0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7A, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+        0x88, 0x89, 0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5,
+        0xA6, 0xA7, 0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3,
+        0xC4, 0xC5, 0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA,
+        0xE2, 0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+        0xF9, 0xFA,
+    ]),
+]
+
+# Number of bytes to read from a stream at once
+STREAM_CHUNK_SIZE = 1 << 20
+
+
+def is_archive(filename):
+    """
+    :param filename: path to file
+    :return: True if the given file is a tar or zip archive
+    """
+    return os.path.isfile(filename) and (zipfile.is_zipfile(filename) or tarfile.is_tarfile(filename))
+
+
+def iterate_archive(archive_filename, search_string=".(jpg|jpeg)$", read_data=True, keep=None):
+    """
+    Iterates over the members of a tar or zip archive without extracting them to disk.
+    Tar archives are read sequentially, so that compressed archives need to be decompressed only once. Members are thus yielded in archive order.
+    :param archive_filename: path to tar or zip archive
+    :param search_string: regular expression that the lower-case member name must match
+    :param read_data: whether to read the members' content. If False, yields None instead.
+    :param keep: (optional) predicate on the member name. Members for which it returns False are skipped before their content is read, e.g., to select a shard.
+    :return: generator of 2-tuples of member name and member content as bytes
+    """
+    if zipfile.is_zipfile(archive_filename):
+        with zipfile.ZipFile(archive_filename) as f:
+            for member_name in sorted(f.namelist()):
+                if member_name.endswith("/") or re.search(search_string, member_name.lower()) is None:
+                    continue
+                if keep is not None and not keep(member_name):
+                    continue
+                yield member_name, f.read(member_name) if read_data else None
+        return
+
+    with tarfile.open(archive_filename, mode="r|*") as f:
+        for member in f:
+            if not member.isfile() or re.search(search_string, member.name.lower()) is None:
+                continue
+            # The stream skips over the content of members that are not extracted
+            if keep is not None and not keep(member.name):
+                continue
+            yield member.name, f.extractfile(member).read() if read_data else None
+
+
+def read_frame_header(f):
+    """
+    Reads the image size and the sampling factors from the frame header without decoding the image.
+    Segments before the frame header are skipped without reading them.
+    :param f: seekable binary file object positioned at the SOI marker
+    :return: height, width, and list of 2-tuples of horizontal and vertical sampling factor per component, as 3-tuple
+    :raises ValueError: if the file ends or the first scan starts before the frame header
+    """
+    if f.read(2) != b"\xff\xd8":
+        raise ValueError("Missing SOI marker")
+
+    while True:
+        if f.read(1) != b"\xff":
+            raise ValueError("Expected marker")
+
+        marker = f.read(1)
+        while marker == b"\xff":
+            # Fill byte
+            marker = f.read(1)
+        if len(marker) == 0:
+            raise ValueError("Unexpected end of file")
+
+        marker = marker[0]
+        if marker in STANDALONE_MARKERS:
+            continue
+        if marker in [MARKER_SOS, MARKER_EOI]:
+            raise ValueError("Missing frame header")
+
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            raise ValueError("Unexpected end of file")
+        segment_length = (length_bytes[0] << 8) | length_bytes[1]
+
+        if marker not in SOF_MARKERS:
+            f.seek(segment_length - 2, os.SEEK_CUR)
+            continue
+
+        segment = f.read(segment_length - 2)
+        if len(segment) < 6 or len(segment) < 6 + 3 * segment[5]:
+            raise ValueError("Truncated frame header")
+        height = (segment[1] << 8) | segment[2]
+        width = (segment[3] << 8) | segment[4]
+        sampling_factors = [(segment[7 + 3 * i] >> 4, segment[7 + 3 * i] & 0x0F) for i in range(segment[5])]
+        return height, width, sampling_factors
+
+
+def count_blocks(height, width, sampling_factors):
+    """
+    Computes the number of 8x8 blocks of all components as stored in the file, as the decoder would allocate them
+    :param height: image height in pixels
+    :param width: image width in pixels
+    :param sampling_factors: list of 2-tuples of horizontal and vertical sampling factor per component
+    :return: total number of blocks
+    """
+    max_h_samp_factor = max(h for h, v in sampling_factors)
+    max_v_samp_factor = max(v for h, v in sampling_factors)
+
+    num_blocks = 0
+    for h_samp_factor, v_samp_factor in sampling_factors:
+        # Ceiling division
+        width_in_blocks = -(-width * h_samp_factor // (8 * max_h_samp_factor))
+        height_in_blocks = -(-height * v_samp_factor // (8 * max_v_samp_factor))
+        num_blocks += width_in_blocks * height_in_blocks
+
+    return num_blocks
+
+
+def walk_jpeg(buffer, pos, in_entropy_coded_data=False):
+    """
+    Walks the marker segments of a JPEG file from the given position on, including the entropy-coded data of all scans.
+    Thumbnails embedded in APPn segments are skipped together with their segment.
+    If the buffer ends before the JPEG file is complete, the walk can be resumed once more data has been appended to the buffer, without walking the segments already seen again.
+    :param buffer: bytes or bytearray
+    :param pos: position after the SOI marker, or position to resume at as returned by a previous call
+    :param in_entropy_coded_data: whether pos is within the entropy-coded data of a scan, as returned by a previous call
+    :return: 3-tuple of position after the EOI marker or None if the buffer ends before the JPEG file is complete, position to resume at, and whether that position is within entropy-coded data
+    :raises ValueError: if the data is not a valid marker sequence
+    """
+    while True:
+        if in_entropy_coded_data:
+            # Skip entropy-coded data up to the next marker other than stuffed zero bytes and restart markers
+            pos = buffer.find(b"\xff", pos)
+            if pos < 0:
+                return None, len(buffer), True
+            if pos + 1 >= len(buffer):
+                return None, pos, True
+            next_byte = buffer[pos + 1]
+            if next_byte == 0x00 or next_byte in STANDALONE_MARKERS:
+                pos += 2
+                continue
+            if next_byte == 0xFF:
+                pos += 1
+                continue
+            in_entropy_coded_data = False
+
+        if pos + 2 > len(buffer):
+            return None, pos, False
+        if buffer[pos] != 0xFF:
+            raise ValueError("Expected marker at position {}".format(pos))
+
+        marker = buffer[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == MARKER_EOI:
+            return pos + 2, pos + 2, False
+        if marker in STANDALONE_MARKERS:
+            pos += 2
+            continue
+
+        if pos + 4 > len(buffer):
+            return None, pos, False
+        segment_length = (buffer[pos + 2] << 8) | buffer[pos + 3]
+        # The segment may extend beyond the end of the buffer, in which case the walk resumes after it
+        pos = pos + 2 + segment_length
+        in_entropy_coded_data = marker == MARKER_SOS
+
+
+def find_jpeg_end(buffer, start):
+    """
+    Walks the marker segments of the JPEG file starting at the given position, see walk_jpeg
+    :param buffer: bytes or bytearray
+    :param start: position of the SOI marker
+    :return: position after the EOI marker, or None if the buffer ends before the JPEG file is complete
+    :raises ValueError: if the data is not a valid marker sequence
+    """
+    end, _, _ = walk_jpeg(buffer, start + 2)
+    return end
+
+
+def split_jpeg_stream(f, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Splits a stream into the JPEG files it contains, e.g., concatenated JPEG files on stdin or Motion-JPEG frames.
+    Any bytes between JPEG files, such as container headers, are skipped.
+    The walk over a JPEG file that spans several chunks resumes where it stopped, so that each byte is parsed only once.
+    :param f: binary file object
+    :param chunk_size: number of bytes to read at once
+    :return: generator of JPEG files as bytes
+    """
+    buffer = bytearray()
+    eof = False
+    # Position to search for the next SOI marker at
+    pos = 0
+    # Position of the SOI marker of the JPEG file being walked, and the state of the walk
+    start = None
+    walk_pos = 0
+    in_entropy_coded_data = False
+    while True:
+        if start is None:
+            start = buffer.find(b"\xff\xd8\xff", pos)
+            if start < 0:
+                start = None
+            else:
+                walk_pos = start + 2
+                in_entropy_coded_data = False
+
+        if start is not None:
+            try:
+                end, walk_pos, in_entropy_coded_data = walk_jpeg(buffer, walk_pos, in_entropy_coded_data)
+            except ValueError:
+                # Not a valid JPEG file, continue searching after the presumed SOI marker
+                pos = start + 2
+                start = None
+                continue
+
+            if end is not None:
+                yield bytes(buffer[start:end])
+                pos = end
+                start = None
+                continue
+
+        if eof:
+            return
+
+        # Drop consumed bytes and read more data. Otherwise, keep the last bytes, which may be the beginning of an SOI marker.
+        offset = start if start is not None else max(0, len(buffer) - 2)
+        del buffer[:offset]
+        pos = max(0, pos - offset)
+        if start is not None:
+            start -= offset
+            walk_pos -= offset
+
+        chunk = f.read(chunk_size)
+        if len(chunk) == 0:
+            eof = True
+        buffer.extend(chunk)
+
+
+def default_huffman_tables_segment():
+    """
+    :return: DHT marker segment that defines the Huffman tables of the JPEG standard, as bytes
+    """
+    payload = bytearray()
+    for table_id, counts, values in DEFAULT_HUFFMAN_TABLES:
+        payload.append(table_id)
+        payload.extend(counts)
+        payload.extend(values)
+    return bytes([0xFF, MARKER_DHT]) + (len(payload) + 2).to_bytes(2, "big") + bytes(payload)
+
+
+def insert_default_huffman_tables(data):
+    """
+    Adds the Huffman tables of the JPEG standard to a JPEG file that does not define any Huffman tables before its first scan, as is common for Motion-JPEG frames.
+    :param data: JPEG file as bytes
+    :return: JPEG file as bytes, unchanged if it defines Huffman tables
+    :raises ValueError: if the data is not a valid marker sequence up to the first scan
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Missing SOI marker")
+
+    pos = 2
+    while True:
+        if pos + 2 > len(data) or data[pos] != 0xFF:
+            raise ValueError("Expected marker at position {}".format(pos))
+
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == MARKER_DHT:
+            return data
+        if marker == MARKER_SOS:
+            # Tables only need to be defined before the scan that uses them
+            return data[:pos] + default_huffman_tables_segment() + data[pos:]
+        if marker == MARKER_EOI:
+            raise ValueError("Missing scan")
+        if marker in STANDALONE_MARKERS:
+            pos += 2
+            continue
+
+        if pos + 4 > len(data):
+            raise ValueError("Unexpected end of file")
+        pos += 2 + ((data[pos + 2] << 8) | data[pos + 3])
+
+
+def _read_exif_string(tiff, byte_order, entry):
+    """
+    :param tiff: TIFF structure of the Exif segment
+    :param byte_order: "<" or ">"
+    :param entry: position of the IFD entry
+    :return: value of an ASCII entry up to the first NUL byte, without trailing whitespace, or None if the entry is not of type ASCII
+    """
+    value_type, count = struct.unpack_from(byte_order + "HI", tiff, entry + 2)
+    if value_type != EXIF_TYPE_ASCII:
+        return None
+    # Values of up to 4 bytes are stored in the entry itself
+    value_pos = entry + 8 if count <= 4 else struct.unpack_from(byte_order + "I", tiff, entry + 8)[0]
+    value = tiff[value_pos:value_pos + count].split(b"\x00")[0]
+    return value.decode("utf-8", errors="replace").rstrip()
+
+
+def read_exif_make_and_model(data):
+    """
+    Reads camera make and model from the Exif segment of a JPEG file in memory, so that images given as bytes do not need to be passed to exiftool as files.
+    Only the Make and Model tags of IFD0 are read, which is where exiftool reports EXIF:Make and EXIF:Model from.
+    :param data: JPEG file as bytes
+    :return: make and model as 2-tuple, empty strings if not available
+    """
+    make, model = "", ""
+    pos = 2
+    try:
+        while pos + 4 <= len(data) and data[pos] == 0xFF:
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+                continue
+            if marker in [MARKER_SOS, MARKER_EOI]:
+                break
+            if marker in STANDALONE_MARKERS:
+                pos += 2
+                continue
+
+            segment_length = (data[pos + 2] << 8) | data[pos + 3]
+            if marker == MARKER_APP1 and data[pos + 4:pos + 10] == EXIF_HEADER:
+                tiff = data[pos + 10:pos + 2 + segment_length]
+                byte_order = {b"II": "<", b"MM": ">"}[bytes(tiff[:2])]
+                ifd0 = struct.unpack_from(byte_order + "I", tiff, 4)[0]
+                num_entries = struct.unpack_from(byte_order + "H", tiff, ifd0)[0]
+                for i in range(num_entries):
+                    entry = ifd0 + 2 + 12 * i
+                    tag = struct.unpack_from(byte_order + "H", tiff, entry)[0]
+                    if tag == EXIF_TAG_MAKE:
+                        make = _read_exif_string(tiff, byte_order, entry) or make
+                    elif tag == EXIF_TAG_MODEL:
+                        model = _read_exif_string(tiff, byte_order, entry) or model
+                break
+
+            pos += 2 + segment_length
+
+    except (KeyError, struct.error):
+        # Malformed Exif segment, report what has been read so far
+        pass
+
+    return make, model
@@ -0,0 +1,98 @@
+import importlib.util
+
+
+# Implementations of the hot loops
+BACKEND_NUMPY = "numpy"
+BACKEND_NUMBA = "numba"
+BACKENDS = [BACKEND_NUMPY, BACKEND_NUMBA]
+
+# Selected backend. The numba kernels only run when selected explicitly, such that the default numerics do not depend on whether numba is installed.
+_backend = BACKEND_NUMPY
+
+
+def is_numba_available():
+    """
+    :return: True if numba can be imported. Does not import numba, which takes a while.
+    """
+    return importlib.util.find_spec("numba") is not None
+
+
+def get_backend():
+    """
+    :return: the selected backend, numpy unless numba was selected with set_backend
+    """
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Selects the implementation of the hot loops for this process and for worker processes forked afterwards
+    :param backend: "numpy" or "numba", or None for the default numpy backend
+    """
+    global _backend
+    if backend is None:
+        backend = BACKEND_NUMPY
+    if backend not in BACKENDS:
+        raise ValueError("Unknown kernel backend")
+    if BACKEND_NUMBA == backend and not is_numba_available():
+        raise ImportError("The numba kernel backend requires numba")
+    _backend = backend
+
+
+def numba_kernels():
+    """
+    Imports the numba kernels, which compiles them on first use or loads them from the cache
+    :return: module utils.numba_kernels
+    """
+    from utils import numba_kernels
+    return numba_kernels
+
+
+def compare_backends():
+    """
+    Compares both backends on random inputs and raises an AssertionError if they differ
+    """
+    from detectors.dct.dct_template_bank_detector import DctTemplateBankDetector
+    from utils.noise_residual import wiener_residual
+    from utils.upsampling import has_undergone_simple_upsampling
+    from detectors.score_aggregator import aggregate_map
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    detector = DctTemplateBankDetector()
+    quantization_table = rng.integers(1, 100, size=64).astype(np.uint16)
+
+    # Quantized coefficients with many all-zero blocks, dequantized coefficients, noise-like and flat images, images with and without simple upsampling, and scores partly outside the histogram range
+    dct_coefs = (rng.integers(-3, 4, size=(37, 53, 64)) * (rng.random((37, 53, 1)) < 0.6)).astype(np.int16)
+    dct_blocks = rng.normal(size=(37, 53, 64)) * 10
+    img = rng.normal(size=(75, 61)) * 20
+    flat_img = np.full((16, 24), 7.)
+    scores = np.clip(rng.normal(size=(37, 53)) * 0.4, -1.2, 1.2)
+    upsampled = np.repeat(np.repeat(rng.integers(0, 256, size=(40, 33)).astype(np.float64), 2, axis=0), 2, axis=1)[:-1]
+
+    results = dict()
+    for backend in BACKENDS:
+        set_backend(backend)
+        results[backend] = [
+            detector.detect_map(dct_coefs, quantization_table=quantization_table),
+            detector.detect_map(dct_blocks),
+            detector.detect_map(np.zeros((3, 4, 64))),
+            wiener_residual(img),
+            wiener_residual(flat_img),
+            has_undergone_simple_upsampling(upsampled),
+            has_undergone_simple_upsampling(img),
+            *aggregate_map(scores, 40, np.array([-0.5, 0., 0.25])),
+        ]
+
+    for i, (numpy_result, numba_result) in enumerate(zip(results[BACKEND_NUMPY], results[BACKEND_NUMBA])):
+        assert np.allclose(numpy_result, numba_result, rtol=1e-9, atol=1e-12, equal_nan=True), "Backends differ in check {}".format(i)
+
+    set_backend(BACKEND_NUMPY)
+
+
+if __name__ == "__main__":
+    if is_numba_available():
+        compare_backends()
+        print("Backends agree")
+    else:
+        print("Skipping the comparison of the backends because numba is not installed")
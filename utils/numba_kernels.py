@@ -0,0 +1,182 @@
+import numba
+import numpy as np
+
+
+# The kernels are compiled on first use and cached on disk. Division follows numpy semantics, i.e., division by zero yields inf or nan instead of raising.
+# Outer loops over rows run in parallel threads, and each block or pixel neighborhood is processed in a single pass while it is in cache.
+
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def correlate_blocks(dct_blocks, template_matrix, epsilon):
+    """
+    Normalized cross-correlation of the AC coefficients of each block with each template, see DctTemplateMatchingDetector.correlate_blocks
+    :param dct_blocks: DCT coefficients of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param template_matrix: normalized templates of shape [63, num_templates]
+    :param epsilon: added to the standard deviation of each block
+    :return: map of shape [num_vertical_blocks, num_horizontal_blocks, num_templates]
+    """
+    num_vertical_blocks, num_horizontal_blocks = dct_blocks.shape[:2]
+    num_coefs, num_templates = template_matrix.shape
+    correlation = np.empty((num_vertical_blocks, num_horizontal_blocks, num_templates))
+
+    for i in numba.prange(num_vertical_blocks):
+        for j in range(num_horizontal_blocks):
+            mean = 0.
+            for k in range(1, 64):
+                mean += dct_blocks[i, j, k]
+            mean /= num_coefs
+
+            variance = 0.
+            for k in range(1, 64):
+                d = dct_blocks[i, j, k] - mean
+                variance += d * d
+            std = np.sqrt(variance / num_coefs)
+
+            for t in range(num_templates):
+                acc = 0.
+                for k in range(1, 64):
+                    acc += (dct_blocks[i, j, k] - mean) * template_matrix[k - 1, t]
+                correlation[i, j, t] = acc / (std + epsilon) / num_coefs
+
+    return correlation
+
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def correlate_quantized(dct_coefs, weights, weights_squared, epsilon):
+    """
+    Normalized cross-correlation on quantized coefficients with the quantization table folded into the weights, see DctTemplateMatchingDetector.correlate_quantized
+    :param dct_coefs: quantized DCT coefficients of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param weights: quantization table times templates, and quantization table in the last column, divided by 63, of shape [63, num_templates + 1]
+    :param weights_squared: squared quantization table divided by 63, of length 63
+    :param epsilon: added to the standard deviation of each block
+    :return: map of shape [num_vertical_blocks, num_horizontal_blocks, num_templates]
+    """
+    num_vertical_blocks, num_horizontal_blocks = dct_coefs.shape[:2]
+    num_templates = weights.shape[1] - 1
+    correlation = np.zeros((num_vertical_blocks, num_horizontal_blocks, num_templates))
+
+    for i in numba.prange(num_vertical_blocks):
+        for j in range(num_horizontal_blocks):
+            # Blocks without any non-zero AC coefficient have a correlation of exactly zero
+            nonzero = False
+            for k in range(1, 64):
+                if dct_coefs[i, j, k] != 0:
+                    nonzero = True
+                    break
+            if not nonzero:
+                continue
+
+            mean = 0.
+            mean_squared = 0.
+            for k in range(1, 64):
+                c = np.float64(dct_coefs[i, j, k])
+                mean += c * weights[k - 1, num_templates]
+                mean_squared += c * c * weights_squared[k - 1]
+            std = np.sqrt(max(mean_squared - mean * mean, 0.))
+
+            for t in range(num_templates):
+                acc = 0.
+                for k in range(1, 64):
+                    acc += np.float64(dct_coefs[i, j, k]) * weights[k - 1, t]
+                correlation[i, j, t] = acc / (std + epsilon)
+
+    return correlation
+
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def wiener_residual(img):
+    """
+    Difference between an image and the output of scipy.signal.wiener(img, 3), with zero padding at the borders as scipy uses
+    :param img: 2-D image as float64
+    :return: noise residual of the same shape
+    """
+    height, width = img.shape
+    local_mean = np.empty((height, width))
+    local_variance = np.empty((height, width))
+    row_variance_sums = np.empty(height)
+
+    # First pass: local mean and variance over 3x3 neighborhoods
+    for y in numba.prange(height):
+        row_variance_sum = 0.
+        for x in range(width):
+            s = 0.
+            s2 = 0.
+            for yy in range(max(y - 1, 0), min(y + 2, height)):
+                for xx in range(max(x - 1, 0), min(x + 2, width)):
+                    v = img[yy, xx]
+                    s += v
+                    s2 += v * v
+            m = s / 9.
+            variance = s2 / 9. - m * m
+            local_mean[y, x] = m
+            local_variance[y, x] = variance
+            row_variance_sum += variance
+        row_variance_sums[y] = row_variance_sum
+
+    # Noise power is estimated as the average local variance
+    noise = np.sum(row_variance_sums) / (height * width)
+
+    # Second pass: subtract the filter output
+    residual = np.empty((height, width))
+    for y in numba.prange(height):
+        for x in range(width):
+            m = local_mean[y, x]
+            variance = local_variance[y, x]
+            if variance < noise:
+                residual[y, x] = img[y, x] - m
+            else:
+                residual[y, x] = img[y, x] - ((img[y, x] - m) * (1. - noise / variance) + m)
+
+    return residual
+
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def count_simple_upsampling_matches(channel):
+    """
+    Number of pixels in 2x2 blocks that equal the top-left block member after truncation to integers, see utils.upsampling.count_simple_upsampling_matches
+    :param channel: 2-D image channel as float32 or float64, not necessarily contiguous
+    :return: number of matching pixels
+    """
+    num_vertical_blocks = channel.shape[0] // 2
+    num_horizontal_blocks = channel.shape[1] // 2
+    row_counts = np.zeros(num_vertical_blocks, dtype=np.int64)
+
+    for i in numba.prange(num_vertical_blocks):
+        count = 0
+        for j in range(num_horizontal_blocks):
+            top_left = np.int64(channel[2 * i, 2 * j])
+            count += np.int64(channel[2 * i, 2 * j + 1]) == top_left
+            count += np.int64(channel[2 * i + 1, 2 * j]) == top_left
+            count += np.int64(channel[2 * i + 1, 2 * j + 1]) == top_left
+        row_counts[i] = count
+
+    return np.sum(row_counts)
+
+
+@numba.njit(cache=True, error_model="numpy")
+def aggregate_map(values, low, high, num_bins, thresholds):
+    """
+    Sums, histogram and above-threshold counts in a single pass, see detectors.score_aggregator.aggregate_map
+    :param values: contiguous 1-D array of per-block scores
+    :param low: lower end of the histogram range
+    :param high: upper end of the histogram range
+    :param num_bins: number of histogram bins. Values outside the range are counted in the first or last bin.
+    :param thresholds: 1-D array of thresholds
+    :return: sum, sum of squares, histogram counts, and number of values strictly above each threshold
+    """
+    histogram = np.zeros(num_bins, dtype=np.int64)
+    above_counts = np.zeros(len(thresholds), dtype=np.int64)
+    scale = num_bins / (high - low)
+    total = 0.
+    total_squared = 0.
+
+    for v in values:
+        total += v
+        total_squared += v * v
+        b = np.int64((v - low) * scale)
+        histogram[min(max(b, 0), num_bins - 1)] += 1
+        for t in range(len(thresholds)):
+            if v > thresholds[t]:
+                above_counts[t] += 1
+
+    return total, total_squared, histogram, above_counts
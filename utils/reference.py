@@ -0,0 +1,295 @@
+# Frozen copies of the original implementations of the detector, cropping, noise residual and 4:4:4 chroma reduction.
+# They transform each block separately with np.apply_along_axis and scipy, which is slow, but serves as the ground truth that the optimized implementations are verified against, see utils.verification.
+# Do not optimize or otherwise change this module.
+from scipy.fftpack import dct, idct
+from scipy.signal import wiener
+import numpy as np
+
+
+EPSILON = 1e-7
+
+SIMPLE_UPSAMPLING = "simple_upsampling"
+DCT_UPSAMPLING = "dct_upsampling"
+AUTO = "auto"
+
+
+def get_template():
+    """
+    Computes the 8x8 template containing the chroma dimples.
+    :return: 8x8 block of DCT coefficient template
+    """
+    # Set up template
+    w = np.ones((8, 8))
+    w[:, 1::2] = 2
+
+    # Set DC term to zero
+    w = w - np.mean(w)
+
+    # Transform into DCT domain
+    coefs = dct(dct(w, axis=1, norm="ortho"), axis=0, norm="ortho")
+
+    return coefs
+
+
+def detect_map(dct_blocks):
+    """
+    Correlates the chroma dimples template with each DCT block using the normalized cross-correlation.
+    :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :return: map of size [num_vertical_blocks, num_horizontal_blocks] that indicates how strongly each block is correlated with the template.
+    """
+    # Retrieve template
+    template = get_template().ravel()
+
+    # Only consider AC coefficients
+    template = template[1:]
+    dct_blocks = dct_blocks[:, :, 1:]
+
+    # Make zero-mean and unit-variance
+    template = (template - np.mean(template)) / np.std(template)
+
+    # Make each DCT block zero-mean and unit-variance
+    dct_blocks = (dct_blocks - np.mean(dct_blocks, axis=2)[:, :, None]) / (np.std(dct_blocks, axis=2)[:, :, None] + EPSILON)
+
+    # Correlate with DCT blocks
+    correlation = np.dot(dct_blocks, template) / float(len(template))
+    return correlation
+
+
+def detect_score(dct_blocks):
+    """
+    Averages the scores over all DCT blocks.
+    :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :return: scalar value that indicates how strongly, on average, all blocks are correlated with the expected template.
+    """
+    detection_map = detect_map(dct_blocks)
+    return np.mean(detection_map)
+
+
+def crop(dct_blocks, crop_top=0, crop_left=0):
+    """
+    Crop an image channel in spatial domain
+    :param dct_blocks: DCT coefficients of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param crop_top: number of pixels to crop from the top
+    :param crop_left: number of pixels to crop from the left
+    :return: DCT coefficients of cropped image, of shape [num_output_vertical_blocks, num_output_horizontal_blocks, 64], where num_output_vertical_blocks is (num_vertical_blocks * 8 - crop_top) // 8.
+    """
+    blocks_8x8 = np.apply_along_axis(lambda x: idct(idct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho"), axis=2, arr=dct_blocks)
+
+    # Align blocks spatially
+    num_vertical_blocks, num_horizontal_blocks = blocks_8x8.shape[:2]
+    channel = blocks_8x8.transpose(0, 2, 1, 3).reshape(num_vertical_blocks * 8, num_horizontal_blocks * 8)
+    height, width = channel.shape
+
+    # After cropping top and left, ensure that the resulting size is a multiple of 8
+    if crop_top > 0:
+        crop_bottom = (height - crop_top) % 8
+        channel = channel[crop_top:-crop_bottom, :]
+        height = height - crop_top - crop_bottom
+    if crop_left > 0:
+        crop_right = (width - crop_left) % 8
+        channel = channel[:, crop_left:-crop_right]
+        width = width - crop_left - crop_right
+
+    num_output_vertical_blocks = height // 8
+    num_output_horizontal_blocks = width // 8
+
+    # Transform back into 8x8 DCT coefficients
+    # Split into 8x8 blocks
+    blocks_8x8 = channel.reshape(num_output_vertical_blocks, 8, num_output_horizontal_blocks, 8).transpose([0, 2, 1, 3])
+    blocks_8x8_flat = blocks_8x8.reshape(num_output_vertical_blocks, num_output_horizontal_blocks, 64)
+
+    # Apply the 2-D DCT
+    dct_blocks_8x8 = np.apply_along_axis(lambda x: dct(dct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho").flatten(), axis=2, arr=blocks_8x8_flat)
+
+    return dct_blocks_8x8
+
+
+def obtain_noise_residual(dct_blocks):
+    """
+    :param dct_blocks: DCT coefficients of image channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :return: DCT coefficients of noise residual of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    """
+    num_vertical_blocks, num_horizontal_blocks = dct_blocks.shape[:2]
+
+    # Transform into image space
+    blocks_8x8 = np.apply_along_axis(lambda x: idct(idct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho"), axis=2, arr=dct_blocks)
+
+    # Reorder blocks to obtain image
+    img = np.transpose(blocks_8x8, axes=[0, 2, 1, 3]).reshape(num_vertical_blocks * 8, num_horizontal_blocks * 8)
+
+    # Apply 3x3 Wiener filter
+    denoised = wiener(img, 3)
+
+    # Subtract denoised from original image to obtain noise residual
+    noise_residual = img - denoised
+
+    # Transform back into DCT domain
+    # Split noise residual into 8x8 blocks and reshape them to [num_vertical_blocks, num_horizontal_blocks, 64]
+    noise_residual_blocks = noise_residual.reshape(num_vertical_blocks, 8, num_horizontal_blocks, 8).transpose([0, 2, 1, 3]).reshape(num_vertical_blocks, num_horizontal_blocks, 8 * 8)
+
+    # Apply the 2-D DCT
+    noise_residual_dct_blocks = np.apply_along_axis(lambda x: dct(dct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho").ravel(), axis=2, arr=noise_residual_blocks)
+
+    return noise_residual_dct_blocks
+
+
+def has_undergone_simple_upsampling(channel):
+    """
+    Determines whether the values inside each 2x2 block is a copy of the top-left block member
+    :param channel: 2-D image channel
+    :return: score in range [0, 1] where 1 indicates that all values inside each 2x2 blocks are copies of their top-left block member
+    """
+
+    height, width = channel.shape
+
+    # Disregard last row or column if the image size is uneven
+    if height % 2 == 1:
+        channel = channel[:-1, :]
+        height -= 1
+    if width % 2 == 1:
+        channel = channel[:, :-1]
+        width -= 1
+
+    # Reshape into blocks of size 2x2
+    num_horizontal_blocks = width // 2
+    num_vertical_blocks = height // 2
+
+    blocks = channel.reshape(num_vertical_blocks, 2, num_horizontal_blocks, 2).transpose(0, 2, 1, 3)
+    blocks = blocks.reshape(num_vertical_blocks * num_horizontal_blocks, 2 * 2)
+
+    # Round to integer. The original used np.int, which has been removed from numpy and was an alias of the builtin int.
+    blocks = blocks.astype(int)
+
+    # Count how many pixel values inside each block match to their top-left block member
+    inside_block_difference = blocks[:, 1:] - np.expand_dims(blocks[:, 0], axis=1)
+    num_matching_values = 3 - np.count_nonzero(inside_block_difference, axis=1)
+
+    # Normalize to range [0, 1]
+    return np.mean(num_matching_values / 3)
+
+
+def undo_simple_upsampling(channel):
+    """
+    Supsamples each dimension by a factor of 2.
+    :param channel: 2-D image channel
+    :return: downsampled image channel with halved dimensions
+    """
+    return channel[::2, ::2]
+
+
+def undo_dct_upsampling(channel):
+    """
+    Reduces the resolution of the given image channel in DCT domain.
+    To do so, reshapes the image channel into 16x16 blocks, takes the 2-D DCT, and discards the high-frequency coefficients.
+    Retained are the 8x8 coefficients corresponding to the top-left block of the 16x16 DCT coefficients.
+    :param channel: 2-D image channel
+    :return: DCT coefficients of downsampled image channel, of shape [height // 16, width // 16, 64]
+    """
+    height, width = channel.shape
+
+    num_output_vertical_blocks = height // 16
+    num_output_horizontal_blocks = width // 16
+
+    # Cut off pixels that don't constitute to full 16x16 blocks
+    if height % 16 != 0:
+        channel = channel[:num_output_vertical_blocks * 16, :]
+    if width % 16 != 0:
+        channel = channel[:, :num_output_horizontal_blocks * 16]
+
+    # Split into 16x16 blocks
+    blocks_16x16 = channel.reshape(num_output_vertical_blocks, 16, num_output_horizontal_blocks, 16).transpose([0, 2, 1, 3])
+    # Flatten last dimension
+    blocks_16x16_flat = blocks_16x16.reshape(num_output_vertical_blocks, num_output_horizontal_blocks, 16 * 16)
+
+    # Apply the 2-D DCT
+    dct_blocks_16x16 = np.apply_along_axis(lambda x: dct(dct(x.reshape(16, 16), axis=1, norm="ortho"), axis=0, norm="ortho"), axis=2, arr=blocks_16x16_flat)
+
+    # Retain only the top-left 8x8 coefficients
+    dct_blocks_8x8 = dct_blocks_16x16[:, :, :8, :8]
+
+    # Flatten last dimension
+    dct_blocks_8x8 = dct_blocks_8x8.reshape(num_output_vertical_blocks, num_output_horizontal_blocks, 8 * 8)
+
+    return dct_blocks_8x8
+
+
+def reduce_444_chroma_channel(dct_blocks, upsampling_method=AUTO):
+    """
+    In order to run the analysis on an image of which the chroma channels have previously been upsampled to full resolution, the analysis requires the upsampling to be undone.
+    This method reduces the spatial resolution of the chroma channel, given as DCT coefficients, by a factor of 2 in both directions
+    :param dct_blocks: DCT coefficients of shape [num_vertical_blocks, num_horizontal_blocks 64]
+    :param upsampling_method: "dct_upsampling", "simple_upsampling", or "auto"
+    :return: DCT coefficients of downsampled channel of shape [num_output_vertical_blocks, num_output_horizontal_blocks, 64]. The exact number of blocks depends on the downsampling method.
+    """
+    upsampling_methods = {DCT_UPSAMPLING, SIMPLE_UPSAMPLING, AUTO}
+    if upsampling_method not in upsampling_methods:
+        raise ValueError("Upsampling method not known")
+
+    # Convert to spatial domain
+    # Apply the 2-D IDCT
+    blocks_8x8 = np.apply_along_axis(lambda x: idct(idct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho"), axis=2, arr=dct_blocks)
+
+    # Align blocks spatially
+    num_vertical_blocks, num_horizontal_blocks = blocks_8x8.shape[:2]
+    channel = blocks_8x8.transpose(0, 2, 1, 3).reshape(num_vertical_blocks * 8, num_horizontal_blocks * 8)
+
+    if AUTO == upsampling_method:
+        has_undergone_simple_upsampling_result = has_undergone_simple_upsampling(channel)
+        if has_undergone_simple_upsampling_result > 0.95:
+            upsampling_method = SIMPLE_UPSAMPLING
+        else:
+            upsampling_method = DCT_UPSAMPLING
+
+    if SIMPLE_UPSAMPLING == upsampling_method:
+        chroma_quartered_spatial = undo_simple_upsampling(channel)
+        height, width = chroma_quartered_spatial.shape
+
+        # Split into 8x8 blocks
+        num_output_vertical_blocks = height // 8
+        num_output_horizontal_blocks = width // 8
+
+        # Cut off right-most columns or bottom rows that are not a multiple of 8
+        if height % 8 != 0:
+            chroma_quartered_spatial = chroma_quartered_spatial[:-(height % 8), :]
+        if width % 8 != 0:
+            chroma_quartered_spatial = chroma_quartered_spatial[:, :-(width % 8)]
+
+        blocks_8x8 = chroma_quartered_spatial.reshape(num_output_vertical_blocks, 8, num_output_horizontal_blocks, 8).transpose(0, 2, 1, 3)
+        # Flatten last dimension
+        blocks_8x8_flat = blocks_8x8.reshape(num_output_vertical_blocks, num_output_horizontal_blocks, 8 * 8)
+
+        # Transform back into DCT-domain
+        dct_blocks_64 = np.apply_along_axis(lambda x: dct(dct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho").flatten(), axis=2, arr=blocks_8x8_flat)
+        return dct_blocks_64
+
+    elif DCT_UPSAMPLING == upsampling_method:
+        chroma_quartered_dct_blocks_8x8 = undo_dct_upsampling(channel)
+        return chroma_quartered_dct_blocks_8x8
+
+    else:
+        raise ValueError("Unknown upsampling method")
+
+
+def score_channel(dct_coefs, quantization_table, reduce_chroma=False, crop_offsets=None, use_noise_residual=False):
+    """
+    Computes the detection score of a single chroma channel in the order of the original scoring loop: reduce, crop, dequantize, noise residual, correlate.
+    :param dct_coefs: quantized DCT coefficients of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param quantization_table: flat quantization table
+    :param reduce_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+    :param crop_offsets: (optional) 2-tuple of number of pixels to crop from the top and left margins
+    :param use_noise_residual: whether to use noise residual instead of image
+    :return: scalar detection score
+    """
+    if reduce_chroma:
+        dct_coefs = reduce_444_chroma_channel(dct_coefs)
+
+    if crop_offsets is not None:
+        dct_coefs = crop(dct_coefs, *crop_offsets)
+
+    # Dequantize
+    dct_coefs = dct_coefs * quantization_table
+
+    if use_noise_residual:
+        dct_coefs = obtain_noise_residual(dct_coefs)
+
+    return detect_score(dct_coefs)
@@ -0,0 +1,277 @@
+from utils.constants import COL_FILENAME, COL_CB_SCORE, COL_CR_SCORE, COL_MAX_V_SAMP_FACTOR, COL_MAX_H_SAMP_FACTOR, COL_CB_V_SAMP_FACTOR, COL_CB_H_SAMP_FACTOR, COL_EXIF_MAKE, COL_EXIF_MODEL, COL_ESTIMATED_QUALITY_FACTOR, COL_ESTIMATED_QUALITY_FACTOR_DISTANCE, COL_CROP_TOP, COL_CROP_LEFT, \
+    COL_DUPLICATE_OF, COL_ENCODER, COL_QUALITY, COL_SAMPLE, COL_CB_BEST_TEMPLATE, COL_CR_BEST_TEMPLATE, COL_CB_TEMPLATE_SCORE, COL_CR_TEMPLATE_SCORE, \
+    COL_CB_ROI_SCORE, COL_CR_ROI_SCORE, COL_CB_ROI_COMPLEMENT_SCORE, COL_CR_ROI_COMPLEMENT_SCORE, COL_ROI_NUM_BLOCKS, COL_ROI_COMPLEMENT_NUM_BLOCKS, COL_CB_STATISTIC, COL_CR_STATISTIC, COL_CB_CR_AGREEMENT, \
+    COL_FRAME, COL_CB_RUNNING_MEAN, COL_CR_RUNNING_MEAN, COL_CB_RUNNING_STD, COL_CR_RUNNING_STD, \
+    COL_VERIFIED, COL_CB_REFERENCE_SCORE, COL_CR_REFERENCE_SCORE, COL_CB_SCORE_DIFFERENCE, COL_CR_SCORE_DIFFERENCE, COL_SCORE_SECONDS, COL_REFERENCE_SCORE_SECONDS, \
+    COL_HEIGHT, COL_WIDTH, COL_CB_SIMPLE_UPSAMPLING_SCORE, COL_CR_SIMPLE_UPSAMPLING_SCORE, COL_SIMPLE_UPSAMPLING
+import os
+import re
+
+
+FORMAT_CSV = "csv"
+FORMAT_PARQUET = "parquet"
+FORMATS = [FORMAT_CSV, FORMAT_PARQUET]
+
+PARQUET_EXTENSIONS = {".parquet", ".pq"}
+
+# Number of rows per Parquet row group
+DEFAULT_ROW_GROUP_SIZE = 10000
+
+
+def infer_format(output_filename, output_format=None):
+    """
+    Determines the output format from the explicitly given format or from the file extension. Defaults to csv.
+    :param output_filename: path to output file
+    :param output_format: (optional) "csv" or "parquet"
+    :return: output format
+    """
+    if output_format is not None:
+        if output_format not in FORMATS:
+            raise ValueError("Unknown output format")
+        return output_format
+
+    if os.path.splitext(output_filename)[1].lower() in PARQUET_EXTENSIONS:
+        return FORMAT_PARQUET
+
+    return FORMAT_CSV
+
+
+def read_results(results_filename, output_format=None):
+    """
+    Reads a results file written by one of the result writers
+    :param results_filename: path to csv or Parquet file
+    :param output_format: (optional) "csv" or "parquet". If not given, the format is inferred from the file extension.
+    :return: data frame. Missing strings in csv files are read as empty strings.
+    """
+    import pandas as pd
+
+    if FORMAT_PARQUET == infer_format(results_filename, output_format):
+        return pd.read_parquet(results_filename)
+
+    # An empty csv file has no header
+    if os.path.getsize(results_filename) <= 1:
+        return pd.DataFrame(columns=[COL_FILENAME])
+    return pd.read_csv(results_filename, keep_default_na=False, float_precision="round_trip")
+
+
+def get_result_writer(output_filename, output_format=None, append=False):
+    """
+    :param output_filename: path to output file
+    :param output_format: (optional) "csv" or "parquet". If not given, the format is inferred from the file extension.
+    :param append: whether to append to an existing output file
+    :return: result writer instance
+    """
+    output_format = infer_format(output_filename, output_format)
+    if FORMAT_PARQUET == output_format:
+        return ParquetResultWriter(output_filename, append=append)
+
+    return CsvResultWriter(output_filename, append=append)
+
+
+class CsvResultWriter(object):
+    def __init__(self, output_filename, append=False):
+        """
+        Collects all results and writes them to a csv file when closed.
+        :param output_filename: path to output csv file
+        :param append: whether to append to an existing csv file. The header is only written if the file does not exist yet.
+        """
+        self._output_filename = output_filename
+        self._append = append
+        self._buffer = []
+
+    def write(self, row):
+        self._buffer.append(row)
+
+    def close(self):
+        import pandas as pd
+        df = pd.DataFrame(self._buffer)
+        if self._append and os.path.exists(self._output_filename):
+            df.to_csv(self._output_filename, index=False, mode="a", header=False)
+        else:
+            df.to_csv(self._output_filename, index=False)
+
+
+class ParquetResultWriter(object):
+    def __init__(self, output_filename, append=False, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        """
+        Writes results to a Parquet file, one row group at a time as results arrive.
+        Columns known from utils.constants get fixed types, and camera make and model are dictionary-encoded. Types of other columns are inferred from their first values, and columns without any values are float64.
+        Columns that first appear after the first row group was written are added to the file, with nulls in the rows written before.
+        Parquet files cannot be extended in place. To append, the existing rows are copied into a new file which replaces the existing file when closed.
+        :param output_filename: path to output Parquet file
+        :param append: whether to append to an existing Parquet file
+        :param row_group_size: number of rows per row group
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow")
+
+        self._pa = pa
+        self._pq = pq
+        self._output_filename = output_filename
+        self._row_group_size = row_group_size
+        self._buffer = []
+        self._writer = None
+        self._schema = None
+        self._existing_table = None
+
+        if append and os.path.exists(output_filename):
+            self._existing_table = pq.read_table(output_filename)
+            # Columns that were empty in the existing file are widened, such that new rows can hold values
+            for i, field in enumerate(self._existing_table.schema):
+                if pa.types.is_null(field.type):
+                    self._existing_table = self._existing_table.set_column(i, field.name, pa.nulls(len(self._existing_table), pa.float64()))
+            self._schema = self._existing_table.schema
+
+        # Write to a temporary file first, so that a crash does not destroy the existing file
+        self._tmp_filename = output_filename + ".tmp"
+
+    def _known_column_types(self):
+        pa = self._pa
+        return {
+            COL_FILENAME: pa.string(),
+            COL_MAX_V_SAMP_FACTOR: pa.int8(),
+            COL_MAX_H_SAMP_FACTOR: pa.int8(),
+            COL_CB_V_SAMP_FACTOR: pa.int8(),
+            COL_CB_H_SAMP_FACTOR: pa.int8(),
+            COL_EXIF_MAKE: pa.dictionary(pa.int32(), pa.string()),
+            COL_EXIF_MODEL: pa.dictionary(pa.int32(), pa.string()),
+            COL_CB_SCORE: pa.float64(),
+            COL_CR_SCORE: pa.float64(),
+            COL_ESTIMATED_QUALITY_FACTOR: pa.int16(),
+            COL_ESTIMATED_QUALITY_FACTOR_DISTANCE: pa.float64(),
+            COL_CROP_TOP: pa.int8(),
+            COL_CROP_LEFT: pa.int8(),
+            COL_DUPLICATE_OF: pa.string(),
+            COL_ENCODER: pa.string(),
+            COL_QUALITY: pa.int16(),
+            COL_SAMPLE: pa.string(),
+            COL_CB_BEST_TEMPLATE: pa.string(),
+            COL_CR_BEST_TEMPLATE: pa.string(),
+            COL_CB_CR_AGREEMENT: pa.float64(),
+            COL_FRAME: pa.int64(),
+            COL_CB_RUNNING_MEAN: pa.float64(),
+            COL_CR_RUNNING_MEAN: pa.float64(),
+            COL_CB_RUNNING_STD: pa.float64(),
+            COL_CR_RUNNING_STD: pa.float64(),
+            COL_VERIFIED: pa.bool_(),
+            COL_CB_REFERENCE_SCORE: pa.float64(),
+            COL_CR_REFERENCE_SCORE: pa.float64(),
+            COL_CB_SCORE_DIFFERENCE: pa.float64(),
+            COL_CR_SCORE_DIFFERENCE: pa.float64(),
+            COL_SCORE_SECONDS: pa.float64(),
+            COL_REFERENCE_SCORE_SECONDS: pa.float64(),
+            COL_HEIGHT: pa.int32(),
+            COL_WIDTH: pa.int32(),
+            COL_CB_SIMPLE_UPSAMPLING_SCORE: pa.float64(),
+            COL_CR_SIMPLE_UPSAMPLING_SCORE: pa.float64(),
+            COL_SIMPLE_UPSAMPLING: pa.bool_(),
+        }
+
+    def _column_patterns(self):
+        # Columns with a template or region index or a statistic name. Histograms hold counts, all other statistics are floats.
+        pa = self._pa
+
+        def pattern(col_template, placeholder):
+            return re.compile("^" + re.escape(col_template).replace(re.escape("{}"), placeholder) + "$")
+
+        return [
+            (pattern(COL_CB_STATISTIC, r"hist_\d+"), pa.int64()),
+            (pattern(COL_CR_STATISTIC, r"hist_\d+"), pa.int64()),
+            (pattern(COL_ROI_NUM_BLOCKS, r"\d+"), pa.int64()),
+            (pattern(COL_ROI_COMPLEMENT_NUM_BLOCKS, r"\d+"), pa.int64()),
+        ] + [(pattern(col_template, ".+"), pa.float64()) for col_template in [
+            COL_CB_ROI_SCORE, COL_CR_ROI_SCORE, COL_CB_ROI_COMPLEMENT_SCORE, COL_CR_ROI_COMPLEMENT_SCORE, COL_CB_TEMPLATE_SCORE, COL_CR_TEMPLATE_SCORE, COL_CB_STATISTIC, COL_CR_STATISTIC]]
+
+    def _column_type(self, col, values):
+        """
+        :param col: column name
+        :param values: values of the column in the current row group
+        :return: type of known columns, or type inferred from the values. Columns without values are float64.
+        """
+        pa = self._pa
+        known_column_types = self._known_column_types()
+        if col in known_column_types:
+            return known_column_types[col]
+
+        for col_pattern, col_type in self._column_patterns():
+            if col_pattern.match(col):
+                return col_type
+
+        inferred_type = pa.array(values).type
+        return pa.float64() if pa.types.is_null(inferred_type) else inferred_type
+
+    def _new_columns(self, rows):
+        # Columns in order of their first appearance that are not part of the schema yet
+        known = set() if self._schema is None else set(self._schema.names)
+        new_columns = []
+        for row in rows:
+            for col in row.keys():
+                if col not in known:
+                    known.add(col)
+                    new_columns.append(col)
+        return new_columns
+
+    def _extend_schema(self, rows):
+        pa = self._pa
+        new_columns = self._new_columns(rows)
+        if len(new_columns) == 0:
+            return
+
+        fields = [pa.field(col, self._column_type(col, [row.get(col) for row in rows])) for col in new_columns]
+        if self._schema is None:
+            self._schema = pa.schema(fields)
+            return
+
+        # The schema of a Parquet file is fixed, thus copy the rows written so far into a new file with the additional columns
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._existing_table = self._pq.read_table(self._tmp_filename)
+
+        if self._existing_table is not None:
+            for field in fields:
+                self._existing_table = self._existing_table.append_column(field, pa.nulls(len(self._existing_table), field.type))
+            self._schema = self._existing_table.schema
+        else:
+            for field in fields:
+                self._schema = self._schema.append(field)
+
+    def _flush(self):
+        if len(self._buffer) == 0:
+            return
+
+        self._extend_schema(self._buffer)
+
+        if self._writer is None:
+            self._open_writer()
+
+        table = self._pa.Table.from_pylist(self._buffer, schema=self._schema)
+        self._writer.write_table(table, row_group_size=self._row_group_size)
+        self._buffer = []
+
+    def _open_writer(self):
+        self._writer = self._pq.ParquetWriter(self._tmp_filename, self._schema)
+        if self._existing_table is not None:
+            self._writer.write_table(self._existing_table, row_group_size=self._row_group_size)
+            self._existing_table = None
+
+    def write(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self._row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+
+        if self._writer is None:
+            if self._schema is None:
+                # Nothing to write at all
+                self._schema = self._pa.schema([])
+            # Without new rows, still write the existing rows or an empty file
+            self._open_writer()
+
+        self._writer.close()
+        os.replace(self._tmp_filename, self._output_filename)
@@ -0,0 +1,279 @@
+from utils.cropping import crop
+import numpy as np
+import argparse
+import re
+
+
+# Number of blocks around each region of interest whose scores make up the complement score
+DEFAULT_CONTEXT_BLOCKS = 8
+
+
+def parse_roi(roi):
+    """
+    Parses a region of interest of the form "left,top,right,bottom"
+    :param roi: string like "100,50,300,200"
+    :return: 4-tuple of left, top, right and bottom pixel coordinates, where right and bottom are exclusive
+    """
+    match = re.match(r"^(\d+),(\d+),(\d+),(\d+)$", roi)
+    if match is None:
+        raise argparse.ArgumentTypeError("Expected region of interest as left,top,right,bottom in pixels")
+
+    left, top, right, bottom = map(int, match.groups())
+    if right <= left or bottom <= top:
+        raise argparse.ArgumentTypeError("Region of interest must not be empty")
+    return left, top, right, bottom
+
+
+def clip_block_range(block_range, num_vertical_blocks, num_horizontal_blocks):
+    """
+    :param block_range: 4-tuple of first and last (exclusive) block row and column, which may extend beyond the channel
+    :param num_vertical_blocks: number of block rows of the channel
+    :param num_horizontal_blocks: number of block columns of the channel
+    :return: block range clipped to the channel. The range is empty if it lies outside of the channel.
+    """
+    first_row, last_row, first_col, last_col = block_range
+    first_row = min(max(first_row, 0), num_vertical_blocks)
+    last_row = min(max(last_row, first_row), num_vertical_blocks)
+    first_col = min(max(first_col, 0), num_horizontal_blocks)
+    last_col = min(max(last_col, first_col), num_horizontal_blocks)
+    return first_row, last_row, first_col, last_col
+
+
+def roi_to_block_range(roi, v_scale, h_scale, crop_top, crop_left, num_vertical_blocks, num_horizontal_blocks, clip=True):
+    """
+    Maps a region of interest in image pixels to the blocks of a channel that overlap with it
+    :param roi: 4-tuple of left, top, right and bottom pixel coordinates in the full-resolution image, where right and bottom are exclusive
+    :param v_scale: vertical resolution of the channel relative to the full-resolution image, e.g., 0.5 for 4:2:0 chroma
+    :param h_scale: horizontal resolution of the channel relative to the full-resolution image
+    :param crop_top: number of channel pixels cropped from the top
+    :param crop_left: number of channel pixels cropped from the left
+    :param num_vertical_blocks: number of block rows of the (cropped) channel
+    :param num_horizontal_blocks: number of block columns of the (cropped) channel
+    :param clip: whether to clip the range to the channel. Unclipped ranges of regions outside of the channel stay outside when they are expanded.
+    :return: 4-tuple of first and last (exclusive) block row and first and last (exclusive) block column. If clipped, the range is empty if the region lies outside of the channel.
+    """
+    left, top, right, bottom = roi
+
+    # Pixel coordinates in the channel after cropping
+    top = top * v_scale - crop_top
+    bottom = bottom * v_scale - crop_top
+    left = left * h_scale - crop_left
+    right = right * h_scale - crop_left
+
+    # Blocks that overlap with the region at least partially
+    block_range = int(np.floor(top / 8.)), int(np.ceil(bottom / 8.)), int(np.floor(left / 8.)), int(np.ceil(right / 8.))
+    if not clip:
+        return block_range
+    return clip_block_range(block_range, num_vertical_blocks, num_horizontal_blocks)
+
+
+def expand_block_range(block_range, num_blocks, num_vertical_blocks, num_horizontal_blocks):
+    """
+    :param block_range: 4-tuple of first and last (exclusive) block row and column, which may extend beyond the channel
+    :param num_blocks: number of blocks to add on each side
+    :param num_vertical_blocks: number of block rows of the channel to clip to
+    :param num_horizontal_blocks: number of block columns of the channel to clip to
+    :return: expanded and clipped block range
+    """
+    first_row, last_row, first_col, last_col = block_range
+    return clip_block_range((first_row - num_blocks, last_row + num_blocks, first_col - num_blocks, last_col + num_blocks), num_vertical_blocks, num_horizontal_blocks)
+
+
+def preprocess_region(dct_coefs, block_range, num_vertical_blocks, num_horizontal_blocks, reduce_444_chroma=None, crop_offsets=(0, 0), noise_residual=None):
+    """
+    Applies the preprocessing of score_decoder only to the blocks needed for the given block range.
+    The block range refers to the final blocks after reduction and cropping. Only the source blocks that these final blocks depend on are transformed.
+    :param dct_coefs: DCT coefficients of the whole channel as decoded, of shape [num_source_vertical_blocks, num_source_horizontal_blocks, 64]
+    :param block_range: 4-tuple of first and last (exclusive) final block row and column
+    :param num_vertical_blocks: number of final block rows
+    :param num_horizontal_blocks: number of final block columns
+    :param reduce_444_chroma: (optional) function that halves the resolution of DCT coefficients
+    :param crop_offsets: 2-tuple of pixels to crop from the top and left margins after reduction
+    :param noise_residual: (optional) function that takes DCT coefficients and returns the DCT coefficients of the noise residual. The residual is computed on the region plus one block of halo on each side, such that the 3x3 neighborhoods at the region's border see the same pixels as for the whole image.
+    :return: preprocessed DCT coefficients of the given final block range
+    """
+    first_row, last_row, first_col, last_col = block_range
+
+    # Residual filtering needs one block of halo, which is discarded afterwards
+    halo = 1 if noise_residual is not None else 0
+    first_row_halo, last_row_halo, first_col_halo, last_col_halo = expand_block_range(block_range, halo, num_vertical_blocks, num_horizontal_blocks)
+
+    # After cropping, final block k covers parts of blocks k and k + 1 of the uncropped channel
+    crop_top, crop_left = crop_offsets
+    source_first_row, source_last_row = first_row_halo, last_row_halo + (1 if crop_top > 0 else 0)
+    source_first_col, source_last_col = first_col_halo, last_col_halo + (1 if crop_left > 0 else 0)
+
+    # Each block of the reduced channel originates from 2x2 decoded blocks
+    scale = 2 if reduce_444_chroma is not None else 1
+    region = dct_coefs[scale * source_first_row:scale * source_last_row, scale * source_first_col:scale * source_last_col]
+
+    if reduce_444_chroma is not None:
+        region = reduce_444_chroma(region)
+    if crop_top > 0 or crop_left > 0:
+        region = crop(region, crop_top, crop_left)
+    if noise_residual is not None:
+        region = noise_residual(region)
+
+    # Discard halo
+    return region[first_row - first_row_halo:last_row - first_row_halo, first_col - first_col_halo:last_col - first_col_halo]
+
+
+def score_rois(detect_region, rois, v_scale, h_scale, crop_offsets, num_vertical_blocks, num_horizontal_blocks, context_blocks=DEFAULT_CONTEXT_BLOCKS):
+    """
+    Computes detection scores inside regions of interest and in their surroundings, running the detector only on the blocks involved.
+    :param detect_region: function that takes a final block range and returns the detection map over it, of shape [num_rows, num_cols] or [num_rows, num_cols, num_templates]
+    :param rois: list of 4-tuples of left, top, right and bottom pixel coordinates in the full-resolution image
+    :param v_scale: vertical resolution of the final blocks relative to the full-resolution image
+    :param h_scale: horizontal resolution of the final blocks relative to the full-resolution image
+    :param crop_offsets: 2-tuple of pixels cropped from the top and left margins at the final resolution
+    :param num_vertical_blocks: number of final block rows
+    :param num_horizontal_blocks: number of final block columns
+    :param context_blocks: number of blocks around each region whose scores make up its complement score. Blocks inside any region of interest are excluded from the complement.
+    :return: scores averaged over all regions weighted by their number of blocks, and list of per-region dicts with keys "score", "complement_score", "num_blocks" and "num_complement_blocks". Scores are vectors over the templates, and NaN if there are no blocks.
+    """
+    crop_top, crop_left = crop_offsets
+    unclipped_block_ranges = [roi_to_block_range(roi, v_scale, h_scale, crop_top, crop_left, num_vertical_blocks, num_horizontal_blocks, clip=False) for roi in rois]
+    roi_block_ranges = [clip_block_range(block_range, num_vertical_blocks, num_horizontal_blocks) for block_range in unclipped_block_ranges]
+    # The context is grown from the unclipped range, such that regions outside of the channel get no context either
+    context_block_ranges = [expand_block_range(block_range, context_blocks, num_vertical_blocks, num_horizontal_blocks) for block_range in unclipped_block_ranges]
+
+    # Blocks covered by any region of interest
+    roi_mask = np.zeros((num_vertical_blocks, num_horizontal_blocks), dtype=bool)
+    for first_row, last_row, first_col, last_col in roi_block_ranges:
+        roi_mask[first_row:last_row, first_col:last_col] = True
+
+    roi_scores = []
+    for (first_row, last_row, first_col, last_col), context_block_range in zip(roi_block_ranges, context_block_ranges):
+        context_first_row, context_last_row, context_first_col, context_last_col = context_block_range
+
+        # Each region is scored on the detection map over its own context only, such that its scores do not depend on the other regions, e.g., through the noise power of the residual
+        region_map = None
+        if context_last_row > context_first_row and context_last_col > context_first_col:
+            region_map = detect_region(context_block_range)
+            region_map = region_map.reshape(region_map.shape[:2] + (-1,))
+
+        def mean_over(mask):
+            if region_map is None or not np.any(mask):
+                return np.array([np.nan]), 0
+            return np.mean(region_map[mask], axis=0), int(np.count_nonzero(mask))
+
+        mask = np.zeros((context_last_row - context_first_row, context_last_col - context_first_col), dtype=bool)
+        mask[first_row - context_first_row:last_row - context_first_row, first_col - context_first_col:last_col - context_first_col] = True
+        score, num_blocks = mean_over(mask)
+
+        complement_mask = ~roi_mask[context_first_row:context_last_row, context_first_col:context_last_col]
+        complement_score, num_complement_blocks = mean_over(complement_mask)
+
+        roi_scores.append({
+            "score": score,
+            "complement_score": complement_score,
+            "num_blocks": num_blocks,
+            "num_complement_blocks": num_complement_blocks,
+        })
+
+    # Average over all regions, weighted by their number of blocks
+    num_roi_blocks = sum(roi_score["num_blocks"] for roi_score in roi_scores)
+    if num_roi_blocks == 0:
+        union_score = np.array([np.nan])
+    else:
+        union_score = sum(roi_score["score"] * roi_score["num_blocks"] for roi_score in roi_scores if roi_score["num_blocks"] > 0) / num_roi_blocks
+
+    return union_score, roi_scores
+
+
+def score_channel_rois(dct_coefs, quantization_table, detector, rois, v_scale, h_scale, reduce_444_chroma=False, crop_offsets=(0, 0), use_noise_residual=False, context_blocks=DEFAULT_CONTEXT_BLOCKS):
+    """
+    Scores regions of interest of a single chroma channel with the same preprocessing as score_decoder, but transforms and correlates only the blocks within the context of the regions.
+    Dequantization, residual and cropping run on the source blocks that the processed blocks depend on. The noise power of the residual is estimated over the context of each region instead of the whole channel, and the upsampling method of reduced channels is detected over the context of each region. Each region is processed on its own, so that its scores do not depend on the other regions.
+    :param dct_coefs: quantized DCT coefficients of the channel as decoded, of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+    :param quantization_table: quantization table of the channel, flattened to 64 entries
+    :param detector: detector instance
+    :param rois: list of 4-tuples of left, top, right and bottom pixel coordinates in the full-resolution image
+    :param v_scale: vertical resolution of the channel as decoded relative to the full-resolution image, i.e., the vertical sampling factor of the channel divided by the maximum vertical sampling factor
+    :param h_scale: horizontal resolution of the channel as decoded relative to the full-resolution image
+    :param reduce_444_chroma: Whether to reduce the channel resolution by a factor of 2 in both directions
+    :param crop_offsets: 2-tuple of pixels to crop from the top and left margins after reduction
+    :param use_noise_residual: whether to use noise residual instead of image
+    :param context_blocks: number of blocks around each region whose scores make up its complement score
+    :return: scores averaged over all regions and list of per-region dicts, see score_rois
+    """
+    num_vertical_blocks, num_horizontal_blocks = dct_coefs.shape[:2]
+
+    reduce_fn = None
+    if reduce_444_chroma:
+        from utils.upsampling import reduce_444_chroma_channel
+        reduce_fn = reduce_444_chroma_channel
+        num_vertical_blocks, num_horizontal_blocks = num_vertical_blocks // 2, num_horizontal_blocks // 2
+        v_scale, h_scale = v_scale / 2., h_scale / 2.
+
+    # Number of final blocks as computed by crop
+    crop_top, crop_left = crop_offsets
+    num_vertical_blocks = (num_vertical_blocks * 8 - crop_top) // 8
+    num_horizontal_blocks = (num_horizontal_blocks * 8 - crop_left) // 8
+
+    residual_fn = None
+    if use_noise_residual:
+        from utils.noise_residual import obtain_noise_residual
+
+        # Dequantize before computing the residual, and compute scores on the dequantized coefficients
+        residual_fn = lambda region: obtain_noise_residual(region * quantization_table)
+        detector_quantization_table = None
+    else:
+        # The detector folds the quantization table into the correlation
+        detector_quantization_table = quantization_table
+
+    def detect_region(block_range):
+        region = preprocess_region(dct_coefs, block_range, num_vertical_blocks, num_horizontal_blocks, reduce_444_chroma=reduce_fn, crop_offsets=crop_offsets, noise_residual=residual_fn)
+        return detector.detect_map(region, quantization_table=detector_quantization_table)
+
+    return score_rois(detect_region, rois, v_scale, h_scale, crop_offsets, num_vertical_blocks, num_horizontal_blocks, context_blocks=context_blocks)
+
+
+if __name__ == "__main__":
+    # Compare the scores of regions of interest to the corresponding blocks of the whole-channel detection map
+    from detectors.dct.dct_template_bank_detector import DctTemplateBankDetector
+    from utils.upsampling import reduce_444_chroma_channel
+    from utils.noise_residual import obtain_noise_residual
+
+    rng = np.random.default_rng(0)
+    detector = DctTemplateBankDetector()
+    quantization_table = rng.integers(1, 30, size=64).astype(np.uint16)
+    dct_coefs = rng.integers(-3, 4, size=(30, 42, 64)).astype(np.int16)
+
+    rois = [(40, 24, 120, 96), (200, 150, 330, 239), (500, 500, 600, 600), (2000, 2000, 2100, 2100)]
+    for reduce_444_chroma in [False, True]:
+        for crop_offsets in [(0, 0), (3, 5)]:
+            channel = reduce_444_chroma_channel(dct_coefs) if reduce_444_chroma else dct_coefs
+            channel = crop(channel, *crop_offsets) if crop_offsets != (0, 0) else channel
+            expected_map = detector.detect_map(channel, quantization_table=quantization_table)
+
+            # Full-resolution 4:2:0 image: chroma channels have half the resolution
+            union_score, roi_scores = score_channel_rois(dct_coefs, quantization_table, detector, rois, 0.5, 0.5, reduce_444_chroma=reduce_444_chroma, crop_offsets=crop_offsets)
+            scale = 4 if reduce_444_chroma else 2
+            for roi, roi_score in zip(rois, roi_scores):
+                block_range = roi_to_block_range(roi, 1. / scale, 1. / scale, crop_offsets[0], crop_offsets[1], *expected_map.shape[:2])
+                first_row, last_row, first_col, last_col = block_range
+                if roi_score["num_blocks"] == 0:
+                    assert last_row == first_row or last_col == first_col
+                    continue
+                expected_score = np.mean(expected_map[first_row:last_row, first_col:last_col], axis=(0, 1))
+                assert np.allclose(roi_score["score"], expected_score), "Region scores differ"
+
+    # Regions far outside of the channel have neither blocks nor context
+    _, roi_scores = score_channel_rois(dct_coefs, quantization_table, detector, [(2000, 2000, 2100, 2100)], 0.5, 0.5)
+    assert roi_scores[0]["num_blocks"] == 0 and roi_scores[0]["num_complement_blocks"] == 0
+    assert np.all(np.isnan(roi_scores[0]["score"])) and np.all(np.isnan(roi_scores[0]["complement_score"]))
+
+    # The residual with halo matches the whole-channel residual when the region covers the whole channel, such that the noise power is estimated over the same pixels
+    residual_map = detector.detect_map(obtain_noise_residual(dct_coefs * quantization_table))
+    union_score, _ = score_channel_rois(dct_coefs, quantization_table, detector, [(0, 0, 42 * 8, 30 * 8)], 1., 1., use_noise_residual=True)
+    assert np.allclose(union_score, np.mean(residual_map, axis=(0, 1))), "Residual scores differ"
+
+    # Overlapping regions do not change each other's scores, although the residual's noise power is estimated over the processed blocks
+    rois = [(40, 24, 160, 120), (120, 80, 260, 200)]
+    _, alone_scores = score_channel_rois(dct_coefs, quantization_table, detector, rois[:1], 0.5, 0.5, use_noise_residual=True)
+    _, overlapping_scores = score_channel_rois(dct_coefs, quantization_table, detector, rois, 0.5, 0.5, use_noise_residual=True)
+    assert np.allclose(alone_scores[0]["score"], overlapping_scores[0]["score"]), "Region scores depend on other regions"
+    assert overlapping_scores[0]["num_complement_blocks"] < alone_scores[0]["num_complement_blocks"]
+
+    print("Region scores agree")
@@ -0,0 +1,60 @@
+from utils.jpeg_io import read_frame_header, count_blocks
+import heapq
+import io
+import os
+
+
+# Cost models to estimate the processing time of an image
+COST_FILE_SIZE = "size"
+COST_NUM_BLOCKS = "blocks"
+COST_MODELS = [COST_FILE_SIZE, COST_NUM_BLOCKS]
+
+
+def estimate_cost(img_filename, data=None, cost_model=COST_FILE_SIZE):
+    """
+    Estimates the processing time of an image without decoding it
+    :param img_filename: path to jpg file, only used if data is None
+    :param data: (optional) JPEG file content as bytes
+    :param cost_model: "size" for the file size, or "blocks" for the number of blocks according to the frame header
+    :return: cost in arbitrary units, comparable only among images with the same cost model
+    """
+    if COST_NUM_BLOCKS == cost_model:
+        try:
+            with open(img_filename, "rb") if data is None else io.BytesIO(data) as f:
+                return count_blocks(*read_frame_header(f))
+        except (OSError, ValueError):
+            # Images without a valid frame header fail quickly, thus schedule them last
+            return 0
+
+    if data is not None:
+        return len(data)
+
+    return os.path.getsize(img_filename)
+
+
+class LongestProcessingTimeFirstQueue(object):
+    def __init__(self):
+        """
+        Queue of pending tasks that always hands out the task with the highest estimated cost first.
+        Dispatching the largest tasks first to whichever worker becomes idle keeps workers busy until the end, instead of leaving a few large tasks to run alone at the tail.
+        Tasks with equal cost are handed out in the order they were added.
+        """
+        self._heap = []
+        self._num_added = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, cost, task):
+        """
+        :param cost: estimated cost of the task
+        :param task: arbitrary task description
+        """
+        heapq.heappush(self._heap, (-cost, self._num_added, task))
+        self._num_added += 1
+
+    def pop(self):
+        """
+        :return: the pending task with the highest cost
+        """
+        return heapq.heappop(self._heap)[2]
@@ -0,0 +1,104 @@
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+
+
+# Alignment of arrays within a slab in bytes
+ARRAY_ALIGNMENT = 64
+
+
+class SlabPool(object):
+    def __init__(self, num_slabs, slab_size):
+        """
+        Fixed number of shared memory slabs to hand arrays from one process to another without pickling them.
+        A producer acquires a free slab, writes its arrays into it and passes the slab index and the array layout to a consumer. The consumer reads the arrays in place and releases the slab when done.
+        Because producers block while all slabs are in use, the shared memory stays bounded by num_slabs * slab_size.
+        The pool must be created before the processes are started, which inherit the mapped slabs.
+        :param num_slabs: number of slabs
+        :param slab_size: size of each slab in bytes
+        """
+        self._slab_size = slab_size
+        self._slabs = [shared_memory.SharedMemory(create=True, size=slab_size) for _ in range(num_slabs)]
+
+        self._free_slabs = multiprocessing.Queue()
+        for slab_index in range(num_slabs):
+            self._free_slabs.put(slab_index)
+
+    @property
+    def slab_size(self):
+        return self._slab_size
+
+    @staticmethod
+    def get_layout(arrays):
+        """
+        Computes where each array is placed within a slab
+        :param arrays: list of ndarrays
+        :return: list of 3-tuples of byte offset, shape and dtype string per array, and the number of bytes needed, as 2-tuple
+        """
+        layout = []
+        offset = 0
+        for array in arrays:
+            layout.append((offset, array.shape, array.dtype.str))
+            # Round up to the next aligned offset
+            offset += -(-array.nbytes // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+        return layout, offset
+
+    def fits(self, arrays):
+        """
+        :param arrays: list of ndarrays
+        :return: True if the arrays fit into a single slab
+        """
+        return self.get_layout(arrays)[1] <= self._slab_size
+
+    def acquire(self):
+        """
+        Blocks until a slab is free
+        :return: index of the acquired slab
+        """
+        return self._free_slabs.get()
+
+    def release(self, slab_index):
+        """
+        Returns a slab to the pool. Views obtained from read_arrays must not be used afterwards.
+        :param slab_index: index of a slab obtained from acquire
+        """
+        self._free_slabs.put(slab_index)
+
+    def write_arrays(self, slab_index, arrays):
+        """
+        Copies arrays into a slab
+        :param slab_index: index of an acquired slab
+        :param arrays: list of ndarrays that fit into the slab
+        :return: layout to pass on to read_arrays
+        """
+        layout, num_bytes = self.get_layout(arrays)
+        if num_bytes > self._slab_size:
+            raise ValueError("Arrays need {} bytes, which exceeds the slab size of {} bytes".format(num_bytes, self._slab_size))
+
+        buffer = self._slabs[slab_index].buf
+        for (offset, shape, dtype), array in zip(layout, arrays):
+            np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)[...] = array
+        return layout
+
+    def read_arrays(self, slab_index, layout):
+        """
+        Provides read-only views of the arrays in a slab without copying them
+        :param slab_index: index of a slab written by write_arrays
+        :param layout: layout returned by write_arrays
+        :return: list of ndarrays
+        """
+        buffer = self._slabs[slab_index].buf
+        arrays = []
+        for offset, shape, dtype in layout:
+            array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            array.flags.writeable = False
+            arrays.append(array)
+        return arrays
+
+    def close(self):
+        """
+        Frees the shared memory. Must only be called by the process that created the pool, after all other processes have finished.
+        """
+        for slab in self._slabs:
+            slab.close()
+            slab.unlink()
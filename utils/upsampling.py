@@ -1,4 +1,5 @@
-from scipy.fftpack import dct, idct
+from utils.dct import dct_2d, blocks_to_channel, channel_to_blocks
+from utils import kernels
 import numpy as np
 
 
@@ -6,40 +7,62 @@ SIMPLE_UPSAMPLING = "simple_upsampling"
 DCT_UPSAMPLING = "dct_upsampling"
 AUTO = "auto"
 
+# Images of which more than this fraction of pixels are copies of the top-left member of their 2x2 block are considered to have undergone simple upsampling
+SIMPLE_UPSAMPLING_THRESHOLD = 0.95
 
-def has_undergone_simple_upsampling(channel):
+# Number of rows that pixel-domain checks process at once
+DEFAULT_CHUNK_ROWS = 256
+
+
+def count_simple_upsampling_matches(channel):
     """
-    Determines whether the values inside each 2x2 block is a copy of the top-left block member
-    :param channel: 2-D image channel
-    :return: score in range [0, 1] where 1 indicates that all values inside each 2x2 blocks are copies of their top-left block member
+    Counts how many pixel values inside each 2x2 block match to their top-left block member after truncation to integers.
+    Compares strided views of the channel instead of building an array of blocks.
+    :param channel: 2-D image channel. A last row or column is disregarded if the size is uneven.
+    :return: number of matching pixels, and number of 2x2 blocks
     """
+    num_vertical_blocks = channel.shape[0] // 2
+    num_horizontal_blocks = channel.shape[1] // 2
 
-    height, width = channel.shape
+    if kernels.BACKEND_NUMBA == kernels.get_backend():
+        if channel.dtype != np.float32:
+            channel = np.asarray(channel, dtype=np.float64)
+        return int(kernels.numba_kernels().count_simple_upsampling_matches(channel)), num_vertical_blocks * num_horizontal_blocks
 
-    # Disregard last row or column if the image size is uneven
-    if height % 2 == 1:
-        channel = channel[:-1, :]
-        height -= 1
-    if width % 2 == 1:
-        channel = channel[:, :-1]
-        width -= 1
+    height = num_vertical_blocks * 2
+    width = num_horizontal_blocks * 2
 
-    # Reshape into blocks of size 2x2
-    num_horizontal_blocks = width // 2
-    num_vertical_blocks = height // 2
+    # Round to integer
+    top_left = channel[0:height:2, 0:width:2].astype(np.int64)
+    num_matching_values = 0
+    for dy, dx in [(0, 1), (1, 0), (1, 1)]:
+        num_matching_values += np.count_nonzero(channel[dy:height:2, dx:width:2].astype(np.int64) == top_left)
 
-    blocks = channel.reshape(num_vertical_blocks, 2, num_horizontal_blocks, 2).transpose(0, 2, 1, 3)
-    blocks = blocks.reshape(num_vertical_blocks * num_horizontal_blocks, 2 * 2)
+    return num_matching_values, num_vertical_blocks * num_horizontal_blocks
 
-    # Round to integer
-    blocks = blocks.astype(np.int)
 
-    # Count how many pixel values inside each block match to their top-left block member
-    inside_block_difference = blocks[:, 1:] - np.expand_dims(blocks[:, 0], axis=1)
-    num_matching_values = 3 - np.count_nonzero(inside_block_difference, axis=1)
+def has_undergone_simple_upsampling(channel, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Determines whether the values inside each 2x2 block is a copy of the top-left block member
+    :param channel: 2-D image channel
+    :param chunk_rows: number of rows to compare at once, which bounds the size of intermediate arrays. Must be even.
+    :return: score in range [0, 1] where 1 indicates that all values inside each 2x2 blocks are copies of their top-left block member
+    """
+    if chunk_rows < 2 or chunk_rows % 2 != 0:
+        raise ValueError("Number of rows per chunk must be even")
+
+    num_matching_values = 0
+    num_blocks = 0
+    for top in range(0, channel.shape[0], chunk_rows):
+        chunk_matching_values, chunk_blocks = count_simple_upsampling_matches(channel[top:top + chunk_rows])
+        num_matching_values += chunk_matching_values
+        num_blocks += chunk_blocks
+
+    if num_blocks == 0:
+        return np.nan
 
     # Normalize to range [0, 1]
-    return np.mean(num_matching_values / 3)
+    return num_matching_values / (3 * num_blocks)
 
 
 def undo_simple_upsampling(channel):
@@ -72,11 +95,9 @@ def undo_dct_upsampling(channel):
 
     # Split into 16x16 blocks
     blocks_16x16 = channel.reshape(num_output_vertical_blocks, 16, num_output_horizontal_blocks, 16).transpose([0, 2, 1, 3])
-    # Flatten last dimension
-    blocks_16x16_flat = blocks_16x16.reshape(num_output_vertical_blocks, num_output_horizontal_blocks, 16 * 16)
 
     # Apply the 2-D DCT
-    dct_blocks_16x16 = np.apply_along_axis(lambda x: dct(dct(x.reshape(16, 16), axis=1, norm="ortho"), axis=0, norm="ortho"), axis=2, arr=blocks_16x16_flat)
+    dct_blocks_16x16 = dct_2d(blocks_16x16)
 
     # Retain only the top-left 8x8 coefficients
     dct_blocks_8x8 = dct_blocks_16x16[:, :, :8, :8]
@@ -99,17 +120,12 @@ def reduce_444_chroma_channel(dct_blocks, upsampling_method=AUTO):
     if upsampling_method not in upsampling_methods:
         raise ValueError("Upsampling method not known")
 
-    # Convert to spatial domain
-    # Apply the 2-D IDCT
-    blocks_8x8 = np.apply_along_axis(lambda x: idct(idct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho"), axis=2, arr=dct_blocks)
-
-    # Align blocks spatially
-    num_vertical_blocks, num_horizontal_blocks = blocks_8x8.shape[:2]
-    channel = blocks_8x8.transpose(0, 2, 1, 3).reshape(num_vertical_blocks * 8, num_horizontal_blocks * 8)
+    # Convert to spatial domain and align blocks spatially
+    channel = blocks_to_channel(dct_blocks)
 
     if AUTO == upsampling_method:
         has_undergone_simple_upsampling_result = has_undergone_simple_upsampling(channel)
-        if has_undergone_simple_upsampling_result > 0.95:
+        if has_undergone_simple_upsampling_result > SIMPLE_UPSAMPLING_THRESHOLD:
             upsampling_method = SIMPLE_UPSAMPLING
         else:
             upsampling_method = DCT_UPSAMPLING
@@ -118,23 +134,14 @@ def reduce_444_chroma_channel(dct_blocks, upsampling_method=AUTO):
         chroma_quartered_spatial = undo_simple_upsampling(channel)
         height, width = chroma_quartered_spatial.shape
 
-        # Split into 8x8 blocks
-        num_output_vertical_blocks = height // 8
-        num_output_horizontal_blocks = width // 8
-
         # Cut off right-most columns or bottom rows that are not a multiple of 8
         if height % 8 != 0:
             chroma_quartered_spatial = chroma_quartered_spatial[:-(height % 8), :]
         if width % 8 != 0:
             chroma_quartered_spatial = chroma_quartered_spatial[:, :-(width % 8)]
 
-        blocks_8x8 = chroma_quartered_spatial.reshape(num_output_vertical_blocks, 8, num_output_horizontal_blocks, 8).transpose(0, 2, 1, 3)
-        # Flatten last dimension
-        blocks_8x8_flat = blocks_8x8.reshape(num_output_vertical_blocks, num_output_horizontal_blocks, 8 * 8)
-
-        # Transform back into DCT-domain
-        dct_blocks_64 = np.apply_along_axis(lambda x: dct(dct(x.reshape(8, 8), axis=1, norm="ortho"), axis=0, norm="ortho").flatten(), axis=2, arr=blocks_8x8_flat)
-        return dct_blocks_64
+        # Split into 8x8 blocks and transform back into DCT-domain
+        return channel_to_blocks(chroma_quartered_spatial)
 
     elif DCT_UPSAMPLING == upsampling_method:
         chroma_quartered_dct_blocks_8x8 = undo_dct_upsampling(channel)
@@ -0,0 +1,150 @@
+from utils.constants import COL_FILENAME, COL_CB_SCORE, COL_CR_SCORE, COL_VERIFIED, COL_CB_REFERENCE_SCORE, COL_CR_REFERENCE_SCORE, COL_CB_SCORE_DIFFERENCE, COL_CR_SCORE_DIFFERENCE, COL_SCORE_SECONDS, COL_REFERENCE_SCORE_SECONDS
+from utils.logger import setup_custom_logger
+import numpy as np
+import hashlib
+import time
+import os
+
+
+log = setup_custom_logger(os.path.basename(__file__))
+
+
+# Maximum absolute difference between the scores of the optimized and the reference implementations
+DEFAULT_TOLERANCE = 1e-6
+
+# Number of block rows and columns of the image used to warm up the optimized implementations
+WARM_UP_BLOCKS = 16
+
+
+class VerificationError(Exception):
+    pass
+
+
+class ScoreVerifier(object):
+    def __init__(self, fraction, tolerance=DEFAULT_TOLERANCE, seed=0):
+        """
+        Scores a random fraction of images a second time with the frozen reference implementations in utils.reference, and compares the scores of both runs.
+        Which images are selected is decided by hashing their names, such that the selection is identical no matter whether images are scored in the main process, in worker processes, or in the staged pipeline.
+        :param fraction: fraction of images to verify, in range [0, 1]
+        :param tolerance: maximum absolute difference between the Cb and Cr scores of both implementations
+        :param seed: changes the selection of images
+        """
+        if not 0 <= fraction <= 1:
+            raise ValueError("Fraction of images to verify must be in range [0, 1]")
+
+        self._fraction = fraction
+        self._tolerance = tolerance
+        self._seed = seed
+        # Set per process, since worker processes receive a copy of the verifier
+        self._warmed_up = False
+
+        # Summary over the rows passed to check
+        self._num_verified = 0
+        self._max_difference = 0.
+        self._seconds = 0.
+        self._reference_seconds = 0.
+
+    @property
+    def tolerance(self):
+        return self._tolerance
+
+    def warm_up(self, score, cb_dct_coefs, cr_dct_coefs):
+        """
+        Runs the optimized implementations once on the top-left corner of the image without timing them, unless done before in this process.
+        The first call imports lazily loaded modules such as scipy, sets up the detector and possibly compiles kernels, which would otherwise be counted in the scoring time of the first image.
+        :param score: function that scores the given Cb and Cr coefficients
+        :param cb_dct_coefs: quantized DCT coefficients of the Cb channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param cr_dct_coefs: quantized DCT coefficients of the Cr channel
+        """
+        if self._warmed_up:
+            return
+
+        score(cb_dct_coefs[:WARM_UP_BLOCKS, :WARM_UP_BLOCKS], cr_dct_coefs[:WARM_UP_BLOCKS, :WARM_UP_BLOCKS])
+        self._warmed_up = True
+
+    def is_selected(self, img_filename):
+        """
+        :param img_filename: name of the image
+        :return: whether the image is among the fraction of images to verify
+        """
+        digest = hashlib.md5("{}:{}".format(self._seed, img_filename).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64 < self._fraction
+
+    def verify(self, img_filename, cb_dct_coefs, cr_dct_coefs, cb_quantization_table, cr_quantization_table, cb_score, cr_score, seconds, reduce_chroma=False, crop_offsets=None, use_noise_residual=False):
+        """
+        Scores the image with the reference implementations if it is selected
+        :param img_filename: name of the image
+        :param cb_dct_coefs: quantized DCT coefficients of the Cb channel of shape [num_vertical_blocks, num_horizontal_blocks, 64]
+        :param cr_dct_coefs: quantized DCT coefficients of the Cr channel
+        :param cb_quantization_table: flat quantization table of the Cb channel
+        :param cr_quantization_table: flat quantization table of the Cr channel
+        :param cb_score: Cb score of the optimized implementations
+        :param cr_score: Cr score of the optimized implementations
+        :param seconds: time taken by the optimized implementations
+        :param reduce_chroma: Whether to reduce chroma channel resolution by a factor of 2 in both directions
+        :param crop_offsets: (optional) 2-tuple of number of pixels to crop from the top and left margins
+        :param use_noise_residual: whether to use noise residual instead of image
+        :return: dict of verification columns. Images that are not selected get NaN reference scores, such that all rows have the same columns.
+        """
+        columns = {
+            COL_VERIFIED: False,
+            COL_CB_REFERENCE_SCORE: np.nan,
+            COL_CR_REFERENCE_SCORE: np.nan,
+            COL_CB_SCORE_DIFFERENCE: np.nan,
+            COL_CR_SCORE_DIFFERENCE: np.nan,
+            COL_SCORE_SECONDS: seconds,
+            COL_REFERENCE_SCORE_SECONDS: np.nan,
+        }
+        if not self.is_selected(img_filename):
+            return columns
+
+        # The reference implementations are slow to import and to run, thus only load them when needed
+        from utils import reference
+
+        start = time.perf_counter()
+        cb_reference_score = reference.score_channel(cb_dct_coefs, cb_quantization_table, reduce_chroma=reduce_chroma, crop_offsets=crop_offsets, use_noise_residual=use_noise_residual)
+        cr_reference_score = reference.score_channel(cr_dct_coefs, cr_quantization_table, reduce_chroma=reduce_chroma, crop_offsets=crop_offsets, use_noise_residual=use_noise_residual)
+        reference_seconds = time.perf_counter() - start
+
+        columns.update({
+            COL_VERIFIED: True,
+            COL_CB_REFERENCE_SCORE: cb_reference_score,
+            COL_CR_REFERENCE_SCORE: cr_reference_score,
+            COL_CB_SCORE_DIFFERENCE: abs(cb_score - cb_reference_score),
+            COL_CR_SCORE_DIFFERENCE: abs(cr_score - cr_reference_score),
+            COL_REFERENCE_SCORE_SECONDS: reference_seconds,
+        })
+        return columns
+
+    def check(self, row):
+        """
+        Compares the score differences of a result row against the tolerance, and adds them to the summary
+        :param row: result row with verification columns
+        :return: True if the row was not verified or its differences are within the tolerance, False otherwise
+        """
+        if not row.get(COL_VERIFIED, False):
+            return True
+
+        self._num_verified += 1
+        self._max_difference = np.nanmax([self._max_difference, row[COL_CB_SCORE_DIFFERENCE], row[COL_CR_SCORE_DIFFERENCE]])
+        self._seconds += row[COL_SCORE_SECONDS]
+        self._reference_seconds += row[COL_REFERENCE_SCORE_SECONDS]
+
+        if self._agree(row[COL_CB_SCORE], row[COL_CB_REFERENCE_SCORE]) and self._agree(row[COL_CR_SCORE], row[COL_CR_REFERENCE_SCORE]):
+            return True
+
+        log.error("Scores of image {} differ from the reference implementations by more than {}: Cb {} vs. {}, Cr {} vs. {}".format(row[COL_FILENAME], self._tolerance, row[COL_CB_SCORE], row[COL_CB_REFERENCE_SCORE], row[COL_CR_SCORE], row[COL_CR_REFERENCE_SCORE]))
+        return False
+
+    def _agree(self, score, reference_score):
+        # Images without any blocks have NaN scores in both implementations
+        if np.isnan(score) and np.isnan(reference_score):
+            return True
+        return abs(score - reference_score) <= self._tolerance
+
+    def log_summary(self):
+        if self._num_verified == 0:
+            log.info("No images verified")
+            return
+
+        log.info("Verified {} images against the reference implementations, maximum score difference {:.3g}, {:.3f}s vs. {:.3f}s reference ({:.1f}x)".format(self._num_verified, self._max_difference, self._seconds, self._reference_seconds, self._reference_seconds / self._seconds if self._seconds > 0 else np.nan))